@@ -23,7 +23,7 @@ from fastapi import (
     Depends,
     Security,
 )
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, FileResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel
@@ -32,7 +32,18 @@ from decouple import config
 # Add current directory to path for imports
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
-from llm_aided_ocr import process_document_pipeline
+from llm_aided_ocr import (
+    process_document_pipeline,
+    get_concurrency_levels,
+    event_loop_lag_monitor,
+    local_inference_worker,
+    get_usage_summary,
+    discard_usage_ledger,
+    Counter,
+    Gauge,
+    metrics_collectors,
+    render_metrics,
+)
 
 # Setup logging
 logging.basicConfig(
@@ -69,6 +80,11 @@ app = FastAPI(
     version="1.0.0",
 )
 
+@app.on_event("startup")
+async def start_event_loop_lag_monitor():
+    event_loop_lag_monitor.start()
+
+
 # Add CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -81,6 +97,38 @@ app.add_middleware(
 # Global variables for job tracking
 active_jobs: Dict[str, Dict[str, Any]] = {}
 
+# Metrics
+http_requests_in_flight = Gauge(
+    "http_requests_in_flight", "API requests currently being served"
+)
+http_requests_total = Counter(
+    "http_requests_total", "API requests served", ("method", "status")
+)
+api_jobs = Gauge("api_jobs", "Jobs known to the API server by status", ("status",))
+
+
+def collect_job_metrics():
+    counts = {(status,): 0 for status in ["pending", "processing", "completed", "failed"]}
+    for job in list(active_jobs.values()):
+        counts[(job["status"],)] = counts.get((job["status"],), 0) + 1
+    api_jobs.replace(counts)
+
+
+metrics_collectors.append(collect_job_metrics)
+
+
+@app.middleware("http")
+async def track_http_requests(request, call_next):
+    http_requests_in_flight.inc()
+    status = "500"
+    try:
+        response = await call_next(request)
+        status = str(response.status_code)
+        return response
+    finally:
+        http_requests_in_flight.dec()
+        http_requests_total.inc(labels=(request.method, status))
+
 # Ensure results directory exists
 RESULTS_DIR_PATH = Path(RESULTS_DIR)
 RESULTS_DIR_PATH.mkdir(exist_ok=True)
@@ -93,6 +141,7 @@ class JobStatus(BaseModel):
     message: Optional[str] = None
     output_files: Optional[Dict[str, str]] = None
     error: Optional[str] = None
+    usage: Optional[Dict[str, Any]] = None  # tokens, cost and latency per provider/model
     created_at: datetime
     updated_at: datetime
 
@@ -102,6 +151,7 @@ class ProcessRequest(BaseModel):
     model: Optional[str] = None
     output_path: Optional[str] = None
     ocr_languages: Optional[str] = None
+    model_cascade: Optional[str] = None
 
 
 def validate_pdf_file(file_path: str) -> bool:
@@ -135,6 +185,8 @@ async def process_pdf_job(
     output_path: Optional[str] = None,
     provider: Optional[str] = None,
     model: Optional[str] = None,
+    ocr_languages: Optional[str] = None,
+    model_cascade: Optional[str] = None,
 ):
     """Background task to process PDF"""
     try:
@@ -185,7 +237,9 @@ async def process_pdf_job(
                 max_test_pages=0,
                 skip_first_n_pages=0,
                 reformat_as_markdown=True,
-                ocr_languages=request.ocr_languages,
+                ocr_languages=ocr_languages,
+                model_cascade=model_cascade,
+                job_id=job_id,
             )
 
             # Output files are already returned by the pipeline function
@@ -209,6 +263,10 @@ async def process_pdf_job(
         active_jobs[job_id]["error"] = str(e)
         active_jobs[job_id]["message"] = f"Processing failed: {str(e)}"
         active_jobs[job_id]["updated_at"] = datetime.now()
+    finally:
+        # Keep the job's usage summary and drop its per-completion ledger
+        active_jobs[job_id]["usage"] = get_usage_summary(job_id)
+        discard_usage_ledger(job_id)
 
 
 @app.get("/")
@@ -231,7 +289,21 @@ async def root(credentials: HTTPAuthorizationCredentials = Security(security)):
 @app.get("/health")
 async def health_check(credentials: HTTPAuthorizationCredentials = Security(security)):
     """Health check endpoint"""
-    return {"status": "healthy", "timestamp": datetime.now().isoformat()}
+    return {
+        "status": "healthy",
+        "timestamp": datetime.now().isoformat(),
+        "concurrency": get_concurrency_levels(),
+        "event_loop_lag": event_loop_lag_monitor.get_stats(),
+        "local_inference": local_inference_worker.get_stats(),
+    }
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics(credentials: HTTPAuthorizationCredentials = Security(security)):
+    """Pipeline, provider and server metrics in the Prometheus text format"""
+    return PlainTextResponse(
+        render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
 
 
 @app.post("/process")
@@ -242,6 +314,7 @@ async def process_pdf_from_path(
     provider: Optional[str] = Form(None),
     model: Optional[str] = Form(None),
     ocr_languages: Optional[str] = Form(None),
+    model_cascade: Optional[str] = Form(None),
     credentials: HTTPAuthorizationCredentials = Security(security),
 ):
     """
@@ -253,6 +326,7 @@ async def process_pdf_from_path(
         provider: Optional LLM provider (openai, claude, lm-studio)
         model: Optional model name (for lm-studio)
         ocr_languages: Optional OCR languages (e.g., "eng+rus+deu")
+        model_cascade: Optional model tiers, cheapest first (e.g., "lm-studio:qwen2.5-7b-instruct,openai:gpt-4o")
 
     Returns:
         Job ID for tracking processing status
@@ -286,7 +360,14 @@ async def process_pdf_from_path(
 
     # Start background processing
     background_tasks.add_task(
-        process_pdf_job, job_id, pdf_path, output_path, provider, model, ocr_languages
+        process_pdf_job,
+        job_id,
+        pdf_path,
+        output_path,
+        provider,
+        model,
+        ocr_languages,
+        model_cascade,
     )
 
     return {
@@ -305,6 +386,7 @@ async def upload_and_process_pdf(
     output_path: Optional[str] = Form(None),
     provider: Optional[str] = Form(None),
     model: Optional[str] = Form(None),
+    model_cascade: Optional[str] = Form(None),
     credentials: HTTPAuthorizationCredentials = Security(security),
 ):
     """
@@ -315,6 +397,7 @@ async def upload_and_process_pdf(
         output_path: Optional output path for results
         provider: Optional LLM provider (openai, claude, lm-studio)
         model: Optional model name (for lm-studio)
+        model_cascade: Optional model tiers, cheapest first (e.g., "lm-studio:qwen2.5-7b-instruct,openai:gpt-4o")
 
     Returns:
         Job ID for tracking processing status
@@ -361,7 +444,14 @@ async def upload_and_process_pdf(
 
     # Start background processing
     background_tasks.add_task(
-        process_pdf_job, job_id, str(pdf_path), output_path, provider, model
+        process_pdf_job,
+        job_id,
+        str(pdf_path),
+        output_path,
+        provider,
+        model,
+        None,
+        model_cascade,
     )
 
     return {
@@ -382,6 +472,8 @@ async def get_job_status(
         raise HTTPException(status_code=404, detail="Job not found")
 
     job = active_jobs[job_id]
+    if job["status"] == "processing":
+        job = {**job, "usage": get_usage_summary(job_id)}
     return JobStatus(**job)
 
 
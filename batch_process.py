@@ -7,6 +7,7 @@ Processes multiple PDF files in a directory
 import os
 import sys
 import glob
+import json
 import subprocess
 import asyncio
 from pathlib import Path
@@ -24,8 +25,35 @@ def change_to_script_directory():
     return script_dir
 
 
+def load_usage_summary(pdf_path):
+    """Usage summary the OCR script wrote next to the PDF, if any"""
+    usage_path = os.path.splitext(pdf_path)[0] + "__usage.json"
+    if not os.path.exists(usage_path):
+        return {}
+    with open(usage_path) as f:
+        return json.load(f)["summary"]
+
+
+def add_usage_summary(totals, summary):
+    """Add one document's usage summary into the batch totals"""
+    for key in [
+        "requests",
+        "retried_requests",
+        "cancelled_requests",
+        "input_tokens",
+        "cached_input_tokens",
+        "output_tokens",
+        "cost",
+    ]:
+        totals[key] = totals.get(key, 0) + summary.get(key, 0)
+    for name, model_usage in summary.get("by_model", {}).items():
+        model_totals = totals.setdefault("by_model", {}).setdefault(name, {})
+        for key, value in model_usage.items():
+            model_totals[key] = model_totals.get(key, 0) + value
+
+
 async def process_pdf(pdf_path, script_dir):
-    """Process a single PDF file"""
+    """Process a single PDF file; returns its usage summary, or None if it failed"""
     print(f"📄 Processing: {os.path.basename(pdf_path)}")
 
     # Change to script directory
@@ -47,10 +75,17 @@ async def process_pdf(pdf_path, script_dir):
         for output in output_files:
             if output.is_file():
                 print(f"   📄 {output.name}")
+        usage = load_usage_summary(pdf_path)
+        if usage:
+            print(
+                f"   🔢 {usage.get('input_tokens', 0):,} input / {usage.get('output_tokens', 0):,} output tokens, ${usage.get('cost', 0):.4f}"
+            )
+        return usage
     else:
         print(f"❌ Failed: {os.path.basename(pdf_path)}")
         if stderr:
             print(f"   Error: {stderr.decode()}")
+        return None
 
 
 async def main():
@@ -109,14 +144,33 @@ async def main():
 
     # Process each PDF
     success_count = 0
+    batch_usage = {"documents": {}}
     for pdf_path in pdf_files:
-        await process_pdf(pdf_path, script_dir)
+        usage = await process_pdf(pdf_path, script_dir)
+        if usage is None:
+            continue
         success_count += 1
+        batch_usage["documents"][os.path.basename(pdf_path)] = usage
+        add_usage_summary(batch_usage, usage)
 
     print(f"\n🎉 Batch processing complete!")
     print(f"✅ Successfully processed: {success_count}/{len(pdf_files)} files")
     print(f"❌ Failed: {len(pdf_files) - success_count} files")
 
+    # Token usage and cost across the batch
+    print(
+        f"🔢 Tokens: {batch_usage.get('input_tokens', 0):,} input ({batch_usage.get('cached_input_tokens', 0):,} cached), {batch_usage.get('output_tokens', 0):,} output"
+    )
+    for name, model_usage in batch_usage.get("by_model", {}).items():
+        print(
+            f"   {name}: {model_usage['requests']:,} requests, ${model_usage['cost']:.4f}"
+        )
+    print(f"💰 Estimated cost: ${batch_usage.get('cost', 0):.4f}")
+    usage_summary_path = os.path.join(pdf_directory, "batch_usage_summary.json")
+    with open(usage_summary_path, "w") as f:
+        json.dump(batch_usage, f, indent=2)
+    print(f"📄 Usage summary: {usage_summary_path}")
+
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,419 @@
+#!/usr/bin/env python3
+"""
+LLM-Aided OCR Benchmarks
+Side-by-side measurements of processing options on the bundled sample
+"""
+
+import os
+import sys
+import time
+import asyncio
+import difflib
+import heapq
+import random
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import llm_aided_ocr as ocr
+
+SAMPLE_RAW_OCR_FILE = "160301289-Warren-Buffett-Katharine-Graham-Letter__raw_ocr_output.txt"
+
+
+def get_script_directory():
+    """Get the directory where this script is located"""
+    return os.path.dirname(os.path.abspath(__file__))
+
+
+def load_sample_text(path=None):
+    """Load the raw OCR output of the bundled Buffett letter"""
+    path = path or os.path.join(get_script_directory(), SAMPLE_RAW_OCR_FILE)
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read()
+
+
+class CompletionRecorder:
+    """Wraps generate_completion/process_chunk to count calls, tokens and latency"""
+
+    def __init__(self):
+        self.calls = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.chunk_latencies = []
+        self._original_generate_completion = ocr.generate_completion
+        self._original_process_chunk = ocr.process_chunk
+
+    async def _generate_completion(self, prompt, *args, **kwargs):
+        self.calls += 1
+        self.input_tokens += ocr.approximate_tokens(prompt)
+        output = await self._original_generate_completion(prompt, *args, **kwargs)
+        if output:
+            self.output_tokens += ocr.approximate_tokens(output)
+        return output
+
+    async def _process_chunk(self, *args, **kwargs):
+        start = time.perf_counter()
+        result = await self._original_process_chunk(*args, **kwargs)
+        self.chunk_latencies.append(time.perf_counter() - start)
+        return result
+
+    def __enter__(self):
+        ocr.generate_completion = self._generate_completion
+        ocr.process_chunk = self._process_chunk
+        return self
+
+    def __exit__(self, *exc):
+        ocr.generate_completion = self._original_generate_completion
+        ocr.process_chunk = self._original_process_chunk
+        return False
+
+
+async def benchmark_correction_modes(sample_path=None):
+    """Compare the correction modes on the sample document"""
+    raw_text = load_sample_text(sample_path)
+    print(f"📄 Sample: {len(raw_text):,} characters")
+    print(f"🤖 Provider: {'LOCAL' if ocr.USE_LOCAL_LLM else ocr.API_PROVIDER}")
+
+    results = {}
+    for mode in ["TWO_PASS", "SINGLE_PASS", "EDIT_LIST"]:
+        print(f"\n⏱️  Running {mode}...")
+        with CompletionRecorder() as recorder:
+            start = time.perf_counter()
+            output = await ocr.process_document(
+                [raw_text],
+                reformat_as_markdown=True,
+                suppress_headers_and_page_numbers=True,
+                correction_mode=mode,
+            )
+            elapsed = time.perf_counter() - start
+        results[mode] = {
+            "output": output,
+            "elapsed": elapsed,
+            "calls": recorder.calls,
+            "input_tokens": recorder.input_tokens,
+            "output_tokens": recorder.output_tokens,
+            "mean_chunk_latency": statistics.mean(recorder.chunk_latencies)
+            if recorder.chunk_latencies
+            else 0.0,
+        }
+
+    print("\n📊 Results")
+    print(
+        f"{'Mode':<12} {'Wall (s)':>9} {'Chunk (s)':>10} {'Calls':>6} {'In tok':>8} {'Out tok':>8}"
+    )
+    for mode, r in results.items():
+        print(
+            f"{mode:<12} {r['elapsed']:>9.1f} {r['mean_chunk_latency']:>10.1f} "
+            f"{r['calls']:>6} {r['input_tokens']:>8,} {r['output_tokens']:>8,}"
+        )
+
+    for mode in ["SINGLE_PASS", "EDIT_LIST"]:
+        similarity = difflib.SequenceMatcher(
+            None, results["TWO_PASS"]["output"], results[mode]["output"]
+        ).ratio()
+        print(f"\n🔍 Output similarity (TWO_PASS vs {mode}): {similarity:.3f}")
+    return results
+
+
+def split_sample_into_chunks(text, chunk_chars=1000, max_chunks=8):
+    """Paragraph-aligned chunks small enough to fit the local context window"""
+    chunks, current = [], ""
+    for paragraph in text.split("\n\n"):
+        if current and len(current) + len(paragraph) > chunk_chars:
+            chunks.append(current)
+            current = ""
+        current = f"{current}\n\n{paragraph}" if current else paragraph
+    if current:
+        chunks.append(current)
+    return chunks[:max_chunks]
+
+
+def benchmark_prefix_state_reuse(sample_path=None):
+    """Measure prompt-eval time per chunk with and without restoring the cached prefix state"""
+    chunks = split_sample_into_chunks(load_sample_text(sample_path))
+    llm = ocr.get_local_model(ocr.DEFAULT_LOCAL_MODEL_NAME)
+    prompt_prefix = f"{ocr.OCR_CORRECTION_SYSTEM_PROMPT}\n\n"
+    prefix_tokens = len(llm.tokenize(prompt_prefix.encode("utf-8")))
+    print(f"🤖 Model: {ocr.DEFAULT_LOCAL_MODEL_NAME}")
+    print(f"📏 Prefix: {prefix_tokens:,} tokens, {len(chunks)} chunks")
+
+    def prompt_eval_time(chunk, reuse):
+        # max_tokens=1 makes the call time almost entirely prompt evaluation
+        if reuse:
+            ocr.restore_prefix_state(llm, ocr.DEFAULT_LOCAL_MODEL_NAME, prompt_prefix)
+        else:
+            llm.reset()
+        start = time.perf_counter()
+        llm(
+            prompt=f"{prompt_prefix}Current chunk to process:\n{chunk}\n\nCorrected text:\n",
+            max_tokens=1,
+            temperature=0.0,
+        )
+        return time.perf_counter() - start
+
+    # Warm up once so the snapshot exists before timing
+    ocr.restore_prefix_state(llm, ocr.DEFAULT_LOCAL_MODEL_NAME, prompt_prefix)
+    cold = [prompt_eval_time(chunk, reuse=False) for chunk in chunks]
+    warm = [prompt_eval_time(chunk, reuse=True) for chunk in chunks]
+
+    print("\n📊 Results")
+    print(f"{'Chunk':>5} {'Full eval (s)':>14} {'Prefix reused (s)':>18} {'Saved (s)':>10}")
+    for i, (c, w) in enumerate(zip(cold, warm), 1):
+        print(f"{i:>5} {c:>14.2f} {w:>18.2f} {c - w:>10.2f}")
+    print(
+        f"\n⏱️  Mean prompt-eval time saved per chunk: {statistics.mean(cold) - statistics.mean(warm):.2f}s "
+        f"({1 - statistics.mean(warm) / statistics.mean(cold):.1%})"
+    )
+
+
+def benchmark_speculative_decoding(sample_path=None):
+    """Compare plain, prompt-lookup and draft-model decoding on OCR correction"""
+    chunks = split_sample_into_chunks(load_sample_text(sample_path), max_chunks=4)
+    modes = ["STANDARD", "PROMPT_LOOKUP"]
+    if ocr.LOCAL_LLM_DRAFT_MODEL_NAME:
+        modes.append("DRAFT_MODEL")
+    prompt_prefix = f"{ocr.OCR_CORRECTION_SYSTEM_PROMPT}\n\n"
+    print(f"🤖 Model: {ocr.DEFAULT_LOCAL_MODEL_NAME}, {len(chunks)} chunks")
+
+    results = {}
+    for mode in modes:
+        print(f"\n⏱️  Running {mode}...")
+        llm = ocr.load_model(ocr.DEFAULT_LOCAL_MODEL_NAME, decoding_mode=mode)
+        generated_tokens, elapsed = 0, 0.0
+        for chunk in chunks:
+            start = time.perf_counter()
+            output = llm(
+                prompt=f"{prompt_prefix}Current chunk to process:\n{chunk}\n\nCorrected text:\n",
+                max_tokens=len(chunk) // 3,
+                temperature=0.0,
+            )
+            chunk_elapsed = time.perf_counter() - start
+            generated_tokens += output["usage"]["completion_tokens"]
+            elapsed += chunk_elapsed
+            if isinstance(llm.draft_model, ocr.CountingDraftModel):
+                llm.draft_model.generated_tokens += output["usage"]["completion_tokens"]
+                llm.draft_model.generation_time += chunk_elapsed
+        results[mode] = {
+            "tokens_per_second": generated_tokens / elapsed if elapsed else 0.0,
+            "acceptance_rate": llm.draft_model.get_stats()["acceptance_rate"]
+            if isinstance(llm.draft_model, ocr.CountingDraftModel)
+            else None,
+        }
+        del llm
+
+    print("\n📊 Results")
+    print(f"{'Mode':<14} {'Tokens/s':>9} {'Accepted':>9} {'Speedup':>8}")
+    baseline = results["STANDARD"]["tokens_per_second"] or 1.0
+    for mode, r in results.items():
+        acceptance = (
+            f"{r['acceptance_rate']:.1%}" if r["acceptance_rate"] is not None else "-"
+        )
+        print(
+            f"{mode:<14} {r['tokens_per_second']:>9.1f} {acceptance:>9} "
+            f"{r['tokens_per_second'] / baseline:>7.2f}x"
+        )
+    return results
+
+
+def simulate_makespan(order, latencies, workers):
+    """Wall-clock time for running chunks in the given order on a fixed number of workers"""
+    free_at = [0.0] * workers
+    for index in order:
+        start = heapq.heappop(free_at)
+        heapq.heappush(free_at, start + latencies[index])
+    return max(free_at)
+
+
+def synthetic_chunk_sizes(distribution, count, rng):
+    """Chunk sizes in characters for a few document shapes"""
+    if distribution == "uniform":
+        # The chunker fills chunks to ~8000 characters; the last one is short
+        return [rng.randint(7000, 8000) for _ in range(count - 1)] + [1500]
+    if distribution == "lognormal":
+        return [min(int(rng.lognormvariate(8.3, 0.6)), 16000) for _ in range(count)]
+    # bimodal: mostly short chunks with a few oversized ones (tables, unsplittable paragraphs)
+    return [
+        rng.randint(12000, 16000) if rng.random() < 0.1 else rng.randint(1000, 4000)
+        for _ in range(count)
+    ]
+
+
+def benchmark_scheduling(seed=0, chunk_count=60, trials=10):
+    """Simulated makespan of FIFO vs longest-first dispatch under bounded concurrency"""
+    rng = random.Random(seed)
+    print(f"🎲 {chunk_count} chunks, {trials} trials per row, latency = estimated cost x lognormal noise")
+    print(f"\n{'Sizes':<10} {'Workers':>7} {'FIFO (s)':>9} {'LPT (s)':>8} {'Bound (s)':>9} {'Saved':>7}")
+    results = {}
+    for distribution in ["uniform", "lognormal", "bimodal"]:
+        for workers in [4, 8, 16]:
+            fifo, lpt, bound = [], [], []
+            for _ in range(trials):
+                sizes = synthetic_chunk_sizes(distribution, chunk_count, rng)
+                rng.shuffle(sizes)
+                costs = [
+                    ocr.estimate_chunk_cost(size / ocr.CHARACTERS_PER_TOKEN, "TWO_PASS", True)
+                    for size in sizes
+                ]
+                # ~50 generated tokens per second, with noise the estimate can't see
+                latencies = [cost / 50 * rng.lognormvariate(0, 0.25) for cost in costs]
+                fifo.append(simulate_makespan(range(chunk_count), latencies, workers))
+                lpt.append(
+                    simulate_makespan(ocr.get_longest_first_order(costs), latencies, workers)
+                )
+                bound.append(max(sum(latencies) / workers, max(latencies)))
+            row = {
+                "fifo": statistics.mean(fifo),
+                "lpt": statistics.mean(lpt),
+                "bound": statistics.mean(bound),
+            }
+            results[(distribution, workers)] = row
+            print(
+                f"{distribution:<10} {workers:>7} {row['fifo']:>9.1f} {row['lpt']:>8.1f} "
+                f"{row['bound']:>9.1f} {1 - row['lpt'] / row['fifo']:>7.1%}"
+            )
+    print("\n📏 Bound: max(total work / workers, longest chunk), no schedule can beat it")
+    return results
+
+
+async def measure_replica_throughput(replicas, chunks, max_tokens):
+    """Chunks per minute for one replica count, after a warm-up request per replica"""
+    if replicas > 1:
+        pool = ocr.LocalReplicaPool(replicas)
+    else:
+        pool = ocr.LocalInferenceWorker()
+    args = (ocr.DEFAULT_LOCAL_MODEL_NAME, "Warm-up", 1, 0.0, None, None)
+    # Loading the model in every replica shouldn't count against throughput
+    await asyncio.gather(
+        *[pool.submit(ocr.run_local_completion, *args) for _ in range(replicas)]
+    )
+    start = time.perf_counter()
+    await asyncio.gather(
+        *[
+            pool.submit(
+                ocr.run_local_completion,
+                ocr.DEFAULT_LOCAL_MODEL_NAME,
+                f"Current chunk to process:\n{chunk}\n\nCorrected text:\n",
+                max_tokens,
+                0.0,
+                None,
+                ocr.OCR_CORRECTION_SYSTEM_PROMPT,
+            )
+            for chunk in chunks
+        ]
+    )
+    elapsed = time.perf_counter() - start
+    if replicas > 1:
+        pool.close()
+    return len(chunks) / elapsed * 60
+
+
+def benchmark_replicas(sample_path=None, max_tokens=128):
+    """Local chunks/minute for 1, 2, 4, ... CPU replicas splitting the available cores"""
+    cpu_count = len(ocr.get_replica_cpu_sets(1)[0])
+    replica_counts = [n for n in [1, 2, 4, 8, 16, 32] if n <= cpu_count]
+    chunks = split_sample_into_chunks(
+        load_sample_text(sample_path), max_chunks=max(replica_counts) * 2
+    )
+    print(f"🤖 Model: {ocr.DEFAULT_LOCAL_MODEL_NAME}, {cpu_count} CPUs, {len(chunks)} chunks")
+    print(f"\n{'Replicas':>8} {'Threads each':>13} {'Chunks/min':>11} {'Speedup':>8}")
+    results = {}
+    for replicas in replica_counts:
+        results[replicas] = asyncio.run(
+            measure_replica_throughput(replicas, chunks, max_tokens)
+        )
+        print(
+            f"{replicas:>8} {cpu_count // replicas:>13} {results[replicas]:>11.1f} "
+            f"{results[replicas] / results[1]:>7.2f}x"
+        )
+    best = max(results, key=results.get)
+    print(f"\n🏁 Best: LOCAL_LLM_REPLICAS={best}")
+    return results
+
+
+def benchmark_token_estimation(sample_path=None, chunk_size=2000, repeats=20):
+    """Calibrated fast token estimates vs the real tokenizers on the sample's chunks"""
+    text = load_sample_text(sample_path)
+    chunks = [text[i : i + chunk_size] for i in range(0, len(text), chunk_size)]
+    print(f"📏 {len(chunks)} chunks of up to {chunk_size:,} characters")
+    print(
+        f"\n{'Family':<10} {'Exact/s':>9} {'Fast/s':>10} {'Speedup':>8} "
+        f"{'Mean err':>9} {'Max err':>8} {'Bound':>7} {'Upper >= exact':>15}"
+    )
+    for family, model_name in ocr.TOKENIZER_FAMILY_MODELS.items():
+        try:
+            tokenizer = ocr.get_tokenizer(model_name)
+        except Exception as e:
+            print(f"{family:<10} skipped: {e}")
+            continue
+        estimator = ocr.get_token_estimator(model_name)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            exact = [len(tokenizer.encode(chunk)) for chunk in chunks]
+        exact_rate = repeats * len(chunks) / (time.perf_counter() - start)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            estimates = estimator.estimate(chunks)
+        fast_rate = repeats * len(chunks) / (time.perf_counter() - start)
+        errors = [abs(e - x) / x for e, x in zip(estimates, exact)]
+        safe = all(
+            e >= x for e, x in zip(estimator.estimate(chunks, upper_bound=True), exact)
+        )
+        print(
+            f"{family:<10} {exact_rate:>9,.0f} {fast_rate:>10,.0f} {fast_rate / exact_rate:>7.1f}x "
+            f"{statistics.mean(errors):>9.1%} {max(errors):>8.1%} {estimator.error_bound:>7.1%} "
+            f"{'yes' if safe else 'NO':>15}"
+        )
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("🔧 LLM-Aided OCR Benchmarks")
+        print("\nUsage:")
+        print(
+            "  python benchmark.py modes [raw_ocr.txt]     # Compare correction modes"
+        )
+        print(
+            "  python benchmark.py kv-cache [raw_ocr.txt]  # Local prompt-eval time with prefix state reuse"
+        )
+        print(
+            "  python benchmark.py speculative [raw_ocr.txt] # Local decoding modes: tokens/sec and acceptance"
+        )
+        print(
+            "  python benchmark.py scheduling              # Simulated makespan: FIFO vs longest-first"
+        )
+        print(
+            "  python benchmark.py replicas [raw_ocr.txt]  # Local chunks/minute vs CPU replica count"
+        )
+        print(
+            "  python benchmark.py tokens [raw_ocr.txt]    # Fast token estimator: estimates/sec and error"
+        )
+        print("\nExamples:")
+        print("  python benchmark.py modes")
+        return
+
+    os.chdir(get_script_directory())
+    command = sys.argv[1].lower()
+
+    if command == "modes":
+        sample_path = sys.argv[2] if len(sys.argv) > 2 else None
+        asyncio.run(benchmark_correction_modes(sample_path))
+    elif command == "kv-cache":
+        sample_path = sys.argv[2] if len(sys.argv) > 2 else None
+        benchmark_prefix_state_reuse(sample_path)
+    elif command == "speculative":
+        sample_path = sys.argv[2] if len(sys.argv) > 2 else None
+        benchmark_speculative_decoding(sample_path)
+    elif command == "scheduling":
+        benchmark_scheduling()
+    elif command == "replicas":
+        sample_path = sys.argv[2] if len(sys.argv) > 2 else None
+        benchmark_replicas(sample_path)
+    elif command == "tokens":
+        sample_path = sys.argv[2] if len(sys.argv) > 2 else None
+        benchmark_token_estimation(sample_path)
+    else:
+        print("❌ Unknown command. Use 'python benchmark.py' for help")
+
+
+if __name__ == "__main__":
+    main()
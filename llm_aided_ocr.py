@@ -6,12 +6,23 @@ import json
 import re
 import urllib.request
 import logging
+import math
+import difflib
+import time
+import bisect
+import statistics
+import contextlib
+import contextvars
+import threading
+import multiprocessing
+from collections import deque
 from concurrent.futures import ThreadPoolExecutor
 import warnings
-from typing import List, Dict, Tuple, Optional
+from typing import Callable, List, Dict, Tuple, Optional
 from pdf2image import convert_from_path
 import pytesseract
 from llama_cpp import Llama, LlamaGrammar
+from llama_cpp.llama_speculative import LlamaDraftModel, LlamaPromptLookupDecoding
 import tiktoken
 import numpy as np
 from PIL import Image
@@ -29,6 +40,14 @@ try:
 except ImportError:
     GPU_AVAILABLE = False
 
+try:
+    from langdetect import DetectorFactory, detect as detect_language
+
+    DetectorFactory.seed = 0
+    LANGDETECT_AVAILABLE = True
+except ImportError:
+    LANGDETECT_AVAILABLE = False
+
 # Configuration
 config = DecoupleConfig(RepositoryEnv(".env"))
 
@@ -46,10 +65,44 @@ LM_STUDIO_BASE_URL = config.get(
 LM_STUDIO_MODEL = config.get(
     "LM_STUDIO_MODEL", default="", cast=str
 )  # Leave empty to use LM Studio's default
+LM_STUDIO_BACKENDS = config.get(
+    "LM_STUDIO_BACKENDS", default="", cast=str
+)  # e.g. "http://box1:1234;weight=2;max_concurrency=8,http://box2:1234"; defaults to LM_STUDIO_BASE_URL
+LM_STUDIO_BACKEND_MAX_FAILURES = config.get(
+    "LM_STUDIO_BACKEND_MAX_FAILURES", default=3, cast=int
+)  # Consecutive failures before a backend is ejected
+LM_STUDIO_BACKEND_COOLDOWN_SECONDS = config.get(
+    "LM_STUDIO_BACKEND_COOLDOWN_SECONDS", default=30.0, cast=float
+)
+ADAPTIVE_CONCURRENCY = config.get(
+    "ADAPTIVE_CONCURRENCY", default=True, cast=bool
+)  # AIMD-tune in-flight requests per LM Studio backend; False keeps the fixed maximum
+ADAPTIVE_API_CONCURRENCY = config.get(
+    "ADAPTIVE_API_CONCURRENCY", default=False, cast=bool
+)  # Same for hosted APIs, whose latency rarely depends on our own load
+API_MAX_CONCURRENCY = config.get(
+    "API_MAX_CONCURRENCY", default=32, cast=int
+)  # Upper bound on in-flight requests per API provider
+AIMD_LATENCY_TOLERANCE = config.get(
+    "AIMD_LATENCY_TOLERANCE", default=2.0, cast=float
+)  # Back off when a request takes this many times the baseline latency
+HEDGE_REQUESTS = config.get("HEDGE_REQUESTS", default=False, cast=bool)
+HEDGE_LATENCY_PERCENTILE = config.get(
+    "HEDGE_LATENCY_PERCENTILE", default=95.0, cast=float
+)  # Send a duplicate request once the first has run longer than this percentile
+HEDGE_MAX_EXTRA_FRACTION = config.get(
+    "HEDGE_MAX_EXTRA_FRACTION", default=0.05, cast=float
+)  # Budget: hedges may add at most this fraction of extra requests
+HEDGE_API_PROVIDER = config.get(
+    "HEDGE_API_PROVIDER", default="", cast=str
+).upper()  # Where hedges go; defaults to the same provider (another backend for LM Studio pools)
+HEDGE_MIN_SAMPLES = 20  # Latencies needed before hedging starts
+MAX_CONCURRENT_CHUNKS = config.get(
+    "MAX_CONCURRENT_CHUNKS", default=0, cast=int
+)  # Chunks processed at once with API providers; 0 dispatches all of them
 CLAUDE_MODEL_STRING = config.get(
     "CLAUDE_MODEL_STRING", default="claude-3-haiku-20240307", cast=str
 )
-CLAUDE_MAX_TOKENS = 4096  # Maximum allowed tokens for Claude API
 TOKEN_BUFFER = 500  # Buffer to account for token estimation inaccuracies
 TOKEN_CUSHION = 300  # Don't use the full max tokens to avoid hitting the limit
 OPENAI_COMPLETION_MODEL = config.get(
@@ -58,18 +111,91 @@ OPENAI_COMPLETION_MODEL = config.get(
 OPENAI_EMBEDDING_MODEL = config.get(
     "OPENAI_EMBEDDING_MODEL", default="text-embedding-3-small", cast=str
 )
-OPENAI_MAX_TOKENS = 12000  # Maximum allowed tokens for OpenAI API
+MODEL_CAPABILITIES_FILE = config.get(
+    "MODEL_CAPABILITIES_FILE", default="model_capabilities.json", cast=str
+)  # Optional JSON adding or overriding context windows, output limits and prices
 DEFAULT_LOCAL_MODEL_NAME = "Llama-3.1-8B-Lexi-Uncensored_Q5_fixedrope.gguf"
-LOCAL_LLM_CONTEXT_SIZE_IN_TOKENS = 2048
+LOCAL_LLM_CONTEXT_SIZE_IN_TOKENS = config.get(
+    "LOCAL_LLM_CONTEXT_SIZE_IN_TOKENS", default=0, cast=int
+)  # 0 sizes the context from the GGUF metadata and available memory
+LOCAL_LLM_MAX_CONTEXT_SIZE_IN_TOKENS = config.get(
+    "LOCAL_LLM_MAX_CONTEXT_SIZE_IN_TOKENS", default=16384, cast=int
+)  # Upper bound for the automatic context size
+LOCAL_LLM_MIN_CONTEXT_SIZE_IN_TOKENS = 2048
+LOCAL_LLM_MEMORY_FRACTION = config.get(
+    "LOCAL_LLM_MEMORY_FRACTION", default=0.75, cast=float
+)  # Share of RAM (or VRAM) the weights and KV caches may use
+LOCAL_LLM_N_BATCH = config.get(
+    "LOCAL_LLM_N_BATCH", default=0, cast=int
+)  # 0 picks 512 on CPU and 2048 with a GPU
+LOCAL_LLM_STARTUP_BENCHMARK = config.get(
+    "LOCAL_LLM_STARTUP_BENCHMARK", default=True, cast=bool
+)  # Measure prompt-eval and generation speed when a model is loaded
+DEFAULT_CHUNK_SIZE_IN_CHARACTERS = 8000
+CHARACTERS_PER_TOKEN = 3.5  # Conservative for noisy OCR text
 USE_VERBOSE = False
+LOCAL_LLM_REUSE_PREFIX_STATE = config.get(
+    "LOCAL_LLM_REUSE_PREFIX_STATE", default=True, cast=bool
+)
+LOCAL_LLM_DECODING_MODE = config.get(
+    "LOCAL_LLM_DECODING_MODE", default="STANDARD", cast=str
+).upper()  # STANDARD, PROMPT_LOOKUP, or DRAFT_MODEL
+LOCAL_LLM_DRAFT_NUM_PRED_TOKENS = config.get(
+    "LOCAL_LLM_DRAFT_NUM_PRED_TOKENS", default=10, cast=int
+)
+LOCAL_LLM_DRAFT_MODEL_NAME = config.get(
+    "LOCAL_LLM_DRAFT_MODEL_NAME", default="", cast=str
+)  # Small GGUF in ./models sharing the main model's vocabulary
+LOCAL_LLM_REPLICAS = config.get(
+    "LOCAL_LLM_REPLICAS", default=1, cast=int
+)  # >1 runs that many CPU model processes, each pinned to its own cores
+LOCAL_LLM_THREADS_PER_REPLICA = config.get(
+    "LOCAL_LLM_THREADS_PER_REPLICA", default=0, cast=int
+)  # 0 splits the available cores evenly between replicas
+LOCAL_LLM_N_THREADS = None  # Set inside replica processes to their share of cores
 DEFAULT_OCR_LANGUAGES = config.get(
     "DEFAULT_OCR_LANGUAGES", default="eng+rus+deu", cast=str
 )
+STRIP_HEADERS_AND_FOOTERS = config.get(
+    "STRIP_HEADERS_AND_FOOTERS", default=True, cast=bool
+)
+NORMALIZE_OCR_TEXT = config.get("NORMALIZE_OCR_TEXT", default=True, cast=bool)
+DICTIONARY_DIR = config.get(
+    "DICTIONARY_DIR", default="dictionaries", cast=str
+)  # Holds <lang>.txt wordlists, one "word" or "word count" per line
+SYSTEM_WORDLIST_PATH = "/usr/share/dict/words"
+LOCAL_SPELL_CORRECTION = config.get(
+    "LOCAL_SPELL_CORRECTION", default=False, cast=bool
+)
+LOCAL_SPELL_MAX_EDIT_DISTANCE = config.get(
+    "LOCAL_SPELL_MAX_EDIT_DISTANCE", default=2, cast=int
+)
+LOCAL_SPELL_SKIP_LLM_ERROR_RATE = config.get(
+    "LOCAL_SPELL_SKIP_LLM_ERROR_RATE", default=0.01, cast=float
+)  # Skip the LLM correction pass for chunks with fewer unknown words than this
+LOCAL_SPELL_DOCUMENT_MIN_COUNT = config.get(
+    "LOCAL_SPELL_DOCUMENT_MIN_COUNT", default=3, cast=int
+)  # Words occurring this often in the document are taken as correctly spelled
+USE_LLM_QUALITY_JUDGE = config.get(
+    "USE_LLM_QUALITY_JUDGE", default=False, cast=bool
+)  # Ask the LLM to assess chunks the local quality report flags as suspicious
+QUALITY_HALLUCINATION_THRESHOLD = config.get(
+    "QUALITY_HALLUCINATION_THRESHOLD", default=0.15, cast=float
+)  # Fraction of output words absent from the input that flags a chunk
+CHUNK_MAX_RETRIES = config.get("CHUNK_MAX_RETRIES", default=2, cast=int)
+FALLBACK_API_PROVIDER = config.get(
+    "FALLBACK_API_PROVIDER", default="", cast=str
+).upper()  # Optional provider for chunk retries: OPENAI, CLAUDE, LM_STUDIO, or LOCAL
+MODEL_CASCADE = config.get(
+    "MODEL_CASCADE", default="", cast=str
+)  # e.g. "LM_STUDIO:qwen2.5-7b-instruct,OPENAI:gpt-4o"; cheapest tier first
+CHUNK_MIN_LENGTH_RATIO = 0.5  # Output shorter than this fraction of the input is truncated
+CHUNK_MAX_LENGTH_RATIO = 1.8  # Output longer than this multiple of the input is runaway
+CORRECTION_MODE = config.get(
+    "CORRECTION_MODE", default="TWO_PASS", cast=str
+).upper()  # TWO_PASS, SINGLE_PASS, or EDIT_LIST
 
 openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY)
-lm_studio_client = AsyncOpenAI(
-    api_key="not-needed", base_url=f"{LM_STUDIO_BASE_URL}/v1"
-)
 warnings.filterwarnings("ignore", category=FutureWarning)
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
@@ -162,26 +288,272 @@ async def download_models() -> Tuple[List[str], List[Dict[str, str]]]:
     return [model_name], download_status
 
 
+# Speculative Decoding
+class LlamaGGUFDraftModel(LlamaDraftModel):
+    """Drafts tokens greedily with a small GGUF model that shares the main model's vocabulary"""
+
+    def __init__(self, model_path: str, num_pred_tokens: int = 10, n_ctx: int = 2048):
+        self.num_pred_tokens = num_pred_tokens
+        self.llm = Llama(
+            model_path=model_path,
+            n_ctx=n_ctx,
+            verbose=USE_VERBOSE,
+            n_gpu_layers=-1,
+        )
+
+    def __call__(self, input_ids, /, **kwargs):
+        draft_tokens = []
+        # generate() reuses the longest matching prefix, so only new tokens are evaluated
+        for token in self.llm.generate(input_ids.tolist(), top_k=1, temp=0.0):
+            if token == self.llm.token_eos():
+                break
+            draft_tokens.append(token)
+            if len(draft_tokens) >= self.num_pred_tokens:
+                break
+        return np.array(draft_tokens, dtype=np.intc)
+
+
+class CountingDraftModel(LlamaDraftModel):
+    """Wraps a draft model and counts drafted tokens to estimate the acceptance rate"""
+
+    def __init__(self, draft_model: LlamaDraftModel):
+        self.draft_model = draft_model
+        self.draft_calls = 0
+        self.drafted_tokens = 0
+        self.generated_tokens = 0
+        self.generation_time = 0.0
+
+    def __call__(self, input_ids, /, **kwargs):
+        draft_tokens = self.draft_model(input_ids, **kwargs)
+        self.draft_calls += 1
+        self.drafted_tokens += len(draft_tokens)
+        return draft_tokens
+
+    def get_stats(self) -> Dict[str, float]:
+        # Each verification step yields the accepted draft tokens plus one sampled token
+        accepted_tokens = max(0, self.generated_tokens - self.draft_calls)
+        return {
+            "draft_calls": self.draft_calls,
+            "drafted_tokens": self.drafted_tokens,
+            "accepted_tokens": accepted_tokens,
+            "acceptance_rate": accepted_tokens / self.drafted_tokens
+            if self.drafted_tokens
+            else 0.0,
+            "tokens_per_second": self.generated_tokens / self.generation_time
+            if self.generation_time
+            else 0.0,
+        }
+
+
+def find_model_file(llm_model_name: str) -> str:
+    current_file_path = os.path.abspath(__file__)
+    base_dir = os.path.dirname(current_file_path)
+    models_dir = os.path.join(base_dir, "models")
+    matching_files = glob.glob(os.path.join(models_dir, f"{llm_model_name}*"))
+    if not matching_files:
+        logging.error(f"Error: No model file found matching: {llm_model_name}")
+        raise FileNotFoundError
+    return max(matching_files, key=os.path.getmtime)
+
+
+def create_draft_model(
+    decoding_mode: str, n_ctx: int = LOCAL_LLM_MIN_CONTEXT_SIZE_IN_TOKENS
+) -> Optional[CountingDraftModel]:
+    if decoding_mode == "PROMPT_LOOKUP":
+        # OCR correction mostly copies its input, so n-grams from the prompt make good drafts
+        logging.info(
+            f"Using prompt-lookup decoding ({LOCAL_LLM_DRAFT_NUM_PRED_TOKENS} draft tokens)"
+        )
+        return CountingDraftModel(
+            LlamaPromptLookupDecoding(num_pred_tokens=LOCAL_LLM_DRAFT_NUM_PRED_TOKENS)
+        )
+    elif decoding_mode == "DRAFT_MODEL":
+        if not LOCAL_LLM_DRAFT_MODEL_NAME:
+            raise ValueError(
+                "LOCAL_LLM_DECODING_MODE=DRAFT_MODEL requires LOCAL_LLM_DRAFT_MODEL_NAME"
+            )
+        draft_model_path = find_model_file(LOCAL_LLM_DRAFT_MODEL_NAME)
+        logging.info(f"Using draft model for speculative decoding: {draft_model_path}")
+        return CountingDraftModel(
+            LlamaGGUFDraftModel(
+                draft_model_path, LOCAL_LLM_DRAFT_NUM_PRED_TOKENS, n_ctx
+            )
+        )
+    elif decoding_mode != "STANDARD":
+        raise ValueError(f"Invalid LOCAL_LLM_DECODING_MODE: {decoding_mode}")
+    return None
+
+
+def get_speculative_decoding_stats() -> Dict[str, Dict[str, float]]:
+    """Acceptance rate and tokens/sec for every loaded model using a draft model"""
+    return {
+        name: llm.draft_model.get_stats()
+        for name, llm in loaded_local_models.items()
+        if isinstance(getattr(llm, "draft_model", None), CountingDraftModel)
+    }
+
+
+# Local Model Sizing
+local_inference_settings: Dict[str, Dict[str, int]] = {}
+
+
+def get_available_cpus() -> List[int]:
+    """CPUs this process may run on"""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def get_physical_core_count(cpu_ids: List[int]) -> int:
+    """Physical cores among cpu_ids; hyperthreads don't speed up memory-bound decoding"""
+    cores = set()
+    for cpu in cpu_ids:
+        try:
+            with open(
+                f"/sys/devices/system/cpu/cpu{cpu}/topology/thread_siblings_list"
+            ) as f:
+                cores.add(f.read().strip())
+        except OSError:
+            return len(cpu_ids)
+    return len(cores)
+
+
+def get_memory_bytes(gpu_found: bool) -> int:
+    """Total VRAM when the model is offloaded to GPUs, otherwise physical RAM"""
+    if gpu_found:
+        return is_gpu_available()["total_vram"] * 1024 * 1024
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def read_gguf_metadata(model_file_path: str) -> Dict[str, str]:
+    """GGUF key/value metadata, read by loading only the model's vocabulary"""
+    llm = Llama(model_path=model_file_path, vocab_only=True, verbose=USE_VERBOSE)
+    metadata = dict(llm.metadata)
+    del llm
+    return metadata
+
+
+def get_local_inference_settings(llm_model_name: str) -> Dict[str, int]:
+    """
+    n_ctx, n_batch and n_threads for a local model.
+
+    The context is the model's trained context length, capped by
+    LOCAL_LLM_MAX_CONTEXT_SIZE_IN_TOKENS and by how many tokens of f16 KV cache
+    fit next to the weights in LOCAL_LLM_MEMORY_FRACTION of RAM (or VRAM),
+    shared between replicas. Explicit settings override the automatic values.
+    """
+    if llm_model_name in local_inference_settings:
+        return local_inference_settings[llm_model_name]
+    model_file_path = find_model_file(llm_model_name)
+    metadata = read_gguf_metadata(model_file_path)
+    architecture = metadata.get("general.architecture", "llama")
+
+    def get_metadata_int(key: str, default: int) -> int:
+        return int(metadata.get(f"{architecture}.{key}", default))
+
+    trained_context = get_metadata_int(
+        "context_length", LOCAL_LLM_MIN_CONTEXT_SIZE_IN_TOKENS
+    )
+    layers = get_metadata_int("block_count", 32)
+    heads = get_metadata_int("attention.head_count", 32)
+    kv_heads = get_metadata_int("attention.head_count_kv", heads)
+    head_size = get_metadata_int("embedding_length", 4096) // heads
+    # Keys and values, 2 bytes each, for every layer and KV head
+    kv_bytes_per_token = 2 * layers * kv_heads * head_size * 2
+    gpu_found = GPU_AVAILABLE and is_gpu_available()["gpu_found"]
+    kv_budget = (
+        get_memory_bytes(gpu_found) * LOCAL_LLM_MEMORY_FRACTION
+        - os.path.getsize(model_file_path)
+    ) / max(1, LOCAL_LLM_REPLICAS)
+    affordable_context = max(0, int(kv_budget // kv_bytes_per_token))
+    if LOCAL_LLM_CONTEXT_SIZE_IN_TOKENS:
+        n_ctx = LOCAL_LLM_CONTEXT_SIZE_IN_TOKENS
+    else:
+        n_ctx = min(
+            trained_context, LOCAL_LLM_MAX_CONTEXT_SIZE_IN_TOKENS, affordable_context
+        )
+        n_ctx = max(LOCAL_LLM_MIN_CONTEXT_SIZE_IN_TOKENS, n_ctx // 256 * 256)
+        if affordable_context < LOCAL_LLM_MIN_CONTEXT_SIZE_IN_TOKENS:
+            logging.warning(
+                f"Only {affordable_context:,} tokens of KV cache fit in memory next to {llm_model_name}; "
+                f"using {n_ctx:,} anyway"
+            )
+    settings = {
+        "n_ctx": n_ctx,
+        "n_batch": LOCAL_LLM_N_BATCH or min(n_ctx, 2048 if gpu_found else 512),
+        "n_threads": LOCAL_LLM_N_THREADS
+        or get_physical_core_count(get_available_cpus()),
+        "trained_context": trained_context,
+        "affordable_context": affordable_context,
+        "kv_bytes_per_token": kv_bytes_per_token,
+        "gpu": gpu_found,
+    }
+    local_inference_settings[llm_model_name] = settings
+    return settings
+
+
+def measure_local_throughput(llm: Llama, generate_tokens: int = 32) -> Dict[str, float]:
+    """
+    Time one batch of prompt evaluation and a short greedy generation.
+
+    The prompt leaves room for the generated tokens in the context. Returns an
+    empty dict if the benchmark fails, which must never stop the model loading.
+    """
+    try:
+        sample = b"The committee reviewed the quarterly report and approved the budget. "
+        sample_tokens = llm.tokenize(sample, add_bos=False)
+        prompt_length = min(llm.n_batch, llm.n_ctx() - 2 * generate_tokens)
+        # One BOS token, then the sample repeated up to the prompt length
+        prompt_tokens = [llm.token_bos()] + (
+            sample_tokens * (prompt_length // len(sample_tokens) + 1)
+        )[: prompt_length - 1]
+        llm.reset()
+        start_time = time.perf_counter()
+        llm.eval(prompt_tokens)
+        prompt_seconds = time.perf_counter() - start_time
+        generated_tokens = 0
+        start_time = time.perf_counter()
+        # generate() reuses the evaluated prompt, so this mostly times decoding
+        for _ in llm.generate(prompt_tokens, top_k=1, temp=0.0):
+            generated_tokens += 1
+            if generated_tokens >= generate_tokens:
+                break
+        generation_seconds = time.perf_counter() - start_time
+        return {
+            "prompt_tokens_per_second": len(prompt_tokens) / prompt_seconds,
+            "generation_tokens_per_second": generated_tokens / generation_seconds,
+        }
+    except Exception as e:
+        logging.warning(f"Local throughput benchmark failed: {e}")
+        return {}
+    finally:
+        llm.reset()
+
+
 # Model Loading
-def load_model(llm_model_name: str, raise_exception: bool = True):
+def load_model(
+    llm_model_name: str,
+    raise_exception: bool = True,
+    decoding_mode: Optional[str] = None,
+):
     global USE_VERBOSE
     try:
-        current_file_path = os.path.abspath(__file__)
-        base_dir = os.path.dirname(current_file_path)
-        models_dir = os.path.join(base_dir, "models")
-        matching_files = glob.glob(os.path.join(models_dir, f"{llm_model_name}*"))
-        if not matching_files:
-            logging.error(f"Error: No model file found matching: {llm_model_name}")
-            raise FileNotFoundError
-        model_file_path = max(matching_files, key=os.path.getmtime)
+        model_file_path = find_model_file(llm_model_name)
         logging.info(f"Loading model: {model_file_path}")
+        settings = get_local_inference_settings(llm_model_name)
+        draft_model = create_draft_model(
+            decoding_mode or LOCAL_LLM_DECODING_MODE, settings["n_ctx"]
+        )
         try:
             logging.info("Attempting to load model with GPU acceleration...")
             model_instance = Llama(
                 model_path=model_file_path,
-                n_ctx=LOCAL_LLM_CONTEXT_SIZE_IN_TOKENS,
+                n_ctx=settings["n_ctx"],
+                n_batch=settings["n_batch"],
                 verbose=USE_VERBOSE,
                 n_gpu_layers=-1,
+                n_threads=settings["n_threads"],
+                draft_model=draft_model,
             )
             logging.info("Model loaded successfully with GPU acceleration.")
         except Exception as gpu_e:
@@ -190,9 +562,12 @@ def load_model(llm_model_name: str, raise_exception: bool = True):
             try:
                 model_instance = Llama(
                     model_path=model_file_path,
-                    n_ctx=LOCAL_LLM_CONTEXT_SIZE_IN_TOKENS,
+                    n_ctx=settings["n_ctx"],
+                    n_batch=settings["n_batch"],
                     verbose=USE_VERBOSE,
                     n_gpu_layers=0,
+                    n_threads=settings["n_threads"],
+                    draft_model=draft_model,
                 )
                 logging.info("Model loaded successfully with CPU.")
             except Exception as cpu_e:
@@ -200,6 +575,20 @@ def load_model(llm_model_name: str, raise_exception: bool = True):
                 if raise_exception:
                     raise
                 return None
+        report = (
+            f"Local model settings for {llm_model_name}: n_ctx={settings['n_ctx']:,} "
+            f"(trained {settings['trained_context']:,}, memory allows {settings['affordable_context']:,}), "
+            f"n_batch={settings['n_batch']}, n_threads={settings['n_threads']}, "
+            f"chunk size {get_chunk_size_in_characters('LOCAL', llm_model_name):,} characters"
+        )
+        if LOCAL_LLM_STARTUP_BENCHMARK:
+            throughput = measure_local_throughput(model_instance)
+            if throughput:
+                report += (
+                    f", prompt eval {throughput['prompt_tokens_per_second']:,.0f} tokens/s, "
+                    f"generation {throughput['generation_tokens_per_second']:,.1f} tokens/s"
+                )
+        logging.info(report)
         return model_instance
     except Exception as e:
         logging.error(f"Exception occurred while loading the model: {e}")
@@ -209,333 +598,2326 @@ def load_model(llm_model_name: str, raise_exception: bool = True):
         return None
 
 
-# API Interaction Functions
-async def generate_completion_from_lm_studio(
-    prompt: str, max_tokens: int = 5000
-) -> Optional[str]:
-    """Generate completion using LM Studio's OpenAI-compatible API"""
-    try:
-        messages = [{"role": "user", "content": prompt}]
-
-        # Use the specified model or let LM Studio choose the default
-        model = LM_STUDIO_MODEL if LM_STUDIO_MODEL else "default"
-
-        response = await lm_studio_client.chat.completions.create(
-            model=model, messages=messages, max_tokens=max_tokens, temperature=0.7
-        )
+# Metrics
+# Counters, gauges and histograms rendered in the Prometheus text format by
+# render_metrics(). An update is a dict lookup and an add under an uncontended
+# lock, so they stay on in production.
+metrics_registry: Dict[str, "Metric"] = {}
+metrics_collectors: List[Callable[[], None]] = []  # Refresh gauges just before rendering
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 40.0, 80.0, 160.0)
+EVENT_LOOP_LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
 
-        if response and response.choices and len(response.choices) > 0:
-            generated_text = response.choices[0].message.content
-            if generated_text:
-                logging.info(
-                    f"LM Studio completion successful. Generated {len(generated_text)} characters."
-                )
-                return generated_text
-            else:
-                logging.error("Empty response from LM Studio")
-                return None
-        else:
-            logging.error("Invalid response from LM Studio")
-            return None
 
-    except Exception as e:
-        logging.error(f"An error occurred while requesting from LM Studio: {e}")
-        if "404" in str(e):
-            logging.error(
-                "Model not found. Check LM_STUDIO_MODEL in .env or leave empty for default."
-            )
-        elif "Connection" in str(e):
-            logging.error(
-                f"Cannot connect to LM Studio at {LM_STUDIO_BASE_URL}. Make sure LM Studio is running."
-            )
-        return None
+def format_metric_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
 
 
-async def list_lm_studio_models():
-    """List available models in LM Studio"""
-    try:
-        response = await lm_studio_client.models.list()
-        if response and response.data:
-            models = [model.id for model in response.data]
-            logging.info(f"Available LM Studio models: {models}")
-            return models
-        else:
-            logging.warning("No models found in LM Studio")
-            return []
-    except Exception as e:
-        logging.error(f"Failed to list LM Studio models: {e}")
-        return []
+def format_metric_labels(names: Tuple[str, ...], values: Tuple[str, ...]) -> str:
+    if not names:
+        return ""
+    escaped = (
+        str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        for value in values
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
 
 
-async def generate_completion(prompt: str, max_tokens: int = 5000) -> Optional[str]:
-    if USE_LOCAL_LLM:
-        return await generate_completion_from_local_llm(
-            DEFAULT_LOCAL_MODEL_NAME, prompt, max_tokens
-        )
-    elif API_PROVIDER == "CLAUDE":
-        return await generate_completion_from_claude(prompt, max_tokens)
-    elif API_PROVIDER == "OPENAI":
-        return await generate_completion_from_openai(prompt, max_tokens)
-    elif API_PROVIDER == "LM_STUDIO":
-        return await generate_completion_from_lm_studio(prompt, max_tokens)
-    else:
-        logging.error(f"Invalid API_PROVIDER: {API_PROVIDER}")
-        return None
+class Metric:
+    """A named metric with one value per combination of label values"""
 
+    metric_type = "untyped"
 
-def get_tokenizer(model_name: str):
-    if model_name.lower().startswith("gpt-"):
-        return tiktoken.encoding_for_model(model_name)
-    elif model_name.lower().startswith("claude-"):
-        return AutoTokenizer.from_pretrained(
-            "EleutherAI/gpt-neox-20b", clean_up_tokenization_spaces=False
-        )
-    elif model_name.lower().startswith("llama-"):
-        return AutoTokenizer.from_pretrained(
-            "huggyllama/llama-7b", clean_up_tokenization_spaces=False
-        )
-    else:
-        raise ValueError(f"Unsupported model: {model_name}")
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values: Dict[Tuple[str, ...], float] = {} if labelnames else {(): 0.0}
+        self._lock = threading.Lock()
+        metrics_registry[name] = self
 
+    def get(self, labels: Tuple[str, ...] = ()) -> float:
+        return self._values.get(labels, 0.0)
 
-def estimate_tokens(text: str, model_name: str) -> int:
-    try:
-        tokenizer = get_tokenizer(model_name)
-        return len(tokenizer.encode(text))
-    except Exception as e:
-        logging.warning(
-            f"Error using tokenizer for {model_name}: {e}. Falling back to approximation."
-        )
-        return approximate_tokens(text)
-
-
-def approximate_tokens(text: str) -> int:
-    # Normalize whitespace
-    text = re.sub(r"\s+", " ", text.strip())
-    # Split on whitespace and punctuation, keeping punctuation
-    tokens = re.findall(r"\b\w+\b|\S", text)
-    count = 0
-    for token in tokens:
-        if token.isdigit():
-            count += max(
-                1, len(token) // 2
-            )  # Numbers often tokenize to multiple tokens
-        elif re.match(r"^[A-Z]{2,}$", token):  # Acronyms
-            count += len(token)
-        elif re.search(r"[^\w\s]", token):  # Punctuation and special characters
-            count += 1
-        elif len(token) > 10:  # Long words often split into multiple tokens
-            count += len(token) // 4 + 1
-        else:
-            count += 1
-    # Add a 10% buffer for potential underestimation
-    return int(count * 1.1)
+    def render(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [
+            f"{self.name}{format_metric_labels(self.labelnames, labels)} {format_metric_value(value)}"
+            for labels, value in values
+        ]
 
 
-def chunk_text(text: str, max_chunk_tokens: int, model_name: str) -> List[str]:
-    chunks = []
-    tokenizer = get_tokenizer(model_name)
-    sentences = re.split(r"(?<=[.!?])\s+", text)
-    current_chunk = []
-    current_chunk_tokens = 0
+class Counter(Metric):
+    metric_type = "counter"
 
-    for sentence in sentences:
-        sentence_tokens = len(tokenizer.encode(sentence))
-        if current_chunk_tokens + sentence_tokens > max_chunk_tokens:
-            chunks.append(" ".join(current_chunk))
-            current_chunk = [sentence]
-            current_chunk_tokens = sentence_tokens
-        else:
-            current_chunk.append(sentence)
-            current_chunk_tokens += sentence_tokens
+    def inc(self, amount: float = 1.0, labels: Tuple[str, ...] = ()):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
 
-    if current_chunk:
-        chunks.append(" ".join(current_chunk))
 
-    adjusted_chunks = adjust_overlaps(chunks, tokenizer, max_chunk_tokens)
-    return adjusted_chunks
+class Gauge(Metric):
+    metric_type = "gauge"
 
+    def set(self, value: float, labels: Tuple[str, ...] = ()):
+        self._values[labels] = value
 
-def split_long_sentence(sentence: str, max_tokens: int, model_name: str) -> List[str]:
-    words = sentence.split()
-    chunks = []
-    current_chunk = []
-    current_chunk_tokens = 0
-    tokenizer = get_tokenizer(model_name)
+    def inc(self, amount: float = 1.0, labels: Tuple[str, ...] = ()):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
 
-    for word in words:
-        word_tokens = len(tokenizer.encode(word))
-        if current_chunk_tokens + word_tokens > max_tokens and current_chunk:
-            chunks.append(" ".join(current_chunk))
-            current_chunk = [word]
-            current_chunk_tokens = word_tokens
-        else:
-            current_chunk.append(word)
-            current_chunk_tokens += word_tokens
+    def dec(self, amount: float = 1.0, labels: Tuple[str, ...] = ()):
+        self.inc(-amount, labels)
 
-    if current_chunk:
-        chunks.append(" ".join(current_chunk))
+    def replace(self, values: Dict[Tuple[str, ...], float]):
+        """Swap in a full set of label values, dropping ones that no longer exist"""
+        self._values = dict(values)
 
-    return chunks
 
+class Histogram(Metric):
+    """Observations counted into fixed buckets; rendered cumulatively as Prometheus expects"""
 
-def adjust_overlaps(
-    chunks: List[str], tokenizer, max_chunk_tokens: int, overlap_size: int = 50
-) -> List[str]:
-    adjusted_chunks = []
-    for i in range(len(chunks)):
-        if i == 0:
-            adjusted_chunks.append(chunks[i])
-        else:
-            overlap_tokens = len(
-                tokenizer.encode(" ".join(chunks[i - 1].split()[-overlap_size:]))
-            )
-            current_tokens = len(tokenizer.encode(chunks[i]))
-            if overlap_tokens + current_tokens > max_chunk_tokens:
-                overlap_adjusted = chunks[i].split()[:-overlap_size]
-                adjusted_chunks.append(" ".join(overlap_adjusted))
-            else:
-                adjusted_chunks.append(
-                    " ".join(chunks[i - 1].split()[-overlap_size:] + chunks[i].split())
-                )
+    metric_type = "histogram"
 
-    return adjusted_chunks
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[Tuple[str, ...], List[float]] = {}
+        if not labelnames:
+            self._series[()] = [0.0] * (len(self.buckets) + 2)
 
+    def observe(self, value: float, labels: Tuple[str, ...] = ()):
+        # Per series: one count per bucket plus +Inf, then the sum
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0.0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
 
-async def generate_completion_from_claude(
-    prompt: str, max_tokens: int = CLAUDE_MAX_TOKENS - TOKEN_BUFFER
-) -> Optional[str]:
-    if not ANTHROPIC_API_KEY:
-        logging.error(
-            "Anthropic API key not found. Please set the ANTHROPIC_API_KEY environment variable."
-        )
-        return None
-    client = AsyncAnthropic(api_key=ANTHROPIC_API_KEY)
-    prompt_tokens = estimate_tokens(prompt, CLAUDE_MODEL_STRING)
-    adjusted_max_tokens = min(
-        max_tokens, CLAUDE_MAX_TOKENS - prompt_tokens - TOKEN_BUFFER
-    )
-    if adjusted_max_tokens <= 0:
-        logging.warning("Prompt is too long for Claude API. Chunking the input.")
-        chunks = chunk_text(
-            prompt, CLAUDE_MAX_TOKENS - TOKEN_CUSHION, CLAUDE_MODEL_STRING
-        )
-        results = []
-        for chunk in chunks:
-            try:
-                async with client.messages.stream(
-                    model=CLAUDE_MODEL_STRING,
-                    max_tokens=CLAUDE_MAX_TOKENS // 2,
-                    temperature=0.7,
-                    messages=[{"role": "user", "content": chunk}],
-                ) as stream:
-                    message = await stream.get_final_message()
-                    results.append(message.content[0].text)
-                    logging.info(
-                        f"Chunk processed. Input tokens: {message.usage.input_tokens:,}, Output tokens: {message.usage.output_tokens:,}"
-                    )
-            except Exception as e:
-                logging.error(f"An error occurred while processing a chunk: {e}")
-        return " ".join(results)
-    else:
+    @contextlib.contextmanager
+    def time(self, labels: Tuple[str, ...] = ()):
+        start_time = time.perf_counter()
         try:
-            async with client.messages.stream(
-                model=CLAUDE_MODEL_STRING,
-                max_tokens=adjusted_max_tokens,
-                temperature=0.7,
-                messages=[{"role": "user", "content": prompt}],
-            ) as stream:
-                message = await stream.get_final_message()
-                output_text = message.content[0].text
-                logging.info(f"Total input tokens: {message.usage.input_tokens:,}")
-                logging.info(f"Total output tokens: {message.usage.output_tokens:,}")
-                logging.info(f"Generated output (abbreviated): {output_text[:150]}...")
-                return output_text
-        except Exception as e:
-            logging.error(f"An error occurred while requesting from Claude API: {e}")
-            return None
+            yield
+        finally:
+            self.observe(time.perf_counter() - start_time, labels)
 
+    def get_count(self, labels: Tuple[str, ...] = ()) -> float:
+        series = self._series.get(labels)
+        return sum(series[:-1]) if series else 0.0
 
-async def generate_completion_from_openai(
-    prompt: str, max_tokens: int = 5000
-) -> Optional[str]:
-    if not OPENAI_API_KEY:
-        logging.error(
-            "OpenAI API key not found. Please set the OPENAI_API_KEY environment variable."
-        )
-        return None
-    prompt_tokens = estimate_tokens(prompt, OPENAI_COMPLETION_MODEL)
-    adjusted_max_tokens = min(
-        max_tokens, 4096 - prompt_tokens - TOKEN_BUFFER
-    )  # 4096 is typical max for GPT-3.5 and GPT-4
-    if adjusted_max_tokens <= 0:
-        logging.warning("Prompt is too long for OpenAI API. Chunking the input.")
-        chunks = chunk_text(
-            prompt, OPENAI_MAX_TOKENS - TOKEN_CUSHION, OPENAI_COMPLETION_MODEL
-        )
-        results = []
-        for chunk in chunks:
-            try:
-                response = await openai_client.chat.completions.create(
-                    model=OPENAI_COMPLETION_MODEL,
-                    messages=[{"role": "user", "content": chunk}],
-                    max_tokens=adjusted_max_tokens,
-                    temperature=0.7,
-                )
-                result = response.choices[0].message.content
-                results.append(result)
-                logging.info(
-                    f"Chunk processed. Output tokens: {response.usage.completion_tokens:,}"
+    def render(self) -> List[str]:
+        with self._lock:
+            series_list = [(labels, list(series)) for labels, series in self._series.items()]
+        lines = []
+        names = self.labelnames + ("le",)
+        for labels, series in series_list:
+            cumulative = 0.0
+            for bound, count in zip(self.buckets + (math.inf,), series[:-1]):
+                cumulative += count
+                lines.append(
+                    f"{self.name}_bucket{format_metric_labels(names, labels + (format_metric_value(bound),))} "
+                    f"{format_metric_value(cumulative)}"
                 )
-            except Exception as e:
-                logging.error(f"An error occurred while processing a chunk: {e}")
-        return " ".join(results)
-    else:
+            label_text = format_metric_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_text} {format_metric_value(series[-1])}")
+            lines.append(f"{self.name}_count{label_text} {format_metric_value(cumulative)}")
+        return lines
+
+
+def render_metrics() -> str:
+    """Every registered metric in the Prometheus text exposition format (version 0.0.4)"""
+    for collector in metrics_collectors:
         try:
-            response = await openai_client.chat.completions.create(
-                model=OPENAI_COMPLETION_MODEL,
-                messages=[{"role": "user", "content": prompt}],
-                max_tokens=adjusted_max_tokens,
-                temperature=0.7,
-            )
-            output_text = response.choices[0].message.content
-            logging.info(f"Total tokens: {response.usage.total_tokens:,}")
-            logging.info(f"Generated output (abbreviated): {output_text[:150]}...")
-            return output_text
+            collector()
         except Exception as e:
-            logging.error(f"An error occurred while requesting from OpenAI API: {e}")
-            return None
+            logging.warning(f"Metrics collector {collector.__name__} failed: {e}")
+    lines = []
+    for metric in metrics_registry.values():
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.metric_type}")
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
 
 
-async def generate_completion_from_local_llm(
+ocr_pages_total = Counter("ocr_pages_total", "Pages run through Tesseract")
+ocr_page_seconds = Histogram(
+    "ocr_page_seconds",
+    "Preprocessing and Tesseract time per page",
+    buckets=(0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 16.0, 32.0),
+)
+pipeline_stage_seconds = Histogram(
+    "pipeline_stage_seconds",
+    "Wall time of each document pipeline stage",
+    ("stage",),
+    buckets=(0.1, 0.5, 1.0, 5.0, 15.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0),
+)
+documents_in_progress = Gauge(
+    "documents_in_progress", "Documents currently in the processing pipeline"
+)
+documents_total = Counter(
+    "documents_total", "Documents finished by the processing pipeline", ("status",)
+)
+chunk_failed_attempts_total = Counter(
+    "chunk_failed_attempts_total", "Chunk attempts that failed validation or the quality heuristic"
+)
+llm_requests_in_flight = Gauge(
+    "llm_requests_in_flight", "Completion requests waiting on a provider", ("provider",)
+)
+llm_requests_total = Counter(
+    "llm_requests_total", "Completion requests by outcome", ("provider", "status")
+)
+llm_request_seconds = Histogram(
+    "llm_request_seconds", "Completion request latency", ("provider",)
+)
+llm_tokens_total = Counter(
+    "llm_tokens_total", "Tokens reported by providers", ("provider", "type")
+)
+llm_cost_usd_total = Counter(
+    "llm_cost_usd_total", "Estimated completion cost in USD", ("provider",)
+)
+prompt_cache_hit_ratio = Gauge(
+    "prompt_cache_hit_ratio", "Share of input tokens served from the prompt cache", ("provider",)
+)
+local_prefix_cache_hit_ratio = Gauge(
+    "local_prefix_cache_hit_ratio", "Share of local prompts whose prefix KV state was reused"
+)
+local_inference_queue_depth = Gauge(
+    "local_inference_queue_depth", "Requests queued for the local model"
+)
+local_replica_restarts_total = Counter(
+    "local_replica_restarts_total", "Local model replica processes restarted after dying"
+)
+event_loop_lag_seconds = Histogram(
+    "event_loop_lag_seconds",
+    "How late the event loop woke up from a short sleep",
+    buckets=EVENT_LOOP_LAG_BUCKETS,
+)
+
+
+def collect_pipeline_metrics():
+    prompt_cache_hit_ratio.replace(
+        {
+            (provider,): stats["cached_input_tokens"] / stats["input_tokens"]
+            for provider, stats in prompt_cache_stats.items()
+            if stats["input_tokens"]
+        }
+    )
+    lookups = prefix_state_stats["hits"] + prefix_state_stats["misses"]
+    if lookups:
+        local_prefix_cache_hit_ratio.set(prefix_state_stats["hits"] / lookups)
+    local_inference_queue_depth.set(
+        sum(local_inference_worker.get_stats()["queued"].values())
+    )
+
+
+metrics_collectors.append(collect_pipeline_metrics)
+
+
+# Prompt Cache Tracking
+prompt_cache_stats: Dict[str, Dict[str, float]] = {}
+
+
+def record_prompt_cache_usage(
+    provider: str,
+    input_tokens: int,
+    cached_input_tokens: int = 0,
+    cache_creation_input_tokens: int = 0,
+    latency: float = 0.0,
+    time_to_first_token: Optional[float] = None,
+):
+    """Accumulate per-provider prompt cache counters from a completion's usage object"""
+    stats = prompt_cache_stats.setdefault(
+        provider,
+        {
+            "requests": 0,
+            "input_tokens": 0,
+            "cached_input_tokens": 0,
+            "cache_creation_input_tokens": 0,
+            "total_latency": 0.0,
+            "ttft_samples": 0,
+            "total_time_to_first_token": 0.0,
+        },
+    )
+    stats["requests"] += 1
+    stats["input_tokens"] += input_tokens or 0
+    stats["cached_input_tokens"] += cached_input_tokens or 0
+    stats["cache_creation_input_tokens"] += cache_creation_input_tokens or 0
+    stats["total_latency"] += latency
+    if time_to_first_token is not None:
+        stats["ttft_samples"] += 1
+        stats["total_time_to_first_token"] += time_to_first_token
+    if cached_input_tokens:
+        logging.info(
+            f"{provider} prompt cache hit: {cached_input_tokens:,}/{input_tokens:,} input tokens read from cache"
+        )
+
+
+def get_prompt_cache_stats() -> Dict[str, Dict[str, float]]:
+    """Return per-provider prompt cache statistics with derived hit ratios"""
+    summary = {}
+    for provider, stats in prompt_cache_stats.items():
+        summary[provider] = {
+            **stats,
+            "cache_hit_ratio": stats["cached_input_tokens"] / stats["input_tokens"]
+            if stats["input_tokens"]
+            else 0.0,
+            "mean_latency": stats["total_latency"] / stats["requests"]
+            if stats["requests"]
+            else 0.0,
+            "mean_time_to_first_token": stats["total_time_to_first_token"]
+            / stats["ttft_samples"]
+            if stats["ttft_samples"]
+            else None,
+        }
+    return summary
+
+
+def build_chat_messages(prompt: str, system_prompt: Optional[str] = None) -> List[Dict]:
+    """Put the static instructions first so OpenAI-compatible servers can reuse the prefix"""
+    messages = []
+    if system_prompt:
+        messages.append({"role": "system", "content": system_prompt})
+    messages.append({"role": "user", "content": prompt})
+    return messages
+
+
+def get_cached_prompt_tokens(usage) -> int:
+    """Read cached prompt tokens from an OpenAI-compatible usage object, if reported"""
+    details = getattr(usage, "prompt_tokens_details", None) if usage else None
+    return (getattr(details, "cached_tokens", 0) or 0) if details else 0
+
+
+# Usage Ledger
+# One entry per completion, grouped by job, so cost and latency can be traced
+# back to documents, chunks, providers and settings.
+usage_ledgers: Dict[str, List[Dict[str, object]]] = {}
+current_chunk_attempt: contextvars.ContextVar[Optional[Tuple[int, int]]] = (
+    contextvars.ContextVar("current_chunk_attempt", default=None)
+)  # (chunk index, attempt) while a chunk is being processed
+
+
+def get_completion_cost(
+    provider: str,
+    model: Optional[str],
+    input_tokens: int,
+    cached_input_tokens: int,
+    output_tokens: int,
+    cache_creation_input_tokens: int = 0,
+) -> float:
+    """USD cost of one completion from the model's registered prices"""
+    if provider == "LOCAL":
+        return 0.0
+    capabilities = get_model_capabilities(provider, model)
+    uncached_input_tokens = input_tokens - cached_input_tokens - cache_creation_input_tokens
+    return (
+        uncached_input_tokens * capabilities["input_price"]
+        + cached_input_tokens * capabilities["cached_input_price"]
+        + cache_creation_input_tokens * capabilities["cache_write_price"]
+        + output_tokens * capabilities["output_price"]
+    ) / 1_000_000
+
+
+def record_completion_usage(
+    provider: str,
+    model: Optional[str],
+    input_tokens: int,
+    output_tokens: int,
+    cached_input_tokens: int = 0,
+    cache_creation_input_tokens: int = 0,
+    latency: float = 0.0,
+    time_to_first_token: Optional[float] = None,
+    cancelled: bool = False,
+):
+    """Add a completion to the current job's ledger and the per-provider cache counters"""
+    if not cancelled:  # A cancelled request's tokens are estimated, so keep them out of the cache ratios
+        record_prompt_cache_usage(
+            provider,
+            input_tokens,
+            cached_input_tokens,
+            cache_creation_input_tokens,
+            latency,
+            time_to_first_token,
+        )
+    model = model or get_provider_model(provider)
+    input_tokens, output_tokens = input_tokens or 0, output_tokens or 0
+    cached_input_tokens = cached_input_tokens or 0
+    cache_creation_input_tokens = cache_creation_input_tokens or 0
+    cost = get_completion_cost(
+        provider,
+        model,
+        input_tokens,
+        cached_input_tokens,
+        output_tokens,
+        cache_creation_input_tokens,
+    )
+    chunk_attempt = current_chunk_attempt.get()
+    usage_ledgers.setdefault(current_job_id.get(), []).append(
+        {
+            "provider": provider,
+            "model": model,
+            "chunk_index": chunk_attempt[0] if chunk_attempt else None,
+            "attempt": chunk_attempt[1] if chunk_attempt else 0,
+            "input_tokens": input_tokens,
+            "cached_input_tokens": cached_input_tokens,
+            "output_tokens": output_tokens,
+            "latency": latency,
+            "cost": cost,
+            "cancelled": cancelled,
+        }
+    )
+    llm_tokens_total.inc(input_tokens - cached_input_tokens, (provider, "input"))
+    llm_tokens_total.inc(cached_input_tokens, (provider, "cached_input"))
+    llm_tokens_total.inc(output_tokens, (provider, "output"))
+    llm_cost_usd_total.inc(cost, (provider,))
+
+
+def add_usage(totals: Dict[str, float], entry: Dict[str, object]):
+    totals["requests"] = totals.get("requests", 0) + 1
+    for key in ["input_tokens", "cached_input_tokens", "output_tokens", "latency", "cost"]:
+        totals[key] = totals.get(key, 0) + entry[key]
+
+
+def summarize_usage(
+    entries: List[Dict[str, object]], include_chunks: bool = False
+) -> Dict[str, object]:
+    """Totals, per provider/model, and optionally per chunk, for ledger entries"""
+    summary = {"requests": 0, "retried_requests": 0, "cancelled_requests": 0, "by_model": {}}
+    for entry in entries:
+        add_usage(summary, entry)
+        if entry["attempt"]:
+            summary["retried_requests"] += 1
+        if entry["cancelled"]:
+            summary["cancelled_requests"] += 1
+        add_usage(
+            summary["by_model"].setdefault(
+                format_tier(entry["provider"], entry["model"]), {}
+            ),
+            entry,
+        )
+        if include_chunks and entry["chunk_index"] is not None:
+            chunk = summary.setdefault("by_chunk", {}).setdefault(
+                str(entry["chunk_index"]), {}
+            )
+            add_usage(chunk, entry)
+            chunk["attempts"] = max(chunk.get("attempts", 0), entry["attempt"] + 1)
+    if summary["requests"]:
+        summary["mean_latency"] = summary["latency"] / summary["requests"]
+    return summary
+
+
+def get_usage_summary(job_id: str, include_chunks: bool = False) -> Dict[str, object]:
+    return summarize_usage(usage_ledgers.get(job_id, []), include_chunks)
+
+
+def write_usage_report(job_id: str, path: str) -> Dict[str, object]:
+    """Write a job's summary and every ledger entry to path; returns the summary"""
+    entries = usage_ledgers.get(job_id, [])
+    summary = summarize_usage(entries, include_chunks=True)
+    with open(path, "w") as f:
+        json.dump({"summary": summary, "completions": entries}, f, indent=2)
+    logging.info(
+        f"Usage: {summary['requests']:,} completions, "
+        f"{summary.get('input_tokens', 0):,} input tokens "
+        f"({summary.get('cached_input_tokens', 0):,} cached), "
+        f"{summary.get('output_tokens', 0):,} output tokens, ${summary.get('cost', 0):.4f}"
+    )
+    return summary
+
+
+def discard_usage_ledger(job_id: str):
+    usage_ledgers.pop(job_id, None)
+
+
+# Local Model Cache
+loaded_local_models: Dict[str, Llama] = {}
+prefix_state_cache: Dict[Tuple[str, str], object] = {}
+prefix_state_stats = {"hits": 0, "misses": 0, "prefix_tokens_reused": 0}
+local_generation_stats = {"generated_tokens": 0, "generation_seconds": 0.0}
+
+
+def get_local_model(llm_model_name: str) -> Llama:
+    """Load a local model once and keep it, so its KV cache survives between calls"""
+    if llm_model_name not in loaded_local_models:
+        loaded_local_models[llm_model_name] = load_model(llm_model_name)
+    return loaded_local_models[llm_model_name]
+
+
+def restore_prefix_state(llm: Llama, llm_model_name: str, prompt_prefix: str) -> int:
+    """
+    Put the model's KV cache into the state right after evaluating prompt_prefix.
+
+    The first time a prefix is seen it is evaluated once and snapshotted with
+    save_state(); afterwards the snapshot is restored with load_state(). The next
+    llm(prompt=prompt_prefix + chunk) call then matches the restored tokens and only
+    evaluates the chunk-specific suffix. Returns the number of prefix tokens reused.
+    """
+    key = (llm_model_name, prompt_prefix)
+    state = prefix_state_cache.get(key)
+    if state is not None:
+        llm.load_state(state)
+        prefix_state_stats["hits"] += 1
+        prefix_state_stats["prefix_tokens_reused"] += llm.n_tokens
+        return llm.n_tokens
+    prefix_tokens = llm.tokenize(prompt_prefix.encode("utf-8"))
+    llm.reset()
+    llm.eval(prefix_tokens)
+    prefix_state_cache[key] = llm.save_state()
+    prefix_state_stats["misses"] += 1
+    logging.info(
+        f"Cached KV state for a {len(prefix_tokens):,}-token prompt prefix ({len(prefix_state_cache)} cached prefixes)"
+    )
+    return 0
+
+
+def record_local_generation(llm: Llama, output: Dict, elapsed: float):
+    local_generation_stats["generated_tokens"] += output["usage"]["completion_tokens"]
+    local_generation_stats["generation_seconds"] += elapsed
+    draft_model = getattr(llm, "draft_model", None)
+    if isinstance(draft_model, CountingDraftModel):
+        draft_model.generated_tokens += output["usage"]["completion_tokens"]
+        draft_model.generation_time += elapsed
+        stats = draft_model.get_stats()
+        logging.info(
+            f"Speculative decoding: {stats['acceptance_rate']:.1%} of drafted tokens accepted, "
+            f"{stats['tokens_per_second']:.1f} tokens/sec overall"
+        )
+
+
+# Local Inference Worker
+current_job_id: contextvars.ContextVar[str] = contextvars.ContextVar(
+    "current_job_id", default="default"
+)
+
+
+def resolve_future(future: asyncio.Future, result=None, error: Exception = None):
+    if future.done():  # The caller gave up, e.g. a cancelled request
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+class LocalInferenceWorker:
+    """
+    A thread that owns the local Llama instances and runs requests one at a time.
+
+    Requests are queued per job (current_job_id) and served round-robin, so
+    concurrent jobs interleave chunk by chunk instead of one job holding the
+    model for its whole document. The event loop only awaits a future. The
+    llama-cpp-python API evaluates one sequence per Llama instance, so requests
+    interleave but are not batched into one forward pass.
+    """
+
+    slot_count = 1
+
+    def __init__(self):
+        self._queues: Dict[str, deque] = {}
+        self._job_order = deque()
+        self._condition = threading.Condition()
+        self._threads = []
+        self.completed = 0
+        self.busy_time = 0.0
+
+    def start(self):
+        with self._condition:
+            if self._threads:
+                return
+            self.start_slots()
+            self._threads = [
+                threading.Thread(
+                    target=self._run, args=(slot,), name=f"local-llm-worker-{slot}", daemon=True
+                )
+                for slot in range(self.slot_count)
+            ]
+            for thread in self._threads:
+                thread.start()
+
+    def start_slots(self):
+        pass
+
+    def execute(self, slot: int, function, args):
+        return function(*args)
+
+    async def submit(self, function, *args):
+        self.start()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        job_id = current_job_id.get()
+        with self._condition:
+            if job_id not in self._queues:
+                self._queues[job_id] = deque()
+                self._job_order.append(job_id)
+            self._queues[job_id].append((function, args, future, loop))
+            self._condition.notify()
+        return await future
+
+    def _next_request(self):
+        with self._condition:
+            while not self._job_order:
+                self._condition.wait()
+            job_id = self._job_order.popleft()
+            queue = self._queues[job_id]
+            request = queue.popleft()
+            if queue:
+                self._job_order.append(job_id)
+            else:
+                del self._queues[job_id]
+            return request
+
+    def _run(self, slot: int):
+        while True:
+            function, args, future, loop = self._next_request()
+            start_time = time.perf_counter()
+            result, error = None, None
+            try:
+                result = self.execute(slot, function, args)
+            except Exception as e:
+                error = e
+            with self._condition:
+                self.busy_time += time.perf_counter() - start_time
+                self.completed += 1
+            try:
+                loop.call_soon_threadsafe(resolve_future, future, result, error)
+            except RuntimeError as e:  # The caller's event loop has closed; keep serving the others
+                logging.warning(f"Dropping a local inference result for a closed event loop: {e}")
+
+    def get_stats(self) -> Dict[str, object]:
+        with self._condition:
+            generation_seconds = local_generation_stats["generation_seconds"]
+            return {
+                "running": bool(self._threads),
+                "slots": self.slot_count,
+                "queued": {job_id: len(queue) for job_id, queue in self._queues.items()},
+                "completed": self.completed,
+                "busy_seconds": self.busy_time,
+                "generated_tokens": local_generation_stats["generated_tokens"],
+                "tokens_per_second": (
+                    local_generation_stats["generated_tokens"] / generation_seconds
+                    if generation_seconds
+                    else 0.0
+                ),
+            }
+
+
+def get_replica_cpu_sets(replicas: int, threads_per_replica: int = 0) -> List[List[int]]:
+    """Split the CPUs this process may use into disjoint per-replica sets"""
+    cpus = get_available_cpus()
+    per_replica = threads_per_replica or max(1, len(cpus) // replicas)
+    if replicas * per_replica > len(cpus):
+        logging.warning(
+            f"{replicas} replicas x {per_replica} threads exceed the {len(cpus)} available CPUs; replicas will share cores"
+        )
+    return [
+        [cpus[(i * per_replica + j) % len(cpus)] for j in range(per_replica)]
+        for i in range(replicas)
+    ]
+
+
+def run_replica(connection, cpu_ids: List[int]):
+    """Replica process: pin to its cores, then run requests from the parent until told to stop"""
+    global LOCAL_LLM_N_THREADS
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpu_ids)
+    LOCAL_LLM_N_THREADS = len(cpu_ids)
+    while True:
+        message = connection.recv()
+        if message is None:
+            break
+        function, args = message
+        try:
+            response = (True, function(*args))
+        except Exception as e:
+            response = (False, f"{type(e).__name__}: {e}")
+        connection.send(response + (take_replica_stats(),))
+
+
+def take_replica_stats() -> Dict[str, Dict]:
+    """Counters gathered in this replica since the last call, for the parent to merge"""
+    stats = {
+        "prefix_state": dict(prefix_state_stats),
+        "generation": dict(local_generation_stats),
+        "speculative_decoding": get_speculative_decoding_stats(),
+    }
+    for counters in (prefix_state_stats, local_generation_stats):
+        for key in counters:
+            counters[key] = 0
+    return stats
+
+
+class LocalReplicaPool(LocalInferenceWorker):
+    """
+    Several CPU model processes, each pinned to a disjoint set of cores.
+
+    One dispatcher thread per replica takes the next request from the same
+    per-job round-robin queue as LocalInferenceWorker and forwards it over a
+    pipe. llama.cpp memory-maps the GGUF file, so the replicas share one copy
+    of the weights through the page cache; only KV caches are per replica.
+
+    Each response carries the replica's counters, which are merged into this
+    process so /health and /metrics see them. A replica that dies (e.g. killed
+    for running out of memory) fails its current request and is restarted.
+    """
+
+    def __init__(self, replicas: int, threads_per_replica: int = 0):
+        super().__init__()
+        self.slot_count = replicas
+        self.cpu_sets = get_replica_cpu_sets(replicas, threads_per_replica)
+        self._connections = [None] * replicas
+        self._processes = [None] * replicas
+        self._replica_stats = [
+            {"completed": 0, "busy_seconds": 0.0, "restarts": 0, "speculative_decoding": {}}
+            for _ in range(replicas)
+        ]
+
+    def start_slots(self):
+        for slot in range(self.slot_count):
+            self._start_replica(slot)
+        logging.info(
+            f"Started {self.slot_count} local model replicas with "
+            f"{[len(cpu_ids) for cpu_ids in self.cpu_sets]} threads"
+        )
+
+    def _start_replica(self, slot: int):
+        context = multiprocessing.get_context("spawn")
+        parent_connection, child_connection = context.Pipe()
+        process = context.Process(
+            target=run_replica,
+            args=(child_connection, self.cpu_sets[slot]),
+            name=f"local-llm-replica-{slot}",
+            daemon=True,
+        )
+        process.start()
+        child_connection.close()  # So recv() sees EOF if the replica dies
+        self._connections[slot] = parent_connection
+        self._processes[slot] = process
+
+    def _restart_replica(self, slot: int, reason: str):
+        process = self._processes[slot]
+        logging.error(
+            f"Local model replica {slot} (pid {process.pid}, exit code {process.exitcode}) died: {reason}; restarting it"
+        )
+        if process.is_alive():
+            process.terminate()
+        process.join(timeout=10)
+        self._connections[slot].close()
+        self._start_replica(slot)
+        local_replica_restarts_total.inc()
+        with self._condition:
+            self._replica_stats[slot]["restarts"] += 1
+
+    def execute(self, slot: int, function, args):
+        if not self._processes[slot].is_alive():
+            self._restart_replica(slot, "exited while idle")
+        connection = self._connections[slot]
+        start_time = time.perf_counter()
+        try:
+            connection.send((function, args))
+            ok, result, stats = connection.recv()
+        except (EOFError, OSError) as e:
+            self._restart_replica(slot, f"{type(e).__name__}: {e}")
+            raise RuntimeError(f"Local model replica {slot} died during the request") from e
+        with self._condition:
+            replica_stats = self._replica_stats[slot]
+            replica_stats["completed"] += 1
+            replica_stats["busy_seconds"] += time.perf_counter() - start_time
+            replica_stats["speculative_decoding"] = stats["speculative_decoding"]
+            for key, value in stats["prefix_state"].items():
+                prefix_state_stats[key] += value
+            for key, value in stats["generation"].items():
+                local_generation_stats[key] += value
+        if not ok:
+            raise RuntimeError(f"Local model replica {slot} failed: {result}")
+        return result
+
+    def get_stats(self) -> Dict[str, object]:
+        stats = super().get_stats()
+        with self._condition:
+            stats["replicas"] = [
+                {
+                    "pid": process.pid if process else None,
+                    "alive": bool(process and process.is_alive()),
+                    "threads": len(cpu_ids),
+                    **replica_stats,
+                }
+                for process, cpu_ids, replica_stats in zip(
+                    self._processes, self.cpu_sets, self._replica_stats
+                )
+            ]
+        return stats
+
+    def close(self):
+        # Only call once no requests are in flight
+        for connection in self._connections:
+            if connection is not None:
+                try:
+                    connection.send(None)
+                except OSError:  # The replica already exited
+                    pass
+        for process in self._processes:
+            if process is not None:
+                process.join(timeout=10)
+
+
+local_inference_worker = (
+    LocalReplicaPool(LOCAL_LLM_REPLICAS, LOCAL_LLM_THREADS_PER_REPLICA)
+    if LOCAL_LLM_REPLICAS > 1
+    else LocalInferenceWorker()
+)
+
+
+# Adaptive Concurrency
+def is_rate_limit_error(error: Exception) -> bool:
+    return getattr(error, "status_code", None) == 429 or "429" in str(error)
+
+
+class AIMDConcurrencyLimiter:
+    """
+    Additive-increase/multiplicative-decrease limit on in-flight requests.
+
+    Every successful request raises the limit by 1/limit (about +1 per round
+    of requests). Errors, 429s and sustained slowness multiply it by
+    decrease_factor, at most once per round: only requests that started after
+    the last decrease can trigger another one.
+
+    Latency is compared per unit of request size (the caller's output token
+    budget), so a large chunk is not "slow" next to a small one. Requests far
+    from the median size are left out, as fixed overheads dominate their per-token
+    latency. Slowness means an EWMA of the per-token latency above
+    AIMD_LATENCY_TOLERANCE times the median of the last latency_window
+    successes, so single noisy responses do not halve the limit.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_limit: int,
+        initial_limit: Optional[int] = None,
+        min_limit: int = 1,
+        decrease_factor: float = 0.5,
+        latency_tolerance: float = AIMD_LATENCY_TOLERANCE,
+        adaptive: bool = ADAPTIVE_CONCURRENCY,
+        latency_window: int = 200,
+        min_samples: int = 10,
+        smoothing: float = 0.1,
+        size_range: float = 2.0,
+    ):
+        self.name = name
+        self.max_limit = max(max_limit, min_limit)
+        self.min_limit = min_limit
+        self.adaptive = adaptive
+        self.limit = float(
+            min(initial_limit or 4, self.max_limit) if adaptive else self.max_limit
+        )
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self.recent_latencies = deque(maxlen=latency_window)  # Seconds per unit of size
+        self.recent_sizes = deque(maxlen=latency_window)
+        self.smoothed_latency = None
+        self.min_samples = min_samples
+        self.smoothing = smoothing
+        self.size_range = size_range
+        self.last_decrease_time = 0.0
+        self.in_flight = 0
+        self.increases = 0
+        self.decreases = 0
+        self._condition = asyncio.Condition()
+
+    @property
+    def current_limit(self) -> int:
+        return max(self.min_limit, int(self.limit))
+
+    @property
+    def baseline_latency(self) -> Optional[float]:
+        return statistics.median(self.recent_latencies) if self.recent_latencies else None
+
+    def is_slow(self, latency: float, size: float) -> bool:
+        """Record a successful request's latency; True if latencies are running well above baseline"""
+        typical_size = statistics.median(self.recent_sizes) if self.recent_sizes else size
+        self.recent_sizes.append(size)
+        if not typical_size / self.size_range <= size <= typical_size * self.size_range:
+            return False
+        normalized = latency / max(size, 1.0)
+        baseline = self.baseline_latency
+        self.recent_latencies.append(normalized)
+        if self.smoothed_latency is None:
+            self.smoothed_latency = normalized
+        else:
+            self.smoothed_latency += self.smoothing * (normalized - self.smoothed_latency)
+        return (
+            len(self.recent_latencies) > self.min_samples
+            and self.smoothed_latency > baseline * self.latency_tolerance
+        )
+
+    def on_sample(
+        self, start_time: float, latency: float, outcome: str, size: float = 1.0
+    ):
+        """Adjust the limit after a request that started at start_time (time.monotonic())"""
+        if not self.adaptive or outcome == "cancelled":
+            return
+        slow = outcome == "ok" and self.is_slow(latency, size)
+        if outcome != "ok" or slow:
+            if start_time >= self.last_decrease_time:
+                self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+                self.last_decrease_time = time.monotonic()
+                self.smoothed_latency = None  # Judge the new limit on fresh samples
+                self.decreases += 1
+                logging.info(
+                    f"{self.name}: concurrency down to {self.current_limit} "
+                    f"({'slow response' if slow else outcome})"
+                )
+        elif self.limit < self.max_limit:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.increases += 1
+
+    async def acquire(self) -> float:
+        async with self._condition:
+            while self.in_flight >= self.current_limit:
+                await self._condition.wait()
+            self.in_flight += 1
+        return time.monotonic()
+
+    async def release(self, start_time: float, outcome: str, size: float = 1.0):
+        async with self._condition:
+            self.in_flight -= 1
+            self.on_sample(start_time, time.monotonic() - start_time, outcome, size)
+            self._condition.notify_all()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, size: float = 1.0):
+        """
+        Hold one in-flight slot for a request; exceptions count as errors or 429s.
+
+        size is the request's expected work, e.g. its output token budget.
+        """
+        start_time = await self.acquire()
+        outcome = "error"
+        try:
+            yield
+            outcome = "ok"
+        except asyncio.CancelledError:
+            # A cancelled hedge says nothing about the backend
+            outcome = "cancelled"
+            raise
+        except Exception as e:
+            outcome = "rate_limited" if is_rate_limit_error(e) else "error"
+            raise
+        finally:
+            await self.release(start_time, outcome, size)
+
+    def get_stats(self) -> Dict[str, object]:
+        return {
+            "limit": self.current_limit,
+            "max_limit": self.max_limit,
+            "in_flight": self.in_flight,
+            "baseline_latency": self.baseline_latency,
+            "increases": self.increases,
+            "decreases": self.decreases,
+        }
+
+
+provider_limiters: Dict[str, AIMDConcurrencyLimiter] = {}
+
+
+def get_provider_limiter(provider: str) -> AIMDConcurrencyLimiter:
+    if provider not in provider_limiters:
+        provider_limiters[provider] = AIMDConcurrencyLimiter(
+            provider, API_MAX_CONCURRENCY, adaptive=ADAPTIVE_API_CONCURRENCY
+        )
+    return provider_limiters[provider]
+
+
+def get_concurrency_levels() -> Dict[str, Dict[str, object]]:
+    """Live concurrency limits per API provider and per LM Studio backend"""
+    levels = {name: limiter.get_stats() for name, limiter in provider_limiters.items()}
+    if lm_studio_pool is not None:
+        for backend in lm_studio_pool.backends:
+            levels[f"LM_STUDIO {backend.base_url}"] = {
+                **backend.limiter.get_stats(),
+                "in_flight": backend.outstanding,
+                "healthy": backend.is_healthy(time.monotonic()),
+            }
+    return levels
+
+
+# OpenAI-compatible Backend Pool
+class OpenAICompatibleBackend:
+    """One OpenAI-compatible server (LM Studio, llama-server, ...) and its live counters"""
+
+    def __init__(
+        self,
+        base_url: str,
+        weight: float = 1.0,
+        max_concurrency: int = 4,
+        api_key: str = "not-needed",
+        adaptive: bool = ADAPTIVE_CONCURRENCY,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.weight = max(weight, 0.01)
+        self.max_concurrency = max(max_concurrency, 1)
+        # Small boxes collapse past a few parallel requests, so start low and probe upwards
+        self.limiter = AIMDConcurrencyLimiter(
+            self.base_url, self.max_concurrency, initial_limit=2, adaptive=adaptive
+        )
+        # Failed requests are retried by the caller through the pool, not pinned to this server
+        self.client = AsyncOpenAI(
+            api_key=api_key, base_url=f"{self.base_url}/v1", max_retries=0
+        )
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        self.total_latency = 0.0
+
+    def is_healthy(self, now: float) -> bool:
+        return now >= self.ejected_until
+
+    def get_stats(self) -> Dict[str, object]:
+        return {
+            "base_url": self.base_url,
+            "weight": self.weight,
+            "max_concurrency": self.max_concurrency,
+            "concurrency_limit": self.limiter.current_limit,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "failures": self.failures,
+            "healthy": self.is_healthy(time.monotonic()),
+            "mean_latency": self.total_latency / self.requests if self.requests else 0.0,
+        }
+
+
+def parse_backend_list(spec: str) -> List[OpenAICompatibleBackend]:
+    """Parse "url;weight=2;max_concurrency=8,url2" into backends"""
+    backends = []
+    for entry in spec.split(","):
+        url, *options = [part.strip() for part in entry.split(";")]
+        if not url:
+            continue
+        settings = {}
+        for option in options:
+            key, _, value = option.partition("=")
+            if key.strip() == "weight":
+                settings["weight"] = float(value)
+            elif key.strip() == "max_concurrency":
+                settings["max_concurrency"] = int(value)
+            else:
+                logging.warning(f"Ignoring unknown backend option '{option}' for {url}")
+        backends.append(OpenAICompatibleBackend(url, **settings))
+    return backends
+
+
+class OpenAICompatibleBackendPool:
+    """
+    Spreads requests over several OpenAI-compatible servers.
+
+    Each request goes to the healthy backend with the fewest outstanding
+    requests relative to its weight, and waits when every backend is at its
+    adaptive (AIMD) concurrency limit. A backend that fails max_failures times in a row is
+    ejected for cooldown_seconds; afterwards it gets traffic again and is
+    ejected again on its next failure.
+    """
+
+    def __init__(
+        self,
+        backends: List[OpenAICompatibleBackend],
+        max_failures: int = 3,
+        cooldown_seconds: float = 30.0,
+    ):
+        if not backends:
+            raise ValueError("A backend pool needs at least one backend")
+        self.backends = backends
+        self.max_failures = max_failures
+        self.cooldown_seconds = cooldown_seconds
+        self._condition = asyncio.Condition()
+
+    def pick_backend(self) -> Optional[OpenAICompatibleBackend]:
+        now = time.monotonic()
+        candidates = [
+            b for b in self.backends if b.outstanding < b.limiter.current_limit
+        ]
+        healthy = [b for b in candidates if b.is_healthy(now)]
+        if not healthy and not any(b.is_healthy(now) for b in self.backends):
+            # Everything is ejected: probe the backend whose cooldown ends first
+            healthy = sorted(candidates, key=lambda b: b.ejected_until)[:1]
+        if not healthy:
+            return None
+        return min(healthy, key=lambda b: ((b.outstanding + 1) / b.weight, b.requests))
+
+    async def acquire(self) -> OpenAICompatibleBackend:
+        async with self._condition:
+            while (backend := self.pick_backend()) is None:
+                await self._condition.wait()
+            backend.outstanding += 1
+            return backend
+
+    async def release(
+        self,
+        backend: OpenAICompatibleBackend,
+        outcome: str,
+        start_time: float,
+        size: float = 1.0,
+    ):
+        latency = time.monotonic() - start_time
+        async with self._condition:
+            backend.outstanding -= 1
+            backend.requests += 1
+            backend.total_latency += latency
+            backend.limiter.on_sample(start_time, latency, outcome, size)
+            # A 429 means "slow down", which the limiter handles; it is not a health failure
+            if outcome == "ok":
+                backend.consecutive_failures = 0
+            elif outcome == "error":
+                backend.failures += 1
+                backend.consecutive_failures += 1
+                if backend.consecutive_failures >= self.max_failures:
+                    backend.ejected_until = time.monotonic() + self.cooldown_seconds
+                    logging.warning(
+                        f"Ejecting backend {backend.base_url} for {self.cooldown_seconds:.0f}s "
+                        f"after {backend.consecutive_failures} consecutive failures"
+                    )
+            self._condition.notify_all()
+
+    @contextlib.asynccontextmanager
+    async def lease(self, size: float = 1.0):
+        """
+        Borrow a backend for one request; an exception counts as a failure, a cancellation doesn't.
+
+        size is the request's expected work (its output token budget), for the backend's limiter.
+        """
+        backend = await self.acquire()
+        start_time = time.monotonic()
+        outcome = "error"
+        try:
+            yield backend
+            outcome = "ok"
+        except asyncio.CancelledError:
+            outcome = "cancelled"
+            raise
+        except Exception as e:
+            outcome = "rate_limited" if is_rate_limit_error(e) else "error"
+            raise
+        finally:
+            await self.release(backend, outcome, start_time, size)
+
+    def get_stats(self) -> List[Dict[str, object]]:
+        return [backend.get_stats() for backend in self.backends]
+
+
+lm_studio_pool = None
+
+
+def get_lm_studio_pool() -> OpenAICompatibleBackendPool:
+    global lm_studio_pool
+    if lm_studio_pool is None:
+        lm_studio_pool = OpenAICompatibleBackendPool(
+            parse_backend_list(LM_STUDIO_BACKENDS or LM_STUDIO_BASE_URL),
+            LM_STUDIO_BACKEND_MAX_FAILURES,
+            LM_STUDIO_BACKEND_COOLDOWN_SECONDS,
+        )
+        logging.info(
+            f"LM Studio backends: {', '.join(b.base_url for b in lm_studio_pool.backends)}"
+        )
+    return lm_studio_pool
+
+
+# API Interaction Functions
+async def generate_completion_from_lm_studio(
+    prompt: str,
+    max_tokens: int = 5000,
+    system_prompt: Optional[str] = None,
+    model: Optional[str] = None,
+    json_schema: Optional[Dict] = None,
+) -> Optional[str]:
+    """Generate completion using LM Studio's OpenAI-compatible API"""
+    try:
+        messages = build_chat_messages(prompt, system_prompt)
+
+        # Use the specified model or let LM Studio choose the default
+        model = model or LM_STUDIO_MODEL or "default"
+        capabilities = get_model_capabilities("LM_STUDIO", model)
+        # The served model's tokenizer is unknown, so use the tokenizer-free estimate
+        prompt_tokens = approximate_tokens(
+            (system_prompt or "") + prompt, capabilities["tokenizer"]
+        )
+        max_tokens = max(
+            1,
+            min(
+                max_tokens,
+                capabilities["max_output_tokens"],
+                capabilities["context_window"] - prompt_tokens - TOKEN_BUFFER,
+            ),
+        )
+
+        start_time = time.perf_counter()
+        async with get_lm_studio_pool().lease(max_tokens) as backend:
+            response = await backend.client.chat.completions.create(
+                model=model,
+                messages=messages,
+                max_tokens=max_tokens,
+                temperature=0.7,
+                **build_response_format_args(json_schema),
+            )
+        if response and response.usage:
+            record_completion_usage(
+                "LM_STUDIO",
+                model,
+                response.usage.prompt_tokens,
+                response.usage.completion_tokens,
+                get_cached_prompt_tokens(response.usage),
+                latency=time.perf_counter() - start_time,
+            )
+
+        if response and response.choices and len(response.choices) > 0:
+            generated_text = response.choices[0].message.content
+            if generated_text:
+                logging.info(
+                    f"LM Studio completion successful. Generated {len(generated_text)} characters."
+                )
+                return generated_text
+            else:
+                logging.error("Empty response from LM Studio")
+                return None
+        else:
+            logging.error("Invalid response from LM Studio")
+            return None
+
+    except Exception as e:
+        logging.error(f"An error occurred while requesting from LM Studio: {e}")
+        if "404" in str(e):
+            logging.error(
+                "Model not found. Check LM_STUDIO_MODEL in .env or leave empty for default."
+            )
+        elif "Connection" in str(e):
+            logging.error(
+                f"Cannot connect to LM Studio at {LM_STUDIO_BACKENDS or LM_STUDIO_BASE_URL}. Make sure LM Studio is running."
+            )
+        return None
+
+
+async def list_lm_studio_models():
+    """List models available on any LM Studio backend"""
+    models = []
+    for backend in get_lm_studio_pool().backends:
+        try:
+            response = await backend.client.models.list()
+            if response and response.data:
+                models.extend(m.id for m in response.data if m.id not in models)
+        except Exception as e:
+            logging.error(f"Failed to list LM Studio models at {backend.base_url}: {e}")
+    if models:
+        logging.info(f"Available LM Studio models: {models}")
+    else:
+        logging.warning("No models found in LM Studio")
+    return models
+
+
+def get_default_provider() -> str:
+    return "LOCAL" if USE_LOCAL_LLM else API_PROVIDER
+
+
+def get_provider_model(provider: str) -> str:
+    """The model a provider uses when none is given"""
+    if provider == "LOCAL":
+        return DEFAULT_LOCAL_MODEL_NAME
+    elif provider == "CLAUDE":
+        return CLAUDE_MODEL_STRING
+    elif provider == "LM_STUDIO":
+        return LM_STUDIO_MODEL or "default"
+    return OPENAI_COMPLETION_MODEL
+
+
+async def dispatch_completion(
+    prompt: str,
+    max_tokens: int,
+    system_prompt: Optional[str],
+    provider: str,
+    model: Optional[str],
+    json_schema: Optional[Dict] = None,
+) -> Optional[str]:
+    labels = (provider,)
+    status = "error"
+    llm_requests_in_flight.inc(labels=labels)
+    start_time = time.perf_counter()
+    try:
+        if provider == "LOCAL":
+            result = await generate_completion_from_local_llm(
+                model or DEFAULT_LOCAL_MODEL_NAME,
+                prompt,
+                max_tokens,
+                system_prompt=system_prompt,
+                json_schema=json_schema,
+            )
+            result = result["generated_text"] if isinstance(result, dict) else result
+        elif provider == "CLAUDE":
+            result = await generate_completion_from_claude(
+                prompt, max_tokens, system_prompt, model, json_schema
+            )
+        elif provider == "OPENAI":
+            result = await generate_completion_from_openai(
+                prompt, max_tokens, system_prompt, model, json_schema
+            )
+        elif provider == "LM_STUDIO":
+            result = await generate_completion_from_lm_studio(
+                prompt, max_tokens, system_prompt, model, json_schema
+            )
+        else:
+            logging.error(f"Invalid API_PROVIDER: {provider}")
+            return None
+        status = "ok" if result else "error"
+        return result
+    except asyncio.CancelledError:
+        status = "cancelled"  # e.g. the losing side of a hedged request
+        if provider != "LOCAL":
+            # Hosted APIs still bill a cancelled request. Its prompt is estimated; the
+            # output generated before the cancellation is unknown and not counted.
+            record_completion_usage(
+                provider,
+                model,
+                approximate_tokens((system_prompt or "") + prompt, model or get_provider_model(provider)),
+                0,
+                latency=time.perf_counter() - start_time,
+                cancelled=True,
+            )
+        raise
+    finally:
+        llm_requests_in_flight.dec(labels=labels)
+        llm_request_seconds.observe(time.perf_counter() - start_time, labels)
+        llm_requests_total.inc(labels=(provider, status))
+
+
+# Request Hedging
+hedge_stats = {"requests": 0, "hedged": 0, "hedge_wins": 0, "budget_exhausted": 0}
+completion_latencies: Dict[Tuple[str, str], deque] = {}
+
+
+def get_hedge_delay(latency_key: Tuple[str, str]) -> Optional[float]:
+    latencies = completion_latencies.get(latency_key)
+    if not latencies or len(latencies) < HEDGE_MIN_SAMPLES:
+        return None
+    return float(np.percentile(latencies, HEDGE_LATENCY_PERCENTILE))
+
+
+def record_completion_latency(latency_key: Tuple[str, str], latency: float):
+    completion_latencies.setdefault(latency_key, deque(maxlen=200)).append(latency)
+
+
+def get_hedge_stats() -> Dict[str, float]:
+    return {
+        **hedge_stats,
+        "hedge_win_rate": hedge_stats["hedge_wins"] / hedge_stats["hedged"]
+        if hedge_stats["hedged"]
+        else 0.0,
+    }
+
+
+async def generate_hedged_completion(
+    prompt: str,
+    max_tokens: int,
+    system_prompt: Optional[str],
+    provider: str,
+    model: Optional[str],
+    json_schema: Optional[Dict] = None,
+) -> Optional[str]:
+    """
+    Send a duplicate request when the first one runs past the latency percentile.
+
+    Latencies are tracked per provider and system prompt, since correction and
+    markdown calls take different times. The first non-empty response wins and
+    the other request is cancelled. Hedges stop once they would exceed
+    HEDGE_MAX_EXTRA_FRACTION of all requests.
+    """
+    latency_key = (provider, system_prompt or "")
+    hedge_delay = get_hedge_delay(latency_key)
+    hedge_stats["requests"] += 1
+    start_time = time.perf_counter()
+    tasks = [
+        asyncio.create_task(
+            dispatch_completion(
+                prompt, max_tokens, system_prompt, provider, model, json_schema
+            )
+        )
+    ]
+    try:
+        if hedge_delay is not None:
+            done, _ = await asyncio.wait(tasks, timeout=hedge_delay)
+            if done:
+                pass
+            elif hedge_stats["hedged"] + 1 > HEDGE_MAX_EXTRA_FRACTION * hedge_stats["requests"]:
+                hedge_stats["budget_exhausted"] += 1
+            else:
+                hedge_stats["hedged"] += 1
+                hedge_provider = HEDGE_API_PROVIDER or provider
+                logging.info(
+                    f"Hedging a {provider} request after {hedge_delay:.1f}s on {hedge_provider}"
+                )
+                tasks.append(
+                    asyncio.create_task(
+                        dispatch_completion(
+                            prompt,
+                            max_tokens,
+                            system_prompt,
+                            hedge_provider,
+                            model if hedge_provider == provider else None,
+                            json_schema,
+                        )
+                    )
+                )
+        pending, result = set(tasks), None
+        while pending and result is None:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in done:
+                if task.exception() is not None:
+                    logging.error(f"Completion request failed: {task.exception()}")
+                elif task.result():
+                    result = task.result()
+                    if task is not tasks[0]:
+                        hedge_stats["hedge_wins"] += 1
+                    break
+        if result is not None:  # Failures return early and would drag the percentile down
+            record_completion_latency(latency_key, time.perf_counter() - start_time)
+        return result
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+
+async def generate_completion(
+    prompt: str,
+    max_tokens: int = 5000,
+    system_prompt: Optional[str] = None,
+    provider: Optional[str] = None,
+    model: Optional[str] = None,
+    json_schema: Optional[Dict] = None,
+) -> Optional[str]:
+    provider = provider or get_default_provider()
+    # The local model runs one request at a time, so a duplicate would only queue behind it
+    if HEDGE_REQUESTS and provider != "LOCAL":
+        return await generate_hedged_completion(
+            prompt, max_tokens, system_prompt, provider, model, json_schema
+        )
+    return await dispatch_completion(
+        prompt, max_tokens, system_prompt, provider, model, json_schema
+    )
+
+
+# Structured Output
+# A JSON schema constrains every provider to valid output: a compiled grammar
+# for local models, response_format json_schema for OpenAI-compatible APIs and
+# a forced tool call for Claude. Roots must be objects for the APIs to accept them.
+EDIT_LIST_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "edits": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "original": {"type": "string"},
+                    "replacement": {"type": "string"},
+                },
+                "required": ["original", "replacement"],
+                "additionalProperties": False,
+            },
+        }
+    },
+    "required": ["edits"],
+    "additionalProperties": False,
+}
+QUALITY_ASSESSMENT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "score": {"type": "integer"},
+        "explanation": {"type": "string"},
+    },
+    "required": ["score", "explanation"],
+    "additionalProperties": False,
+}
+STRUCTURED_OUTPUT_SCHEMAS = {
+    "edit_list": EDIT_LIST_SCHEMA,
+    "quality_assessment": QUALITY_ASSESSMENT_SCHEMA,
+}
+grammar_cache: Dict[str, LlamaGrammar] = {}
+
+
+def get_grammar_from_file(grammar_file_string: str) -> LlamaGrammar:
+    """Compile the newest ./grammar_files/*.gbnf matching grammar_file_string, once"""
+    key = f"file:{grammar_file_string.lower()}"
+    if key not in grammar_cache:
+        matching_grammar_files = [
+            x
+            for x in glob.glob("./grammar_files/*.gbnf")
+            if grammar_file_string.lower()
+            in os.path.splitext(os.path.basename(x).lower())[0]
+        ]
+        if len(matching_grammar_files) == 0:
+            logging.error(f"No grammar file found matching: {grammar_file_string}")
+            raise FileNotFoundError
+        grammar_file_path = max(matching_grammar_files, key=os.path.getmtime)
+        logging.info(f"Loading selected grammar file: '{grammar_file_path}'")
+        grammar_cache[key] = LlamaGrammar.from_file(grammar_file_path)
+    return grammar_cache[key]
+
+
+def get_json_schema_grammar(json_schema: Dict) -> LlamaGrammar:
+    """Compile a JSON schema to a GBNF grammar once per schema"""
+    schema_json = json.dumps(json_schema, sort_keys=True)
+    key = f"schema:{schema_json}"
+    if key not in grammar_cache:
+        grammar_cache[key] = LlamaGrammar.from_json_schema(
+            schema_json, verbose=USE_VERBOSE
+        )
+    return grammar_cache[key]
+
+
+def get_schema_name(json_schema: Dict) -> str:
+    for name, schema in STRUCTURED_OUTPUT_SCHEMAS.items():
+        if schema == json_schema:
+            return name
+    return "structured_output"
+
+
+def build_response_format_args(json_schema: Optional[Dict]) -> Dict:
+    """response_format for OpenAI-compatible chat completions"""
+    if not json_schema:
+        return {}
+    return {
+        "response_format": {
+            "type": "json_schema",
+            "json_schema": {
+                "name": get_schema_name(json_schema),
+                "schema": json_schema,
+                "strict": True,
+            },
+        }
+    }
+
+
+def build_claude_tool_args(json_schema: Optional[Dict]) -> Dict:
+    """Force a single tool call whose input follows json_schema"""
+    if not json_schema:
+        return {}
+    name = get_schema_name(json_schema)
+    return {
+        "tools": [
+            {
+                "name": name,
+                "description": "Record the response.",
+                "input_schema": json_schema,
+            }
+        ],
+        "tool_choice": {"type": "tool", "name": name},
+    }
+
+
+def parse_json_object(response: Optional[str]) -> Optional[Dict]:
+    """Parse a JSON object, tolerating text around it from providers without schema support"""
+    if not response:
+        return None
+    start, end = response.find("{"), response.rfind("}")
+    if start == -1 or end < start:
+        return None
+    try:
+        result = json.loads(response[start : end + 1])
+    except json.JSONDecodeError:
+        return None
+    return result if isinstance(result, dict) else None
+
+
+async def generate_structured_completion(
+    prompt: str,
+    json_schema: Dict,
+    max_tokens: int = 1000,
+    system_prompt: Optional[str] = None,
+    provider: Optional[str] = None,
+    model: Optional[str] = None,
+) -> Optional[Dict]:
+    """Completion constrained to json_schema, parsed; None if the request failed"""
+    response = await generate_completion(
+        prompt, max_tokens, system_prompt, provider, model, json_schema
+    )
+    result = parse_json_object(response)
+    if response and result is None:
+        logging.error(f"Structured completion was not valid JSON: {response[:200]}")
+    return result
+
+
+# Model Capabilities
+# Token limits in tokens, prices in USD per million tokens. Claude prompt cache
+# writes cost 1.25x the input price. Dated model names
+# (e.g. gpt-4o-mini-2024-07-18) match their longest listed prefix.
+PROVIDER_DEFAULT_CAPABILITIES = {
+    "OPENAI": {"context_window": 128000, "max_output_tokens": 4096},
+    "CLAUDE": {"context_window": 200000, "max_output_tokens": 4096},
+    # Conservative until LM Studio reports the loaded context length
+    "LM_STUDIO": {"context_window": 4096, "max_output_tokens": 4096, "tokenizer": "llama-3"},
+    "LOCAL": {"tokenizer": "llama-3"},
+}
+DEFAULT_MODEL_CAPABILITIES = {
+    "gpt-4o-mini": {
+        "context_window": 128000,
+        "max_output_tokens": 16384,
+        "input_price": 0.15,
+        "cached_input_price": 0.075,
+        "output_price": 0.60,
+    },
+    "gpt-4o": {
+        "context_window": 128000,
+        "max_output_tokens": 16384,
+        "input_price": 2.50,
+        "cached_input_price": 1.25,
+        "output_price": 10.00,
+    },
+    "gpt-4.1-mini": {
+        "context_window": 1047576,
+        "max_output_tokens": 32768,
+        "tokenizer": "gpt-4o",
+        "input_price": 0.40,
+        "cached_input_price": 0.10,
+        "output_price": 1.60,
+    },
+    "claude-3-haiku": {
+        "context_window": 200000,
+        "max_output_tokens": 4096,
+        "input_price": 0.25,
+        "cached_input_price": 0.03,
+        "cache_write_price": 0.30,
+        "output_price": 1.25,
+    },
+    "claude-3-5-haiku": {
+        "context_window": 200000,
+        "max_output_tokens": 8192,
+        "input_price": 0.80,
+        "cached_input_price": 0.08,
+        "cache_write_price": 1.00,
+        "output_price": 4.00,
+    },
+    "claude-3-5-sonnet": {
+        "context_window": 200000,
+        "max_output_tokens": 8192,
+        "input_price": 3.00,
+        "cached_input_price": 0.30,
+        "cache_write_price": 3.75,
+        "output_price": 15.00,
+    },
+}
+OUTPUT_TOKEN_RATIO = 1.3  # Rewritten chunks, especially as markdown, run longer than their input
+discovered_model_capabilities: Dict[str, Dict] = {}
+
+
+def load_model_capabilities(path: str) -> Dict[str, Dict]:
+    """Per-model entries from MODEL_CAPABILITIES_FILE, e.g. {"my-model": {"context_window": 32768}}"""
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        logging.error(f"Could not read model capabilities from {path}: {e}")
+        return {}
+
+
+configured_model_capabilities = load_model_capabilities(MODEL_CAPABILITIES_FILE)
+
+
+def find_model_entry(table: Dict[str, Dict], model: str) -> Dict:
+    if model in table:
+        return table[model]
+    prefixes = [name for name in table if model.startswith(name)]
+    return table[max(prefixes, key=len)] if prefixes else {}
+
+
+def get_model_capabilities(
+    provider: Optional[str] = None, model: Optional[str] = None
+) -> Dict[str, object]:
+    """
+    Context window, max output tokens, tokenizer and prices for a model.
+
+    Later sources win: provider defaults, the built-in table, what LM Studio
+    reports about its loaded models, then MODEL_CAPABILITIES_FILE.
+    """
+    provider = provider or get_default_provider()
+    model = model or get_provider_model(provider)
+    capabilities = {
+        "input_price": 0.0,
+        "cached_input_price": 0.0,
+        "output_price": 0.0,
+        "tokenizer": model,
+    }
+    capabilities.update(PROVIDER_DEFAULT_CAPABILITIES.get(provider, {}))
+    if provider == "LOCAL":
+        n_ctx = get_local_inference_settings(model)["n_ctx"]
+        capabilities.update(context_window=n_ctx, max_output_tokens=n_ctx)
+    capabilities.update(find_model_entry(DEFAULT_MODEL_CAPABILITIES, model))
+    capabilities.update(discovered_model_capabilities.get(model, {}))
+    capabilities.update(find_model_entry(configured_model_capabilities, model))
+    # Only Anthropic charges extra for writing the prompt cache
+    capabilities.setdefault("cache_write_price", capabilities["input_price"])
+    return capabilities
+
+
+def fetch_lm_studio_model_info(base_url: str) -> List[Dict]:
+    """Models from LM Studio's native REST API, which, unlike /v1/models, reports context lengths"""
+    with urllib.request.urlopen(f"{base_url}/api/v0/models", timeout=5) as response:
+        return json.load(response).get("data", [])
+
+
+async def refresh_lm_studio_capabilities():
+    """Record each LM Studio model's context length, keeping the smallest across backends"""
+    discovered = {}
+    for backend in get_lm_studio_pool().backends:
+        try:
+            models = await run_blocking(fetch_lm_studio_model_info, backend.base_url)
+        except Exception as e:
+            logging.warning(f"Could not read model info from {backend.base_url}: {e}")
+            continue
+        loaded = [info for info in models if info.get("state") == "loaded"]
+        for info in models:
+            context_window = info.get("loaded_context_length") or info.get(
+                "max_context_length"
+            )
+            if not context_window:
+                continue
+            names = [info["id"]]
+            # Requests without a model go to the only loaded model
+            if len(loaded) == 1 and info is loaded[0]:
+                names.append("default")
+            for name in names:
+                context_window = min(
+                    context_window,
+                    discovered.get(name, {}).get("context_window", context_window),
+                )
+                discovered[name] = {
+                    "context_window": context_window,
+                    "max_output_tokens": context_window,
+                }
+    discovered_model_capabilities.update(discovered)
+    if discovered:
+        logging.info(
+            "LM Studio context windows: "
+            + ", ".join(f"{name}={c['context_window']:,}" for name, c in discovered.items())
+        )
+
+
+def get_output_token_budget(
+    text: str,
+    provider: Optional[str] = None,
+    model: Optional[str] = None,
+    ratio: float = OUTPUT_TOKEN_RATIO,
+) -> int:
+    """max_tokens for a response about ratio times as long as text, within the model's output limit"""
+    capabilities = get_model_capabilities(provider, model)
+    return min(
+        capabilities["max_output_tokens"],
+        int(approximate_tokens(text, capabilities["tokenizer"]) * ratio) + 100,
+    )
+
+
+def get_chunk_size_in_characters(
+    provider: Optional[str] = None, model: Optional[str] = None
+) -> int:
+    """
+    Characters per chunk so that a correction request fits the model.
+
+    A request holds the system prompt, the previous context, the chunk and a
+    rewrite OUTPUT_TOKEN_RATIO times as long, plus TOKEN_BUFFER, and the
+    rewrite must fit the model's output limit.
+    """
+    capabilities = get_model_capabilities(provider, model)
+    # The longest system prompt plus the last 500 characters of context
+    prompt_tokens = get_token_estimator(capabilities["tokenizer"]).estimate(
+        [
+            OCR_CORRECTION_SYSTEM_PROMPT,
+            MARKDOWN_FORMATTING_SYSTEM_PROMPT,
+            SINGLE_PASS_SYSTEM_PROMPT,
+        ],
+        upper_bound=True,
+    ).max() + 500 / CHARACTERS_PER_TOKEN
+    chunk_tokens = min(
+        (capabilities["context_window"] - prompt_tokens - TOKEN_BUFFER)
+        / (1 + OUTPUT_TOKEN_RATIO),
+        capabilities["max_output_tokens"] / OUTPUT_TOKEN_RATIO,
+    )
+    chunk_size = int(chunk_tokens * CHARACTERS_PER_TOKEN)
+    return max(500, min(DEFAULT_CHUNK_SIZE_IN_CHARACTERS, chunk_size))
+
+
+tokenizer_cache: Dict[str, object] = {}
+
+
+def load_hf_tokenizer(name: str):
+    """AutoTokenizer.from_pretrained reads its files on every call, so keep one per name"""
+    if name not in tokenizer_cache:
+        tokenizer_cache[name] = AutoTokenizer.from_pretrained(
+            name, clean_up_tokenization_spaces=False
+        )
+    return tokenizer_cache[name]
+
+
+def get_tokenizer(model_name: str):
+    if model_name.lower().startswith("gpt-"):
+        return tiktoken.encoding_for_model(model_name)
+    elif model_name.lower().startswith("claude-"):
+        return load_hf_tokenizer("EleutherAI/gpt-neox-20b")
+    elif model_name.lower().startswith("llama-"):
+        return load_hf_tokenizer("huggyllama/llama-7b")
+    else:
+        raise ValueError(f"Unsupported model: {model_name}")
+
+
+unavailable_tokenizers: set = set()
+
+
+def estimate_tokens(text: str, model_name: str) -> int:
+    """Exact token count; use approximate_tokens() where an estimate will do"""
+    if model_name not in unavailable_tokenizers:
+        try:
+            tokenizer = get_tokenizer(model_name)
+            return len(tokenizer.encode(text))
+        except Exception as e:
+            # Warn once; later calls go straight to the estimate
+            unavailable_tokenizers.add(model_name)
+            logging.warning(
+                f"No tokenizer for {model_name} ({e}); using the calibrated estimate instead"
+            )
+    return approximate_tokens(text, model_name)
+
+
+# Token Estimation
+# Bytes fall into five classes; token counts are a linear function of byte,
+# class-run and per-class counts, fitted per tokenizer family on OCR text.
+TOKEN_CLASS_SPACE, TOKEN_CLASS_LETTER, TOKEN_CLASS_DIGIT = 0, 1, 2
+TOKEN_CLASS_PUNCTUATION, TOKEN_CLASS_NON_ASCII = 3, 4
+TOKEN_BYTE_CLASSES = np.full(256, TOKEN_CLASS_NON_ASCII, dtype=np.int8)
+TOKEN_BYTE_CLASSES[:128] = TOKEN_CLASS_PUNCTUATION
+TOKEN_BYTE_CLASSES[list(b" \t\n\r\x0b\x0c")] = TOKEN_CLASS_SPACE
+TOKEN_BYTE_CLASSES[list(range(ord("a"), ord("z") + 1))] = TOKEN_CLASS_LETTER
+TOKEN_BYTE_CLASSES[list(range(ord("A"), ord("Z") + 1))] = TOKEN_CLASS_LETTER
+TOKEN_BYTE_CLASSES[list(range(ord("0"), ord("9") + 1))] = TOKEN_CLASS_DIGIT
+TOKENIZER_FAMILY_MODELS = {
+    "tiktoken": "gpt-4o",
+    "gpt-neox": "claude-3",
+    "llama": "llama-3",
+}  # A model name get_tokenizer() maps to each family's tokenizer
+TOKEN_CALIBRATION_TEXT_FILE = config.get(
+    "TOKEN_CALIBRATION_TEXT_FILE",
+    default="160301289-Warren-Buffett-Katharine-Graham-Letter__raw_ocr_output.txt",
+    cast=str,
+)  # Representative OCR text for calibrating the fast token estimator
+TOKEN_CALIBRATION_SAMPLES = 300
+
+
+def get_tokenizer_family(model_name: Optional[str]) -> str:
+    name = (model_name or "").lower()
+    if name.startswith("gpt-"):
+        return "tiktoken"
+    elif name.startswith("claude-"):
+        return "gpt-neox"
+    return "llama"
+
+
+def extract_token_features(texts: List[str]) -> np.ndarray:
+    """
+    One row per text: bytes, non-ASCII bytes, class runs, punctuation, digits, whitespace.
+
+    All texts are classified in one pass over their concatenated bytes and
+    summed per text with np.add.reduceat.
+    """
+    encoded = [text.encode("utf-8") for text in texts]
+    lengths = np.fromiter((len(b) for b in encoded), dtype=np.int64, count=len(encoded))
+    features = np.zeros((len(encoded), 6))
+    if not lengths.any():
+        return features
+    classes = TOKEN_BYTE_CLASSES[np.frombuffer(b"".join(encoded), dtype=np.uint8)]
+    offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    non_empty = lengths > 0
+    run_starts = np.ones(len(classes), dtype=bool)
+    run_starts[1:] = classes[1:] != classes[:-1]
+    run_starts[offsets[non_empty]] = True  # A run never continues into the next text
+    indicators = np.stack(
+        [
+            np.ones(len(classes), dtype=bool),
+            classes == TOKEN_CLASS_NON_ASCII,
+            run_starts,
+            classes == TOKEN_CLASS_PUNCTUATION,
+            classes == TOKEN_CLASS_DIGIT,
+            classes == TOKEN_CLASS_SPACE,
+        ],
+        axis=1,
+    ).astype(np.int32)
+    features[non_empty] = np.add.reduceat(indicators, offsets[non_empty], axis=0)
+    return features
+
+
+class FastTokenEstimator:
+    """
+    Vectorized token-count estimate for one tokenizer family.
+
+    calibrate() fits the coefficients by least squares against the real
+    tokenizer on random 200-4000 character windows of OCR text and measures
+    the largest relative error on windows from a held-out part of the text.
+    Upper-bound estimates are scaled by that bound, so budgets stay safe
+    without an exact tokenization.
+    The bound holds for text like the calibration text; languages it lacks are
+    overestimated.
+    """
+
+    def __init__(
+        self,
+        family: str,
+        coefficients: np.ndarray,
+        error_bound: float,
+        mean_error: Optional[float] = None,
+        samples: int = 0,
+    ):
+        self.family = family
+        self.coefficients = coefficients
+        self.error_bound = error_bound
+        self.mean_error = mean_error
+        self.samples = samples
+
+    @classmethod
+    def uncalibrated(cls, family: str) -> "FastTokenEstimator":
+        coefficients = np.array([1 / CHARACTERS_PER_TOKEN, 0.25, 0, 0, 0, 0])
+        return cls(family, coefficients, error_bound=0.3)
+
+    @classmethod
+    def calibrate(
+        cls, family: str, text: str, samples: int = TOKEN_CALIBRATION_SAMPLES, seed: int = 0
+    ) -> "FastTokenEstimator":
+        tokenizer = get_tokenizer(TOKENIZER_FAMILY_MODELS[family])
+        rng = np.random.default_rng(seed)
+        split = samples * 2 // 3
+        # Training windows come from the first two thirds of the text and held-out
+        # windows from the rest, so no held-out window overlaps the training data
+        boundary = len(text) * 2 // 3
+        windows = []
+        for region, count in [(text[:boundary], split), (text[boundary:], samples - split)]:
+            for _ in range(count):
+                length = int(rng.integers(min(200, len(region)), min(4000, len(region)) + 1))
+                start = int(rng.integers(0, len(region) - length + 1))
+                windows.append(region[start : start + length])
+        features = extract_token_features(windows)
+        exact = np.array([len(tokenizer.encode(window)) for window in windows])
+        coefficients = np.linalg.lstsq(features[:split], exact[:split], rcond=None)[0]
+        relative_errors = np.abs(features[split:] @ coefficients - exact[split:]) / np.maximum(
+            exact[split:], 1
+        )
+        return cls(
+            family,
+            coefficients,
+            error_bound=float(relative_errors.max()),
+            mean_error=float(relative_errors.mean()),
+            samples=samples,
+        )
+
+    def estimate(self, texts: List[str], upper_bound: bool = False) -> np.ndarray:
+        tokens = extract_token_features(texts) @ self.coefficients
+        if upper_bound:
+            tokens *= 1 + self.error_bound
+        return np.ceil(np.maximum(tokens, 0))
+
+    def get_stats(self) -> Dict[str, object]:
+        return {
+            "family": self.family,
+            "calibrated": self.samples > 0,
+            "error_bound": self.error_bound,
+            "mean_error": self.mean_error,
+            "samples": self.samples,
+        }
+
+
+token_estimators: Dict[str, FastTokenEstimator] = {}
+token_estimator_lock = threading.Lock()
+
+
+def load_token_calibration_text() -> Optional[str]:
+    path = TOKEN_CALIBRATION_TEXT_FILE
+    if not os.path.isabs(path):
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), path)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            text = f.read()
+        return text if len(text) >= 1000 else None
+    except OSError:
+        return None
+
+
+def get_token_estimator(model_name: Optional[str] = None) -> FastTokenEstimator:
+    """The calibrated estimator for model_name's tokenizer family (the active model by default)"""
+    family = get_tokenizer_family(model_name or get_active_model_name())
+    if family in token_estimators:
+        return token_estimators[family]
+    with token_estimator_lock:
+        if family in token_estimators:
+            return token_estimators[family]
+        text = load_token_calibration_text()
+        try:
+            if text is None:
+                raise FileNotFoundError(TOKEN_CALIBRATION_TEXT_FILE)
+            estimator = FastTokenEstimator.calibrate(family, text)
+            logging.info(
+                f"Calibrated {family} token estimator: mean error {estimator.mean_error:.1%}, "
+                f"bound {estimator.error_bound:.1%}"
+            )
+        except Exception as e:
+            logging.warning(
+                f"Could not calibrate {family} token estimator ({e}); using a conservative default"
+            )
+            estimator = FastTokenEstimator.uncalibrated(family)
+        token_estimators[family] = estimator
+    return estimator
+
+
+def approximate_tokens(text: str, model_name: Optional[str] = None) -> int:
+    """Fast token count that errs high by the estimator's error bound"""
+    return int(get_token_estimator(model_name).estimate([text], upper_bound=True)[0])
+
+
+def prepare_token_counting(tiers) -> None:
+    """
+    Load the tokenizers and calibrate the estimators the given (provider, model) tiers use.
+
+    Both happen on first use and may download tokenizer files, so run this on
+    the worker pool before requests need them on the event loop.
+    """
+    get_token_estimator()
+    for provider, model in tiers:
+        tokenizer_name = get_model_capabilities(provider, model)["tokenizer"]
+        get_token_estimator(tokenizer_name)
+        if provider in ("CLAUDE", "OPENAI"):  # These count prompt tokens exactly
+            estimate_tokens("", tokenizer_name)
+
+
+def chunk_text(text: str, max_chunk_tokens: int, model_name: str) -> List[str]:
+    chunks = []
+    tokenizer = get_tokenizer(model_name)
+    sentences = re.split(r"(?<=[.!?])\s+", text)
+    current_chunk = []
+    current_chunk_tokens = 0
+
+    for sentence in sentences:
+        sentence_tokens = len(tokenizer.encode(sentence))
+        if current_chunk_tokens + sentence_tokens > max_chunk_tokens:
+            chunks.append(" ".join(current_chunk))
+            current_chunk = [sentence]
+            current_chunk_tokens = sentence_tokens
+        else:
+            current_chunk.append(sentence)
+            current_chunk_tokens += sentence_tokens
+
+    if current_chunk:
+        chunks.append(" ".join(current_chunk))
+
+    adjusted_chunks = adjust_overlaps(chunks, tokenizer, max_chunk_tokens)
+    return adjusted_chunks
+
+
+def split_long_sentence(sentence: str, max_tokens: int, model_name: str) -> List[str]:
+    words = sentence.split()
+    chunks = []
+    current_chunk = []
+    current_chunk_tokens = 0
+    tokenizer = get_tokenizer(model_name)
+
+    for word in words:
+        word_tokens = len(tokenizer.encode(word))
+        if current_chunk_tokens + word_tokens > max_tokens and current_chunk:
+            chunks.append(" ".join(current_chunk))
+            current_chunk = [word]
+            current_chunk_tokens = word_tokens
+        else:
+            current_chunk.append(word)
+            current_chunk_tokens += word_tokens
+
+    if current_chunk:
+        chunks.append(" ".join(current_chunk))
+
+    return chunks
+
+
+def adjust_overlaps(
+    chunks: List[str], tokenizer, max_chunk_tokens: int, overlap_size: int = 50
+) -> List[str]:
+    adjusted_chunks = []
+    for i in range(len(chunks)):
+        if i == 0:
+            adjusted_chunks.append(chunks[i])
+        else:
+            overlap_tokens = len(
+                tokenizer.encode(" ".join(chunks[i - 1].split()[-overlap_size:]))
+            )
+            current_tokens = len(tokenizer.encode(chunks[i]))
+            if overlap_tokens + current_tokens > max_chunk_tokens:
+                overlap_adjusted = chunks[i].split()[:-overlap_size]
+                adjusted_chunks.append(" ".join(overlap_adjusted))
+            else:
+                adjusted_chunks.append(
+                    " ".join(chunks[i - 1].split()[-overlap_size:] + chunks[i].split())
+                )
+
+    return adjusted_chunks
+
+
+def build_claude_system_blocks(system_prompt: Optional[str]):
+    """Mark the static instructions with cache_control so Anthropic can cache the prefix"""
+    if not system_prompt:
+        return None
+    return [
+        {
+            "type": "text",
+            "text": system_prompt,
+            "cache_control": {"type": "ephemeral"},
+        }
+    ]
+
+
+def record_claude_usage(
+    message, model: str, start_time: float, first_token_time: Optional[float]
+):
+    usage = message.usage
+    cache_read = getattr(usage, "cache_read_input_tokens", 0) or 0
+    cache_creation = getattr(usage, "cache_creation_input_tokens", 0) or 0
+    record_completion_usage(
+        "CLAUDE",
+        model,
+        usage.input_tokens + cache_read + cache_creation,
+        usage.output_tokens,
+        cache_read,
+        cache_creation,
+        latency=time.perf_counter() - start_time,
+        time_to_first_token=first_token_time - start_time
+        if first_token_time
+        else None,
+    )
+
+
+def get_claude_output_text(message) -> str:
+    """Text of a Claude reply, or the JSON input of its forced tool call"""
+    for block in message.content:
+        if block.type == "tool_use":
+            return json.dumps(block.input)
+    return message.content[0].text
+
+
+async def generate_completion_from_claude(
+    prompt: str,
+    max_tokens: int = 4000,
+    system_prompt: Optional[str] = None,
+    model: Optional[str] = None,
+    json_schema: Optional[Dict] = None,
+) -> Optional[str]:
+    if not ANTHROPIC_API_KEY:
+        logging.error(
+            "Anthropic API key not found. Please set the ANTHROPIC_API_KEY environment variable."
+        )
+        return None
+    model = model or CLAUDE_MODEL_STRING
+    client = AsyncAnthropic(api_key=ANTHROPIC_API_KEY)
+    system_blocks = build_claude_system_blocks(system_prompt)
+    extra_args = {"system": system_blocks} if system_blocks else {}
+    capabilities = get_model_capabilities("CLAUDE", model)
+    prompt_tokens = estimate_tokens(
+        (system_prompt or "") + prompt, capabilities["tokenizer"]
+    )
+    adjusted_max_tokens = min(
+        max_tokens,
+        capabilities["max_output_tokens"],
+        capabilities["context_window"] - prompt_tokens - TOKEN_BUFFER,
+    )
+    if adjusted_max_tokens <= 0:
+        logging.warning("Prompt is too long for Claude API. Chunking the input.")
+        chunk_tokens = min(
+            capabilities["max_output_tokens"],
+            (capabilities["context_window"] - TOKEN_CUSHION) // 2,
+        )
+        chunks = chunk_text(prompt, chunk_tokens, capabilities["tokenizer"])
+        results = []
+        for chunk in chunks:
+            try:
+                async with get_provider_limiter("CLAUDE").slot(chunk_tokens):
+                    start_time = time.perf_counter()
+                    async with client.messages.stream(
+                        model=model,
+                        max_tokens=chunk_tokens,
+                        temperature=0.7,
+                        messages=[{"role": "user", "content": chunk}],
+                        **extra_args,
+                    ) as stream:
+                        message = await stream.get_final_message()
+                        record_claude_usage(message, model, start_time, None)
+                        results.append(message.content[0].text)
+                        logging.info(
+                            f"Chunk processed. Input tokens: {message.usage.input_tokens:,}, Output tokens: {message.usage.output_tokens:,}"
+                        )
+            except Exception as e:
+                logging.error(f"An error occurred while processing a chunk: {e}")
+        return " ".join(results)
+    else:
+        try:
+            async with get_provider_limiter("CLAUDE").slot(adjusted_max_tokens):
+                start_time = time.perf_counter()
+                first_token_time = None
+                async with client.messages.stream(
+                    model=model,
+                    max_tokens=adjusted_max_tokens,
+                    temperature=0.7,
+                    messages=[{"role": "user", "content": prompt}],
+                    **extra_args,
+                    **build_claude_tool_args(json_schema),
+                ) as stream:
+                    async for _ in stream.text_stream:
+                        if first_token_time is None:
+                            first_token_time = time.perf_counter()
+                    message = await stream.get_final_message()
+                    record_claude_usage(message, model, start_time, first_token_time)
+                    output_text = get_claude_output_text(message)
+                    logging.info(f"Total input tokens: {message.usage.input_tokens:,}")
+                    logging.info(f"Total output tokens: {message.usage.output_tokens:,}")
+                    logging.info(f"Generated output (abbreviated): {output_text[:150]}...")
+                    return output_text
+        except Exception as e:
+            logging.error(f"An error occurred while requesting from Claude API: {e}")
+            return None
+
+
+async def generate_completion_from_openai(
+    prompt: str,
+    max_tokens: int = 5000,
+    system_prompt: Optional[str] = None,
+    model: Optional[str] = None,
+    json_schema: Optional[Dict] = None,
+) -> Optional[str]:
+    if not OPENAI_API_KEY:
+        logging.error(
+            "OpenAI API key not found. Please set the OPENAI_API_KEY environment variable."
+        )
+        return None
+    model = model or OPENAI_COMPLETION_MODEL
+    capabilities = get_model_capabilities("OPENAI", model)
+    prompt_tokens = estimate_tokens(
+        (system_prompt or "") + prompt, capabilities["tokenizer"]
+    )
+    adjusted_max_tokens = min(
+        max_tokens,
+        capabilities["max_output_tokens"],
+        capabilities["context_window"] - prompt_tokens - TOKEN_BUFFER,
+    )
+    if adjusted_max_tokens <= 0:
+        logging.warning("Prompt is too long for OpenAI API. Chunking the input.")
+        chunk_tokens = min(
+            capabilities["max_output_tokens"],
+            (capabilities["context_window"] - TOKEN_CUSHION) // 2,
+        )
+        chunks = chunk_text(prompt, chunk_tokens, capabilities["tokenizer"])
+        results = []
+        for chunk in chunks:
+            try:
+                async with get_provider_limiter("OPENAI").slot(chunk_tokens):
+                    start_time = time.perf_counter()
+                    response = await openai_client.chat.completions.create(
+                        model=model,
+                        messages=build_chat_messages(chunk, system_prompt),
+                        max_tokens=chunk_tokens,
+                        temperature=0.7,
+                    )
+                    record_completion_usage(
+                        "OPENAI",
+                        model,
+                        response.usage.prompt_tokens,
+                        response.usage.completion_tokens,
+                        get_cached_prompt_tokens(response.usage),
+                        latency=time.perf_counter() - start_time,
+                    )
+                result = response.choices[0].message.content
+                results.append(result)
+                logging.info(
+                    f"Chunk processed. Output tokens: {response.usage.completion_tokens:,}"
+                )
+            except Exception as e:
+                logging.error(f"An error occurred while processing a chunk: {e}")
+        return " ".join(results)
+    else:
+        try:
+            async with get_provider_limiter("OPENAI").slot(adjusted_max_tokens):
+                start_time = time.perf_counter()
+                response = await openai_client.chat.completions.create(
+                    model=model,
+                    messages=build_chat_messages(prompt, system_prompt),
+                    max_tokens=adjusted_max_tokens,
+                    temperature=0.7,
+                    **build_response_format_args(json_schema),
+                )
+                record_completion_usage(
+                    "OPENAI",
+                    model,
+                    response.usage.prompt_tokens,
+                    response.usage.completion_tokens,
+                    get_cached_prompt_tokens(response.usage),
+                    latency=time.perf_counter() - start_time,
+                )
+            output_text = response.choices[0].message.content
+            logging.info(f"Total tokens: {response.usage.total_tokens:,}")
+            logging.info(f"Generated output (abbreviated): {output_text[:150]}...")
+            return output_text
+        except Exception as e:
+            logging.error(f"An error occurred while requesting from OpenAI API: {e}")
+            return None
+
+
+def run_local_completion(
     llm_model_name: str,
     input_prompt: str,
     number_of_tokens_to_generate: int = 100,
     temperature: float = 0.7,
     grammar_file_string: str = None,
+    system_prompt: Optional[str] = None,
+    json_schema: Optional[Dict] = None,
 ):
+    """Blocking local completion; only called on the local inference worker thread"""
     logging.info(
         f"Starting text completion using model: '{llm_model_name}' for input prompt: '{input_prompt}'"
     )
-    llm = load_model(llm_model_name)
-    prompt_tokens = estimate_tokens(input_prompt, llm_model_name)
+    llm = get_local_model(llm_model_name)
+    # Keep the instructions as a fixed leading prefix so llama.cpp can reuse its KV cache
+    prompt_prefix = f"{system_prompt}\n\n" if system_prompt else ""
+    reuse_prefix_state = LOCAL_LLM_REUSE_PREFIX_STATE and bool(prompt_prefix)
+    context_size = llm.n_ctx()
+    prompt_tokens = estimate_tokens(prompt_prefix + input_prompt, llm_model_name)
     adjusted_max_tokens = min(
         number_of_tokens_to_generate,
-        LOCAL_LLM_CONTEXT_SIZE_IN_TOKENS - prompt_tokens - TOKEN_BUFFER,
+        context_size - prompt_tokens - TOKEN_BUFFER,
     )
     if adjusted_max_tokens <= 0:
         logging.warning("Prompt is too long for LLM. Chunking the input.")
         chunks = chunk_text(
             input_prompt,
-            LOCAL_LLM_CONTEXT_SIZE_IN_TOKENS - TOKEN_CUSHION,
+            context_size
+            - TOKEN_CUSHION
+            - estimate_tokens(prompt_prefix, llm_model_name),
             llm_model_name,
         )
         results = []
         for chunk in chunks:
             try:
+                if reuse_prefix_state:
+                    restore_prefix_state(llm, llm_model_name, prompt_prefix)
                 output = llm(
-                    prompt=chunk,
-                    max_tokens=LOCAL_LLM_CONTEXT_SIZE_IN_TOKENS - TOKEN_CUSHION,
+                    prompt=prompt_prefix + chunk,
+                    max_tokens=context_size - TOKEN_CUSHION,
                     temperature=temperature,
                 )
                 results.append(output["choices"][0]["text"])
@@ -546,42 +2928,29 @@ async def generate_completion_from_local_llm(
                 logging.error(f"An error occurred while processing a chunk: {e}")
         return " ".join(results)
     else:
-        grammar_file_string_lower = (
-            grammar_file_string.lower() if grammar_file_string else ""
-        )
-        if grammar_file_string_lower:
-            list_of_grammar_files = glob.glob("./grammar_files/*.gbnf")
-            matching_grammar_files = [
-                x
-                for x in list_of_grammar_files
-                if grammar_file_string_lower
-                in os.path.splitext(os.path.basename(x).lower())[0]
-            ]
-            if len(matching_grammar_files) == 0:
-                logging.error(f"No grammar file found matching: {grammar_file_string}")
-                raise FileNotFoundError
-            grammar_file_path = max(matching_grammar_files, key=os.path.getmtime)
-            logging.info(f"Loading selected grammar file: '{grammar_file_path}'")
-            llama_grammar = LlamaGrammar.from_file(grammar_file_path)
-            output = llm(
-                prompt=input_prompt,
-                max_tokens=adjusted_max_tokens,
-                temperature=temperature,
-                grammar=llama_grammar,
-            )
-        else:
-            output = llm(
-                prompt=input_prompt,
-                max_tokens=adjusted_max_tokens,
-                temperature=temperature,
-            )
+        llama_grammar = None
+        if json_schema:
+            llama_grammar = get_json_schema_grammar(json_schema)
+        elif grammar_file_string:
+            llama_grammar = get_grammar_from_file(grammar_file_string)
+        start_time = time.perf_counter()
+        if reuse_prefix_state:
+            restore_prefix_state(llm, llm_model_name, prompt_prefix)
+        output = llm(
+            prompt=prompt_prefix + input_prompt,
+            max_tokens=adjusted_max_tokens,
+            temperature=temperature,
+            grammar=llama_grammar,
+        )
+        elapsed = time.perf_counter() - start_time
+        record_local_generation(llm, output, elapsed)
         generated_text = output["choices"][0]["text"]
         if grammar_file_string == "json":
             generated_text = generated_text.encode("unicode_escape").decode()
         finish_reason = str(output["choices"][0]["finish_reason"])
         llm_model_usage_json = json.dumps(output["usage"])
         logging.info(
-            f"Completed text completion in {output['usage']['total_time']:.2f} seconds. Beginning of generated text: \n'{generated_text[:150]}'..."
+            f"Completed text completion in {elapsed:.2f} seconds. Beginning of generated text: \n'{generated_text[:150]}'..."
         )
         return {
             "generated_text": generated_text,
@@ -590,39 +2959,898 @@ async def generate_completion_from_local_llm(
         }
 
 
-# Image Processing Functions
-def preprocess_image(image):
-    gray = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2GRAY)
-    gray = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)[1]
-    kernel = np.ones((1, 1), np.uint8)
-    gray = cv2.dilate(gray, kernel, iterations=1)
-    return Image.fromarray(gray)
+async def generate_completion_from_local_llm(
+    llm_model_name: str,
+    input_prompt: str,
+    number_of_tokens_to_generate: int = 100,
+    temperature: float = 0.7,
+    grammar_file_string: str = None,
+    system_prompt: Optional[str] = None,
+    json_schema: Optional[Dict] = None,
+):
+    start_time = time.perf_counter()
+    result = await local_inference_worker.submit(
+        run_local_completion,
+        llm_model_name,
+        input_prompt,
+        number_of_tokens_to_generate,
+        temperature,
+        grammar_file_string,
+        system_prompt,
+        json_schema,
+    )
+    if isinstance(result, dict):
+        # Recorded here rather than on the worker, where the job's context isn't set
+        usage = json.loads(result["llm_model_usage_json"])
+        record_completion_usage(
+            "LOCAL",
+            llm_model_name,
+            usage["prompt_tokens"],
+            usage["completion_tokens"],
+            latency=time.perf_counter() - start_time,
+        )
+    return result
+
+
+# Image Processing Functions
+def preprocess_image(image):
+    gray = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2GRAY)
+    gray = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)[1]
+    kernel = np.ones((1, 1), np.uint8)
+    gray = cv2.dilate(gray, kernel, iterations=1)
+    return Image.fromarray(gray)
+
+
+# Blocking Work and Event Loop Health
+blocking_executor = ThreadPoolExecutor(thread_name_prefix="ocr-worker")
+LOOP_LAG_WARNING_SECONDS = 1.0
+
+
+async def run_blocking(function, *args):
+    """Run a blocking call on the worker pool so the event loop keeps serving requests"""
+    return await asyncio.get_running_loop().run_in_executor(
+        blocking_executor, function, *args
+    )
+
+
+class EventLoopLagMonitor:
+    """Measures how late the event loop wakes up from a short sleep"""
+
+    def __init__(self, interval: float = 0.1, window: int = 600):
+        self.interval = interval
+        self.samples = deque(maxlen=window)
+        self.max_lag = 0.0
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while True:
+            start_time = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.perf_counter() - start_time - self.interval)
+            self.samples.append(lag)
+            event_loop_lag_seconds.observe(lag)
+            self.max_lag = max(self.max_lag, lag)
+            if lag > LOOP_LAG_WARNING_SECONDS:
+                logging.warning(f"Event loop was blocked for {lag * 1000:,.0f} ms")
+
+    def get_stats(self) -> Dict[str, float]:
+        samples = list(self.samples)
+        return {
+            "current_ms": samples[-1] * 1000 if samples else 0.0,
+            "mean_ms": statistics.mean(samples) * 1000 if samples else 0.0,
+            "p99_ms": float(np.percentile(samples, 99)) * 1000 if samples else 0.0,
+            "max_ms": self.max_lag * 1000,
+        }
+
+
+event_loop_lag_monitor = EventLoopLagMonitor()
+
+
+def convert_pdf_to_images(
+    input_pdf_file_path: str, max_pages: int = 0, skip_first_n_pages: int = 0
+) -> List[Image.Image]:
+    logging.info(f"Processing PDF file {input_pdf_file_path}")
+    if max_pages == 0:
+        last_page = None
+        logging.info("Converting all pages to images...")
+    else:
+        last_page = skip_first_n_pages + max_pages
+        logging.info(f"Converting pages {skip_first_n_pages + 1} to {last_page}")
+    first_page = skip_first_n_pages + 1  # pdf2image uses 1-based indexing
+    images = convert_from_path(
+        input_pdf_file_path, first_page=first_page, last_page=last_page
+    )
+    logging.info(f"Converted {len(images)} pages from PDF file to images.")
+    return images
+
+
+def ocr_image(image, languages=None):
+    if languages is None:
+        languages = DEFAULT_OCR_LANGUAGES.split("+")
+    with ocr_page_seconds.time():
+        preprocessed_image = preprocess_image(image)
+        lang_config = "+".join(languages)
+        text = pytesseract.image_to_string(preprocessed_image, lang=lang_config)
+    ocr_pages_total.inc()
+    return text
+
+
+# Header and Footer Detection
+PAGE_NUMBER_PATTERN = re.compile(
+    r"^[\s\-–—~.|•*]*((page|p\.|seite|стр\.?|страница)\s*)?(\d{1,4}|[ivxlcdm]{1,7})"
+    r"(\s*(of|/|von|из)\s*\d{1,4})?[\s\-–—~.|•*]*$",
+    flags=re.IGNORECASE,
+)
+ROMAN_NUMERAL_PATTERN = re.compile(
+    r"^m{0,3}(cm|cd|d?c{0,3})(xc|xl|l?x{0,3})(ix|iv|v?i{0,3})$", flags=re.IGNORECASE
+)
+ROMAN_NUMERAL_VALUES = {"i": 1, "v": 5, "x": 10, "l": 50, "c": 100, "d": 500, "m": 1000}
+HEADER_FOOTER_SCAN_LINES = 3  # Non-empty lines examined at the top and bottom of each page
+HEADER_FOOTER_MIN_PAGE_FRACTION = 0.3
+HEADER_FOOTER_MIN_PAGES = 3  # On two pages a repeated heading looks just like a running header
+HEADER_FOOTER_SIMILARITY = 0.85
+PAGE_NUMBER_MIN_PAGE_FRACTION = 0.5  # Page numbers must sit at the same margin slot on most pages
+PAGE_NUMBER_MIN_SEQUENTIAL_FRACTION = 0.5  # Share of neighbouring values that step like the pages
+
+
+def normalize_margin_line(line: str) -> str:
+    """Canonical form for comparing running headers: case, digits and spacing ignored"""
+    line = re.sub(r"\d+", "#", line.lower())
+    line = re.sub(r"\s+", " ", line)
+    return line.strip(" .-–—~|•*_")
+
+
+def parse_page_number(line: str) -> Optional[int]:
+    """The page number a margin line shows, if it looks like nothing but a page number"""
+    match = PAGE_NUMBER_PATTERN.match(line.strip())
+    if not match:
+        return None
+    number = match.group(3)
+    if number.isdigit():
+        return int(number)
+    if not ROMAN_NUMERAL_PATTERN.match(number):
+        return None
+    values = [ROMAN_NUMERAL_VALUES[c] for c in number.lower()]
+    return sum(
+        -value if i + 1 < len(values) and value < values[i + 1] else value
+        for i, value in enumerate(values)
+    )
+
+
+def find_page_number_lines(pages: List[List[str]]) -> set:
+    """
+    (page index, line index) of lines that are page numbers.
+
+    A candidate must sit at the same margin slot (e.g. last non-empty line) on
+    at least PAGE_NUMBER_MIN_PAGE_FRACTION of the pages, and its values must
+    step like the pages do, so words such as "did." or a short numeric table
+    row are never taken for page numbers. A candidate is kept only if its value
+    is in step with the candidate of a neighbouring page in the same slot.
+    """
+    slots: Dict[Tuple[str, int], List[Tuple[int, int, int]]] = {}
+    for page_index, lines in enumerate(pages):
+        non_empty = [i for i, line in enumerate(lines) if line.strip()]
+        margin_slots = {
+            line_index: ("bottom", rank)
+            for rank, line_index in enumerate(reversed(non_empty[-HEADER_FOOTER_SCAN_LINES:]))
+        }
+        margin_slots.update(
+            {line_index: ("top", rank) for rank, line_index in enumerate(non_empty[:HEADER_FOOTER_SCAN_LINES])}
+        )
+        for line_index, slot in margin_slots.items():
+            value = parse_page_number(lines[line_index])
+            if value is not None:
+                slots.setdefault(slot, []).append((page_index, line_index, value))
+
+    min_pages = max(2, math.ceil(PAGE_NUMBER_MIN_PAGE_FRACTION * len(pages)))
+    page_number_lines = set()
+    for candidates in slots.values():
+        if len(candidates) < min_pages:
+            continue
+        in_step = [
+            0 < next_value - value == next_page - page
+            for (page, _, value), (next_page, _, next_value) in zip(candidates, candidates[1:])
+        ]
+        if sum(in_step) < PAGE_NUMBER_MIN_SEQUENTIAL_FRACTION * len(in_step):
+            continue
+        for i, (page_index, line_index, _) in enumerate(candidates):
+            if (i > 0 and in_step[i - 1]) or (i < len(in_step) and in_step[i]):
+                page_number_lines.add((page_index, line_index))
+    return page_number_lines
+
+
+def get_margin_line_indices(lines: List[str]) -> Dict[int, str]:
+    """Map line index -> "top" or "bottom" for the lines in a page's margins"""
+    non_empty = [i for i, line in enumerate(lines) if line.strip()]
+    margins = {i: "bottom" for i in non_empty[-HEADER_FOOTER_SCAN_LINES:]}
+    margins.update({i: "top" for i in non_empty[:HEADER_FOOTER_SCAN_LINES]})
+    return margins
+
+
+def strip_headers_and_footers(
+    list_of_extracted_text_strings: List[str],
+    suppress_headers_and_page_numbers: bool = True,
+) -> Tuple[List[str], Dict[str, int]]:
+    """
+    Find running headers, footers and page numbers across pages and remove them.
+
+    Only the first and last few non-empty lines of each page are considered. A line
+    is a running header/footer when a fuzzy match of it (digits ignored, so "Page 3
+    of 9" matches "Page 4 of 9") appears in the margins of at least
+    HEADER_FOOTER_MIN_PAGE_FRACTION of the pages, and of no fewer than
+    HEADER_FOOTER_MIN_PAGES; standalone page numbers need
+    the evidence described in find_page_number_lines. Matching lines are
+    dropped, or kept as blockquotes when suppress_headers_and_page_numbers is False.
+    """
+    pages = [page.split("\n") for page in list_of_extracted_text_strings]
+    margin_lines = [get_margin_line_indices(lines) for lines in pages]
+    page_number_lines = find_page_number_lines(pages)
+
+    # Cluster similar margin lines (separately for top and bottom margins) and
+    # record which pages each cluster occurs on
+    clusters: List[Tuple[str, str, set]] = []
+    line_clusters: Dict[Tuple[int, int], int] = {}
+    for page_index, (lines, margins) in enumerate(zip(pages, margin_lines)):
+        for line_index, position in margins.items():
+            normalized = normalize_margin_line(lines[line_index])
+            if len(normalized) < 4:
+                continue
+            for cluster_index, (cluster_position, representative, cluster_pages) in enumerate(clusters):
+                if cluster_position == position and (
+                    normalized == representative
+                    or difflib.SequenceMatcher(None, normalized, representative).ratio()
+                    >= HEADER_FOOTER_SIMILARITY
+                ):
+                    cluster_pages.add(page_index)
+                    break
+            else:
+                clusters.append((position, normalized, {page_index}))
+                cluster_index = len(clusters) - 1
+            line_clusters[(page_index, line_index)] = cluster_index
+
+    min_pages = max(HEADER_FOOTER_MIN_PAGES, math.ceil(HEADER_FOOTER_MIN_PAGE_FRACTION * len(pages)))
+    repeated_clusters = {
+        i for i, (_, _, cluster_pages) in enumerate(clusters) if len(cluster_pages) >= min_pages
+    }
+
+    stats = {"page_numbers": 0, "running_lines": 0}
+    cleaned_pages = []
+    for page_index, (lines, indices) in enumerate(zip(pages, margin_lines)):
+        to_strip = set()
+        for line_index in indices:
+            if (page_index, line_index) in page_number_lines:
+                to_strip.add(line_index)
+                stats["page_numbers"] += 1
+            elif line_clusters.get((page_index, line_index)) in repeated_clusters:
+                to_strip.add(line_index)
+                stats["running_lines"] += 1
+        cleaned_lines = []
+        for line_index, line in enumerate(lines):
+            if line_index not in to_strip:
+                cleaned_lines.append(line)
+            elif not suppress_headers_and_page_numbers:
+                # Keep it as its own blockquote paragraph so normalization doesn't merge it
+                cleaned_lines.extend(["", f"> {line.strip()}", ""])
+        cleaned_pages.append("\n".join(cleaned_lines))
+
+    logging.info(
+        f"Header/footer detection: {stats['running_lines']:,} running header/footer lines and "
+        f"{stats['page_numbers']:,} page numbers {'removed' if suppress_headers_and_page_numbers else 'tagged'} "
+        f"across {len(pages):,} pages"
+    )
+    return cleaned_pages, stats
+
+
+# Text Normalization Functions
+wordlist_cache: Dict[Tuple[str, ...], Dict[str, int]] = {}
+LIST_ITEM_PATTERN = re.compile(r"^\s*([-*•▪]|\d{1,3}[.)]|\([0-9a-zA-Z]{1,3}\))\s+")
+HEADING_MARKER_PATTERN = re.compile(r"^(#{1,6}|§+)\s")
+NUMERIC_CELL_PATTERN = re.compile(r"^[(\-+$€£]*\d[\d.,:/]*[)%]?$")
+HEADING_MAX_WORDS = 8
+HYPHENATED_LINE_BREAK_PATTERN = re.compile(
+    r"(\w+)-[ \t]*\n[ \t]*(\w+)", flags=re.UNICODE
+)
+HYPHENATED_COMPOUND_PATTERN = re.compile(r"\w+(?:-\w+)+", flags=re.UNICODE)
+
+
+def load_wordlist(languages: List[str]) -> Dict[str, int]:
+    """
+    Load lowercase word frequencies for the given Tesseract language codes.
+
+    Reads DICTIONARY_DIR/<lang>.txt (plain word lists or SymSpell-style "word count"
+    frequency lists) and falls back to the system word list for English. Missing
+    dictionaries are skipped, so the result may be empty.
+    """
+    key = tuple(sorted(languages))
+    if key in wordlist_cache:
+        return wordlist_cache[key]
+    dictionary_dir = DICTIONARY_DIR
+    if not os.path.isabs(dictionary_dir):
+        dictionary_dir = os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), dictionary_dir
+        )
+    words: Dict[str, int] = {}
+    for language in languages:
+        path = os.path.join(dictionary_dir, f"{language}.txt")
+        if not os.path.exists(path) and language == "eng":
+            path = SYSTEM_WORDLIST_PATH
+        if not os.path.exists(path):
+            logging.info(f"No dictionary found for OCR language '{language}'")
+            continue
+        with open(path, "r", encoding="utf-8", errors="ignore") as f:
+            for line in f:
+                parts = line.split()
+                if not parts:
+                    continue
+                count = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 1
+                word = parts[0].lower()
+                words[word] = words.get(word, 0) + count
+        logging.info(f"Loaded dictionary for '{language}' from {path}")
+    wordlist_cache[key] = words
+    return words
+
+
+def count_document_words(text: str) -> Dict[str, int]:
+    """
+    Lowercase word and hyphenated-compound counts for de-hyphenation.
+
+    The halves of words split at a line break ("com-\npound") are left out, or
+    every split would look like a compound of two known words. Compounds are
+    counted per adjacent pair, so "mother-in-law" also counts "in-law".
+    """
+    text = HYPHENATED_LINE_BREAK_PATTERN.sub(" ", text.replace("\r", "")).lower()
+    counts: Dict[str, int] = {}
+    for word in re.findall(r"\w+", text):
+        counts[word] = counts.get(word, 0) + 1
+    for compound in HYPHENATED_COMPOUND_PATTERN.findall(text):
+        parts = compound.split("-")
+        for first, second in zip(parts, parts[1:]):
+            pair = f"{first}-{second}"
+            counts[pair] = counts.get(pair, 0) + 1
+    return counts
+
+
+def dehyphenate(text: str, vocabulary: Dict[str, int]) -> str:
+    """Rejoin words split by a hyphen at a line break ("cor-\nrect" -> "correct")"""
+
+    def rejoin(match: re.Match) -> str:
+        first, second = match.group(1), match.group(2)
+        joined = first + second
+        hyphenated = f"{first}-{second}"
+        # Only a compound the text also writes with a hyphen elsewhere keeps it;
+        # typographic hyphenation is by far the common case
+        if vocabulary.get(hyphenated.lower(), 0) > vocabulary.get(joined.lower(), 0):
+            return hyphenated
+        return joined
+
+    return HYPHENATED_LINE_BREAK_PATTERN.sub(rejoin, text)
+
+
+def is_table_row(line: str) -> bool:
+    """Pipe-delimited cells, or a row made up mostly of numbers"""
+    if line.count("|") >= 2:
+        return True
+    if line[-1] in ".,;:!?":  # The end of a sentence that mentions numbers
+        return False
+    cells = line.split()
+    numeric = sum(1 for cell in cells if NUMERIC_CELL_PATTERN.match(cell))
+    return numeric >= 2 and numeric * 2 >= len(cells)
+
+
+def is_heading_line(line: str) -> bool:
+    """A markdown/section marker, or a short line in capitals such as "CHAPTER TWO" """
+    if HEADING_MARKER_PATTERN.match(line):
+        return True
+    letters = [c for c in line if c.isalpha()]
+    return (
+        len(letters) >= 4
+        and line[-1] not in ",;"
+        and len(line.split()) <= HEADING_MAX_WORDS
+        and all(c.isupper() for c in letters)
+    )
+
+
+def unwrap_paragraph_lines(text: str) -> str:
+    """
+    Join hard-wrapped lines inside each paragraph.
+
+    List items, table rows and headings stay on their own lines, and nothing
+    is joined onto a table row or heading.
+    """
+    paragraphs = re.split(r"\n[ \t]*\n", text)
+    unwrapped = []
+    for paragraph in paragraphs:
+        lines = [line.strip() for line in paragraph.split("\n") if line.strip()]
+        if not lines:
+            continue
+        merged = [lines[0]]
+        table_rows = [is_table_row(line) for line in lines]
+        standalone = [
+            is_row or is_heading_line(line) for line, is_row in zip(lines, table_rows)
+        ]
+        for i in range(1, len(lines)):
+            line = lines[i]
+            if (
+                LIST_ITEM_PATTERN.match(line)
+                or standalone[i]
+                or standalone[i - 1]
+                or (i + 1 < len(lines) and table_rows[i + 1])  # A table's header row
+            ):
+                merged.append(line)
+            else:
+                merged[-1] = f"{merged[-1]} {line}"
+        unwrapped.append("\n".join(merged))
+    return "\n\n".join(unwrapped)
+
+
+def compact_whitespace(text: str) -> str:
+    text = text.replace("\r\n", "\n").replace("\r", "\n").replace("\f", "\n\n")
+    text = re.sub(r"[ \t\u00a0]+", " ", text)
+    text = re.sub(r" *\n *", "\n", text)
+    text = re.sub(r"\n{3,}", "\n\n", text)
+    return text.strip()
+
+
+def normalize_ocr_text(text: str, vocabulary: Dict[str, int]) -> str:
+    text = compact_whitespace(text)
+    text = dehyphenate(text, vocabulary)
+    text = unwrap_paragraph_lines(text)
+    return compact_whitespace(text)
+
+
+def get_active_model_name() -> str:
+    return get_provider_model(get_default_provider())
+
+
+def normalize_extracted_pages(
+    list_of_extracted_text_strings: List[str], languages: List[str]
+) -> Tuple[List[str], Dict[str, int]]:
+    """
+    Deterministic cleanup of raw Tesseract pages before they reach the LLM.
+
+    Words the document itself uses unhyphenated count as known words, so
+    de-hyphenation works even without an installed dictionary. Returns the
+    normalized pages and a token report for the active model.
+    """
+    vocabulary = dict(load_wordlist(languages))
+    for word, count in count_document_words("\n\n".join(list_of_extracted_text_strings)).items():
+        vocabulary[word] = vocabulary.get(word, 0) + count
+    normalized_pages = [
+        normalize_ocr_text(page, vocabulary) for page in list_of_extracted_text_strings
+    ]
+    model_name = get_active_model_name()
+    tokens_before = estimate_tokens("\n\n".join(list_of_extracted_text_strings), model_name)
+    tokens_after = estimate_tokens("\n\n".join(normalized_pages), model_name)
+    report = {
+        "tokens_before": tokens_before,
+        "tokens_after": tokens_after,
+        "tokens_saved": tokens_before - tokens_after,
+    }
+    logging.info(
+        f"Normalized OCR text: {tokens_before:,} -> {tokens_after:,} tokens "
+        f"({report['tokens_saved']:,} fewer input and output tokens per LLM pass)"
+    )
+    return normalized_pages, report
+
+
+# Local Spell Correction
+# (OCR output, intended text) pairs that cost half an edit in ocr_weighted_distance
+OCR_CONFUSIONS = [
+    ("rn", "m"),
+    ("m", "rn"),
+    ("cl", "d"),
+    ("vv", "w"),
+    ("li", "h"),
+    ("ii", "u"),
+    ("l", "1"),
+    ("1", "l"),
+    ("l", "i"),
+    ("i", "l"),
+    ("1", "i"),
+    ("0", "o"),
+    ("o", "0"),
+    ("5", "s"),
+    ("s", "5"),
+    ("8", "b"),
+    ("6", "b"),
+    ("e", "c"),
+    ("c", "e"),
+    ("n", "u"),
+    ("u", "n"),
+    ("f", "t"),
+    ("t", "f"),
+]
+OCR_CONFUSION_COST = 0.5
+SPELL_TOKEN_PATTERN = re.compile(r"[^\W_]+", flags=re.UNICODE)
+# Numbers with a unit or ordinal suffix ("10th", "5kg") and names ending in a number ("Win32")
+ALPHANUMERIC_TERM_PATTERN = re.compile(
+    r"^(\d+(st|nd|rd|th)|\d{2,}[^\W\d_]+|[^\W\d_]+\d{2,})$", flags=re.UNICODE
+)
+
+
+def ocr_weighted_distance(
+    ocr_word: str, candidate: str, confusion_cost: float = OCR_CONFUSION_COST
+) -> float:
+    """Damerau-Levenshtein distance where common OCR confusions cost confusion_cost"""
+    rows, cols = len(ocr_word) + 1, len(candidate) + 1
+    dp = [[0.0] * cols for _ in range(rows)]
+    for i in range(rows):
+        dp[i][0] = float(i)
+    for j in range(cols):
+        dp[0][j] = float(j)
+    for i in range(1, rows):
+        for j in range(1, cols):
+            a, b = ocr_word[i - 1], candidate[j - 1]
+            best = min(
+                dp[i - 1][j] + 1,
+                dp[i][j - 1] + 1,
+                dp[i - 1][j - 1] + (0 if a == b else 1),
+            )
+            if i > 1 and j > 1 and a == candidate[j - 2] and ocr_word[i - 2] == b:
+                best = min(best, dp[i - 2][j - 2] + 1)
+            for source, target in OCR_CONFUSIONS:
+                si, tj = i - len(source), j - len(target)
+                if (
+                    si >= 0
+                    and tj >= 0
+                    and ocr_word[si:i] == source
+                    and candidate[tj:j] == target
+                ):
+                    best = min(best, dp[si][tj] + confusion_cost)
+            dp[i][j] = best
+    return dp[-1][-1]
+
+
+def is_ocr_confusion(ocr_word: str, candidate: str) -> bool:
+    """True if the correction only undoes known OCR confusions (rn/m, l/1, 0/o, ...)"""
+    return ocr_word != candidate and ocr_weighted_distance(ocr_word, candidate, 0.0) == 0.0
+
+
+def is_sentence_initial(text: str, start: int) -> bool:
+    """Whether the word at start begins the text, a paragraph or a sentence"""
+    prefix = text[max(0, start - 20) : start]
+    stripped = prefix.rstrip()
+    if not stripped:
+        return start <= 20 or "\n\n" in prefix
+    if "\n\n" in prefix[len(stripped) :]:
+        return True
+    return stripped.rstrip("\"'”’)]*")[-1:] in (".", "!", "?", ":", "")
+
+
+def get_document_vocabulary(text: str, min_count: int) -> set:
+    """Lowercase words that occur at least min_count times in the text"""
+    counts: Dict[str, int] = {}
+    for token in SPELL_TOKEN_PATTERN.findall(text.lower()):
+        counts[token] = counts.get(token, 0) + 1
+    return {token for token, count in counts.items() if count >= min_count}
+
+
+class SymSpellCorrector:
+    """
+    Symmetric-delete spelling corrector for mechanical OCR errors.
+
+    Every dictionary word is indexed under all strings reachable by deleting up to
+    max_edit_distance characters from its prefix, so looking up a word only needs
+    the deletes of that word rather than a scan of the dictionary. Candidates are
+    ranked by ocr_weighted_distance, then by word frequency.
+
+    Only ordinary words are corrected: capitalized words in mid-sentence (names,
+    places, brands) and alphanumeric terms are left alone, since the dictionary
+    can't vouch for them. A word with a stray digit ("t1me") is corrected only if
+    the digit is a known OCR confusion.
+    """
+
+    def __init__(
+        self, words: Dict[str, int], max_edit_distance: int = 2, prefix_length: int = 7
+    ):
+        self.words = words
+        self.max_edit_distance = max_edit_distance
+        self.prefix_length = prefix_length
+        self.deletes: Dict[str, List[str]] = {}
+        for word in words:
+            if word.isalpha():
+                for variant in self._edits(word[:prefix_length]):
+                    self.deletes.setdefault(variant, []).append(word)
+        logging.info(
+            f"Built symmetric-delete index: {len(words):,} words, {len(self.deletes):,} delete variants"
+        )
+
+    def _edits(self, word: str) -> set:
+        variants = {word}
+        frontier = {word}
+        for _ in range(self.max_edit_distance):
+            frontier = {
+                w[:i] + w[i + 1 :] for w in frontier if len(w) > 1 for i in range(len(w))
+            }
+            variants |= frontier
+        return variants
+
+    def lookup(self, word: str) -> Optional[str]:
+        """Best dictionary match for a lowercase word, or None if nothing is close enough"""
+        if word in self.words:
+            return word
+        candidates = set()
+        for variant in self._edits(word[: self.prefix_length]):
+            candidates.update(self.deletes.get(variant, ()))
+        # At most one full edit, or two OCR confusions
+        max_distance = 1.0
+        best, best_key = None, None
+        for candidate in candidates:
+            if abs(len(candidate) - len(word)) > self.max_edit_distance:
+                continue
+            distance = ocr_weighted_distance(word, candidate)
+            if distance > max_distance:
+                continue
+            key = (distance, -self.words[candidate])
+            if best_key is None or key < best_key:
+                best, best_key = candidate, key
+        return best
+
+    def correct_text(
+        self, text: str, known_words: Optional[set] = None
+    ) -> Tuple[str, Dict[str, float]]:
+        """
+        Correct unknown words; returns the text and stats.
+
+        known_words (lowercase) are accepted as spelled, e.g. names that recur in
+        the document. "uncertain_corrections" counts corrections that are not
+        explained by OCR confusions alone; a chunk with any should still be
+        reviewed by the LLM.
+        """
+        known_words = known_words or set()
+        stats = {"words": 0, "corrected": 0, "unknown": 0, "uncertain_corrections": 0}
+
+        def replace(match: re.Match) -> str:
+            token = match.group(0)
+            if token.isdigit() or len(token) < 2:
+                return token
+            stats["words"] += 1
+            lower = token.lower()
+            if lower in self.words or lower in known_words:
+                return token
+            digits = sum(c.isdigit() for c in token)
+            # Acronyms, alphanumeric terms and mid-sentence names are left for the LLM
+            if (
+                len(token) < 3
+                or (token.isupper() and len(token) <= 5)
+                or (digits and (digits * 2 > len(token) or ALPHANUMERIC_TERM_PATTERN.match(token)))
+                or (token[0].isupper() and not is_sentence_initial(text, match.start()))
+            ):
+                stats["unknown"] += 1
+                return token
+            suggestion = self.lookup(lower)
+            # A digit may only be replaced as an OCR confusion ("1ike" -> "like")
+            if suggestion is None or (digits and not is_ocr_confusion(lower, suggestion)):
+                stats["unknown"] += 1
+                return token
+            stats["corrected"] += 1
+            if not is_ocr_confusion(lower, suggestion):
+                stats["uncertain_corrections"] += 1
+            if token.isupper():
+                return suggestion.upper()
+            if token[0].isupper():
+                return suggestion.capitalize()
+            return suggestion
+
+        corrected_text = SPELL_TOKEN_PATTERN.sub(replace, text)
+        stats["residual_error_rate"] = (
+            stats["unknown"] / stats["words"] if stats["words"] else 0.0
+        )
+        return corrected_text, stats
+
+
+spell_corrector_cache: Dict[Tuple[str, ...], Optional[SymSpellCorrector]] = {}
+
+
+def get_spell_corrector(languages: List[str]) -> Optional[SymSpellCorrector]:
+    """Build (once per language set) a corrector over the languages' dictionaries"""
+    key = tuple(sorted(languages))
+    if key not in spell_corrector_cache:
+        words = load_wordlist(languages)
+        if not words:
+            logging.warning(
+                f"No dictionaries found in {DICTIONARY_DIR} for {'+'.join(languages)}; local spell correction disabled"
+            )
+            spell_corrector_cache[key] = None
+        else:
+            spell_corrector_cache[key] = SymSpellCorrector(
+                words, LOCAL_SPELL_MAX_EDIT_DISTANCE
+            )
+    return spell_corrector_cache[key]
+
+
+# Prompt Templates
+# The instructions are static per job and sent as a system prompt ahead of the
+# chunk, giving every request an identical prefix that providers can cache.
+OCR_CORRECTION_SYSTEM_PROMPT = """Correct OCR-induced errors in the text, ensuring it flows coherently with the previous context. Follow these guidelines:
+
+1. Fix OCR-induced typos and errors:
+   - Correct words split across line breaks
+   - Fix common OCR errors (e.g., 'rn' misread as 'm')
+   - Use context and common sense to correct errors
+   - Only fix clear errors, don't alter the content unnecessarily
+   - Do not add extra periods or any unnecessary punctuation
+
+2. Maintain original structure:
+   - Keep all headings and subheadings intact
+
+3. Preserve original content:
+   - Keep all important information from the original text
+   - Do not add any new information not present in the original text
+   - Remove unnecessary line breaks within sentences or paragraphs
+   - Maintain paragraph breaks
+   
+4. Maintain coherence:
+   - Ensure the content connects smoothly with the previous context
+   - Handle text that starts or ends mid-sentence appropriately
+
+IMPORTANT: Respond ONLY with the corrected text. Preserve all original formatting, including line breaks. Do not include any introduction, explanation, or metadata."""
+
+MARKDOWN_FORMATTING_SYSTEM_PROMPT = """Reformat the following text as markdown, improving readability while preserving the original structure. Follow these guidelines:
+1. Preserve all original headings, converting them to appropriate markdown heading levels (# for main titles, ## for subtitles, etc.)
+   - Ensure each heading is on its own line
+   - Add a blank line before and after each heading
+2. Maintain the original paragraph structure. Remove all breaks within a word that should be a single word (for example, "cor- rect" should be "correct")
+3. Format lists properly (unordered or ordered) if they exist in the original text
+4. Use emphasis (*italic*) and strong emphasis (**bold**) where appropriate, based on the original formatting
+5. Preserve all original content and meaning
+6. Do not add any extra punctuation or modify the existing punctuation
+7. Remove any spuriously inserted introductory text such as "Here is the corrected text:" that may have been added by the LLM and which is obviously not part of the original text.
+8. {header_instruction}
+
+Respond ONLY with the reformatted markdown."""
+
+SINGLE_PASS_SYSTEM_PROMPT = """Correct OCR-induced errors in the text and reformat it as markdown, improving readability while preserving the original structure. Follow these guidelines:
+
+1. Fix OCR-induced typos and errors:
+   - Correct words split across line breaks (for example, "cor- rect" should be "correct")
+   - Fix common OCR errors (e.g., 'rn' misread as 'm')
+   - Use context and common sense to correct errors
+   - Only fix clear errors, don't alter the content unnecessarily
+   - Do not add extra periods or any unnecessary punctuation
+
+2. Preserve original content:
+   - Keep all important information from the original text
+   - Do not add any new information not present in the original text
+   - Remove unnecessary line breaks within sentences or paragraphs
+   - Maintain paragraph breaks
+   - Handle text that starts or ends mid-sentence appropriately
+
+3. Format as markdown:
+   - Convert headings to appropriate markdown heading levels (# for main titles, ## for subtitles, etc.), each on its own line with a blank line before and after
+   - Format lists properly (unordered or ordered) if they exist in the original text
+   - Use emphasis (*italic*) and strong emphasis (**bold**) where appropriate, based on the original formatting
+   - {header_instruction}
+
+IMPORTANT: Respond ONLY with the corrected markdown. Do not include any introduction, explanation, or metadata."""
+
+
+EDIT_LIST_SYSTEM_PROMPT = """Find OCR-induced errors in the text and list the corrections needed, instead of rewriting the text. Follow these guidelines:
+
+1. Only correct clear OCR errors:
+   - Misrecognized characters (e.g., 'rn' misread as 'm', 'l' misread as '1', '0' misread as 'O')
+   - Words split across line breaks (e.g., "cor-\nrect" should become "correct")
+   - Garbled words whose intended spelling is obvious from context
+   - Do not rephrase, restyle or add content, and do not change punctuation unless it is an OCR artifact
+
+2. Describe each correction as an object with two fields:
+   - "original": text copied EXACTLY from the chunk, including enough surrounding words to occur only once
+   - "replacement": what that text should be instead
+   - List corrections in the order they appear in the chunk, without overlaps
+
+IMPORTANT: Respond ONLY with a JSON object listing the corrections, for example:
+{"edits": [{"original": "the cornpany's right", "replacement": "the company's right"}]}
+If there is nothing to correct, respond with {"edits": []}."""
+
+
+def get_header_instruction(suppress_headers_and_page_numbers: bool) -> str:
+    if STRIP_HEADERS_AND_FOOTERS:
+        # Running headers, footers and page numbers were handled before chunking
+        return "Keep any blockquoted lines exactly as they are."
+    if suppress_headers_and_page_numbers:
+        return "Carefully remove headers, footers, and page numbers while preserving all other content."
+    return "Identify but do not remove headers, footers, or page numbers. Instead, format them distinctly, e.g., as blockquotes."
+
+
+def parse_edit_list(response: Optional[Dict]) -> Optional[List[Tuple[str, str]]]:
+    """Read the {"original", "replacement"} pairs of an EDIT_LIST_SCHEMA response; None if malformed"""
+    items = response.get("edits") if response else None
+    if not isinstance(items, list):
+        return None
+    edits = []
+    for item in items:
+        if not isinstance(item, dict):
+            return None
+        original, replacement = item.get("original"), item.get("replacement")
+        if not isinstance(original, str) or not isinstance(replacement, str):
+            return None
+        if original and original != replacement:
+            edits.append((original, replacement))
+    return edits
+
 
+def apply_edit_list(text: str, edits: List[Tuple[str, str]]) -> Optional[str]:
+    """
+    Apply (original, replacement) edits to text; None if any edit does not apply cleanly.
 
-def convert_pdf_to_images(
-    input_pdf_file_path: str, max_pages: int = 0, skip_first_n_pages: int = 0
-) -> List[Image.Image]:
-    logging.info(f"Processing PDF file {input_pdf_file_path}")
-    if max_pages == 0:
-        last_page = None
-        logging.info("Converting all pages to images...")
-    else:
-        last_page = skip_first_n_pages + max_pages
-        logging.info(f"Converting pages {skip_first_n_pages + 1} to {last_page}")
-    first_page = skip_first_n_pages + 1  # pdf2image uses 1-based indexing
-    images = convert_from_path(
-        input_pdf_file_path, first_page=first_page, last_page=last_page
-    )
-    logging.info(f"Converted {len(images)} pages from PDF file to images.")
-    return images
+    Whitespace inside an original span matches any whitespace run, since models
+    tend to quote hard OCR line breaks as spaces. Each span is located at or after
+    the previous edit, and spans must not overlap.
+    """
+    spans = []
+    cursor = 0
+    for original, replacement in edits:
+        pattern = r"\s+".join(re.escape(part) for part in original.split())
+        if not pattern:
+            return None
+        matches = list(re.finditer(pattern, text))
+        if not matches:
+            return None
+        following = [m for m in matches if m.start() >= cursor]
+        if following:
+            match = following[0]
+        elif len(matches) == 1:
+            match = matches[0]
+        else:
+            return None
+        spans.append((match.start(), match.end(), replacement))
+        cursor = match.end()
+    spans.sort()
+    for (_, prev_end, _), (next_start, _, _) in zip(spans, spans[1:]):
+        if next_start < prev_end:
+            return None
+    parts = []
+    position = 0
+    for start, end, replacement in spans:
+        parts.append(text[position:start])
+        parts.append(replacement)
+        position = end
+    parts.append(text[position:])
+    return "".join(parts)
 
 
-def ocr_image(image, languages=None):
-    if languages is None:
-        languages = DEFAULT_OCR_LANGUAGES.split("+")
-    preprocessed_image = preprocess_image(image)
-    lang_config = "+".join(languages)
-    return pytesseract.image_to_string(preprocessed_image, lang=lang_config)
+async def correct_chunk_with_edit_list(
+    chunk: str,
+    chunk_index: int,
+    total_chunks: int,
+    provider: Optional[str] = None,
+    model: Optional[str] = None,
+) -> Optional[str]:
+    """Ask for a compact list of edits and apply it locally; None if it can't be applied"""
+    edit_list_prompt = f"""Chunk to check:
+{chunk}
+
+Corrections (JSON):
+"""
+    response = await generate_structured_completion(
+        edit_list_prompt,
+        EDIT_LIST_SCHEMA,
+        max_tokens=get_output_token_budget(chunk, provider, model, ratio=1.0),
+        system_prompt=EDIT_LIST_SYSTEM_PROMPT,
+        provider=provider,
+        model=model,
+    )
+    edits = parse_edit_list(response)
+    if edits is None:
+        logging.warning(
+            f"Chunk {chunk_index + 1}/{total_chunks}: could not parse edit list, falling back to full rewrite"
+        )
+        return None
+    corrected_chunk = apply_edit_list(chunk, edits)
+    if corrected_chunk is None:
+        logging.warning(
+            f"Chunk {chunk_index + 1}/{total_chunks}: edit list did not apply cleanly, falling back to full rewrite"
+        )
+        return None
+    logging.info(
+        f"Chunk {chunk_index + 1}/{total_chunks}: applied {len(edits)} edits "
+        f"({len(json.dumps(response)):,} output characters for a {len(chunk):,}-character chunk)"
+    )
+    return corrected_chunk
 
 
 async def process_chunk(
@@ -632,37 +3860,60 @@ async def process_chunk(
     total_chunks: int,
     reformat_as_markdown: bool,
     suppress_headers_and_page_numbers: bool,
+    correction_mode: str = CORRECTION_MODE,
+    skip_llm_correction: bool = False,
+    provider: Optional[str] = None,
+    model: Optional[str] = None,
 ) -> Tuple[str, str]:
     logging.info(
         f"Processing chunk {chunk_index + 1}/{total_chunks} (length: {len(chunk):,} characters)"
     )
+    header_instruction = get_header_instruction(suppress_headers_and_page_numbers)
 
-    # Step 1: OCR Correction
-    ocr_correction_prompt = f"""Correct OCR-induced errors in the text, ensuring it flows coherently with the previous context. Follow these guidelines:
-
-1. Fix OCR-induced typos and errors:
-   - Correct words split across line breaks
-   - Fix common OCR errors (e.g., 'rn' misread as 'm')
-   - Use context and common sense to correct errors
-   - Only fix clear errors, don't alter the content unnecessarily
-   - Do not add extra periods or any unnecessary punctuation
+    if (
+        reformat_as_markdown
+        and correction_mode == "SINGLE_PASS"
+        and not skip_llm_correction
+    ):
+        # Correction and markdown formatting in a single round-trip
+        combined_prompt = f"""Previous context:
+{prev_context[-500:]}
 
-2. Maintain original structure:
-   - Keep all headings and subheadings intact
+Current chunk to process:
+{chunk}
 
-3. Preserve original content:
-   - Keep all important information from the original text
-   - Do not add any new information not present in the original text
-   - Remove unnecessary line breaks within sentences or paragraphs
-   - Maintain paragraph breaks
-   
-4. Maintain coherence:
-   - Ensure the content connects smoothly with the previous context
-   - Handle text that starts or ends mid-sentence appropriately
+Corrected markdown:
+"""
+        processed_chunk = await generate_completion(
+            combined_prompt,
+            max_tokens=get_output_token_budget(chunk, provider, model),
+            system_prompt=SINGLE_PASS_SYSTEM_PROMPT.format(
+                header_instruction=header_instruction
+            ),
+            provider=provider,
+            model=model,
+        )
+        processed_chunk = processed_chunk or ""
+        new_context = processed_chunk[-1000:]
+        logging.info(
+            f"Chunk {chunk_index + 1}/{total_chunks} processed in a single pass. Output length: {len(processed_chunk):,} characters"
+        )
+        return processed_chunk, new_context
 
-IMPORTANT: Respond ONLY with the corrected text. Preserve all original formatting, including line breaks. Do not include any introduction, explanation, or metadata.
+    # Step 1: OCR Correction
+    ocr_corrected_chunk = None
+    if skip_llm_correction:
+        logging.info(
+            f"Chunk {chunk_index + 1}/{total_chunks}: local spell correction left few unknown words, skipping LLM correction"
+        )
+        ocr_corrected_chunk = chunk
+    elif correction_mode == "EDIT_LIST":
+        ocr_corrected_chunk = await correct_chunk_with_edit_list(
+            chunk, chunk_index, total_chunks, provider, model
+        )
 
-Previous context:
+    if ocr_corrected_chunk is None:
+        ocr_correction_prompt = f"""Previous context:
 {prev_context[-500:]}
 
 Current chunk to process:
@@ -671,43 +3922,34 @@ Current chunk to process:
 Corrected text:
 """
 
-    ocr_corrected_chunk = await generate_completion(
-        ocr_correction_prompt, max_tokens=len(chunk) + 500
-    )
+        ocr_corrected_chunk = await generate_completion(
+            ocr_correction_prompt,
+            max_tokens=get_output_token_budget(chunk, provider, model),
+            system_prompt=OCR_CORRECTION_SYSTEM_PROMPT,
+            provider=provider,
+            model=model,
+        )
 
-    processed_chunk = ocr_corrected_chunk
+    processed_chunk = ocr_corrected_chunk or ""
 
     # Step 2: Markdown Formatting (if requested)
-    if reformat_as_markdown:
-        markdown_prompt = f"""Reformat the following text as markdown, improving readability while preserving the original structure. Follow these guidelines:
-1. Preserve all original headings, converting them to appropriate markdown heading levels (# for main titles, ## for subtitles, etc.)
-   - Ensure each heading is on its own line
-   - Add a blank line before and after each heading
-2. Maintain the original paragraph structure. Remove all breaks within a word that should be a single word (for example, "cor- rect" should be "correct")
-3. Format lists properly (unordered or ordered) if they exist in the original text
-4. Use emphasis (*italic*) and strong emphasis (**bold**) where appropriate, based on the original formatting
-5. Preserve all original content and meaning
-6. Do not add any extra punctuation or modify the existing punctuation
-7. Remove any spuriously inserted introductory text such as "Here is the corrected text:" that may have been added by the LLM and which is obviously not part of the original text.
-8. Remove any obviously duplicated content that appears to have been accidentally included twice. Follow these strict guidelines:
-   - Remove only exact or near-exact repeated paragraphs or sections within the main chunk.
-   - Consider the context (before and after the main chunk) to identify duplicates that span chunk boundaries.
-   - Do not remove content that is simply similar but conveys different information.
-   - Preserve all unique content, even if it seems redundant.
-   - Ensure the text flows smoothly after removal.
-   - Do not add any new content or explanations.
-   - If no obvious duplicates are found, return the main chunk unchanged.
-9. {"Identify but do not remove headers, footers, or page numbers. Instead, format them distinctly, e.g., as blockquotes." if not suppress_headers_and_page_numbers else "Carefully remove headers, footers, and page numbers while preserving all other content."}
-
-Text to reformat:
+    if reformat_as_markdown and ocr_corrected_chunk:
+        markdown_prompt = f"""Text to reformat:
 
 {ocr_corrected_chunk}
 
 Reformatted markdown:
 """
         processed_chunk = await generate_completion(
-            markdown_prompt, max_tokens=len(ocr_corrected_chunk) + 500
+            markdown_prompt,
+            max_tokens=get_output_token_budget(ocr_corrected_chunk, provider, model),
+            system_prompt=MARKDOWN_FORMATTING_SYSTEM_PROMPT.format(
+                header_instruction=header_instruction
+            ),
+            provider=provider,
+            model=model,
         )
+        processed_chunk = processed_chunk or ""
     new_context = processed_chunk[
         -1000:
     ]  # Use the last 1000 characters as context for the next chunk
@@ -717,51 +3959,408 @@ Reformatted markdown:
     return processed_chunk, new_context
 
 
+# Chunk Validation
+PREAMBLE_PATTERN = re.compile(
+    r"^\s*(here is|here's|here are|sure[,!.]|certainly[,!.]|of course[,!.]|below is|"
+    r"the (corrected|reformatted) (text|markdown)|i have (corrected|reformatted))",
+    flags=re.IGNORECASE,
+)
+REFUSAL_PATTERN = re.compile(
+    r"^\s*(i'm sorry|i am sorry|i apologi[sz]e|i can(not|'t) (help|assist|comply|process)|as an ai)",
+    flags=re.IGNORECASE,
+)
+
+
+def validate_chunk_output(input_chunk: str, output_chunk: Optional[str]) -> List[str]:
+    """Return the problems found in a chunk's output; an empty list means it looks fine"""
+    if not output_chunk or not output_chunk.strip():
+        return ["empty"]
+    problems = []
+    input_text = strip_markup_for_comparison(input_chunk)
+    output_text = strip_markup_for_comparison(output_chunk)
+    length_ratio = len(output_text) / len(input_text) if input_text else 1.0
+    if length_ratio < CHUNK_MIN_LENGTH_RATIO:
+        problems.append(f"truncated (length ratio {length_ratio:.2f})")
+    elif length_ratio > CHUNK_MAX_LENGTH_RATIO:
+        problems.append(f"runaway (length ratio {length_ratio:.2f})")
+    if REFUSAL_PATTERN.match(output_text):
+        problems.append("refusal")
+    elif PREAMBLE_PATTERN.match(output_text):
+        problems.append("preamble")
+    if LANGDETECT_AVAILABLE and len(input_text) >= 200 and len(output_text) >= 200:
+        try:
+            input_language = detect_language(input_text)
+            output_language = detect_language(output_text)
+            if input_language != output_language:
+                problems.append(
+                    f"language mismatch ({input_language} -> {output_language})"
+                )
+        except Exception:
+            pass
+    return problems
+
+
+def parse_model_cascade(spec: Optional[str]) -> List[Tuple[str, Optional[str]]]:
+    """Parse "LM_STUDIO:qwen2.5-7b-instruct,OPENAI:gpt-4o" into (provider, model) tiers"""
+    tiers = []
+    for entry in (spec or "").split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        provider, _, model = entry.partition(":")
+        provider = provider.strip().upper().replace("-", "_")
+        if provider not in ("LOCAL", "OPENAI", "CLAUDE", "LM_STUDIO"):
+            logging.error(f"Ignoring model cascade tier with unknown provider: {entry}")
+            continue
+        tiers.append((provider, model.strip() or None))
+    return tiers
+
+
+def format_tier(provider: Optional[str], model: Optional[str]) -> str:
+    provider = provider or get_default_provider()
+    return f"{provider}:{model}" if model else provider
+
+
+def get_attempt_plan(
+    model_cascade: List[Tuple[str, Optional[str]]],
+) -> List[Tuple[Optional[str], Optional[str]]]:
+    """Providers/models to try for a chunk, in order: every cascade tier, then retries on the last one"""
+    if model_cascade:
+        return model_cascade + [model_cascade[-1]] * CHUNK_MAX_RETRIES
+    retry_tier = (FALLBACK_API_PROVIDER or None, None)
+    return [(None, None)] + [retry_tier] * CHUNK_MAX_RETRIES
+
+
+async def process_chunk_with_retries(
+    chunk: str,
+    prev_context: str,
+    chunk_index: int,
+    total_chunks: int,
+    reformat_as_markdown: bool,
+    suppress_headers_and_page_numbers: bool,
+    correction_mode: str,
+    skip_llm_correction: bool,
+    retried_chunks: List[Dict],
+    model_cascade: Optional[List[Tuple[str, Optional[str]]]] = None,
+    vocabulary: Optional[Dict[str, int]] = None,
+    tier_counts: Optional[Dict[str, int]] = None,
+) -> Tuple[str, str]:
+    """
+    Process a chunk, validate the output and retry just this chunk if it looks wrong.
+
+    Retries go to FALLBACK_API_PROVIDER when one is configured. With a model
+    cascade the chunk starts on the first (cheapest) tier and is escalated to the
+    next one when its output fails validation or the local quality heuristic.
+    If every attempt fails validation the input chunk is kept, so one bad
+    response never loses the rest of the document.
+    """
+    model_cascade = model_cascade or []
+    attempt_plan = get_attempt_plan(model_cascade)
+    attempts = []
+    fallback_result = None
+    chunk_attempt_token = current_chunk_attempt.set((chunk_index, 0))
+    for attempt, (provider, model) in enumerate(attempt_plan):
+        tier = format_tier(provider, model)
+        current_chunk_attempt.set((chunk_index, attempt))
+        try:
+            processed_chunk, new_context = await process_chunk(
+                chunk,
+                prev_context,
+                chunk_index,
+                total_chunks,
+                reformat_as_markdown,
+                suppress_headers_and_page_numbers,
+                correction_mode,
+                skip_llm_correction,
+                provider,
+                model,
+            )
+            problems = validate_chunk_output(chunk, processed_chunk)
+        except Exception as e:
+            logging.error(f"Chunk {chunk_index + 1}/{total_chunks} raised: {e}")
+            processed_chunk, new_context = None, prev_context
+            problems = [f"error: {e}"]
+        if not problems and attempt < len(model_cascade) - 1:
+            # Only cheaper tiers are second-guessed; there is nothing to escalate to from the last one
+            chunk_report = flag_chunk_quality(
+                compute_chunk_quality(chunk, processed_chunk, vocabulary or {})
+            )
+            if chunk_report["suspicious"]:
+                fallback_result = fallback_result or (processed_chunk, new_context, tier)
+                problems = ["failed quality heuristic"]
+        if not problems:
+            break
+        attempts.append({"tier": tier, "problems": problems})
+        chunk_failed_attempts_total.inc()
+        logging.warning(
+            f"Chunk {chunk_index + 1}/{total_chunks} attempt {attempt + 1} on {tier} failed validation: {', '.join(problems)}"
+        )
+    current_chunk_attempt.reset(chunk_attempt_token)
+
+    if problems and fallback_result:
+        # A cheaper tier's output that only failed the quality heuristic beats the raw text
+        processed_chunk, new_context, tier = fallback_result
+        problems = []
+    if attempts:
+        retried_chunks.append(
+            {
+                "chunk_index": chunk_index,
+                "attempts": attempts,
+                "recovered": not problems,
+                "final_tier": tier,
+            }
+        )
+    if tier_counts is not None:
+        final_tier = "UNCORRECTED" if problems else tier
+        tier_counts[final_tier] = tier_counts.get(final_tier, 0) + 1
+    if problems:
+        logging.error(
+            f"Chunk {chunk_index + 1}/{total_chunks} failed after {len(attempt_plan)} attempts; keeping the uncorrected text"
+        )
+        return chunk, chunk[-1000:]
+    return processed_chunk, new_context
+
+
+# Chunk Scheduling
+PREFILL_COST_RATIO = 0.05  # A prompt token costs about this fraction of a generated token
+
+
+def estimate_chunk_cost(
+    tokens: float,
+    correction_mode: str,
+    reformat_as_markdown: bool,
+    skip_llm_correction: bool = False,
+) -> float:
+    """Relative processing time of a chunk of that many tokens, in generated-token equivalents"""
+    if correction_mode == "SINGLE_PASS":
+        input_tokens, output_tokens = tokens, tokens
+    else:
+        if skip_llm_correction:
+            input_tokens, output_tokens = 0, 0
+        elif correction_mode == "EDIT_LIST":
+            # The edit list is small; most of the time goes into reading the chunk
+            input_tokens, output_tokens = tokens, tokens * 0.1
+        else:
+            input_tokens, output_tokens = tokens, tokens
+        if reformat_as_markdown:
+            input_tokens += tokens
+            output_tokens += tokens
+    return output_tokens + input_tokens * PREFILL_COST_RATIO
+
+
+def get_longest_first_order(costs: List[float]) -> List[int]:
+    """Indices by decreasing cost, ties in document order (longest-processing-time-first)"""
+    return sorted(range(len(costs)), key=lambda i: (-costs[i], i))
+
+
+async def run_longest_first(
+    costs: List[float], process_index, max_concurrency: int = 0
+) -> List[object]:
+    """
+    Run process_index(i) for every index, longest first, on at most
+    max_concurrency workers (0 = all at once), returning results in index order.
+
+    Starting the big chunks first keeps one large chunk from running alone at
+    the end of the document.
+    """
+    pending = deque(get_longest_first_order(costs))
+    results = [None] * len(costs)
+
+    async def worker():
+        while pending:
+            index = pending.popleft()
+            results[index] = await process_index(index)
+
+    worker_count = min(max_concurrency or len(costs), len(costs))
+    await asyncio.gather(*[worker() for _ in range(worker_count)])
+    return results
+
+
+# Chunk Stitching
+STITCH_MIN_MATCH_WORDS = 3
+
+
+def normalize_stitch_token(token: str) -> str:
+    # Markdown markup and punctuation often differ between the two copies of the overlap
+    return re.sub(r"[\W_]+", "", token.lower())
+
+
+def get_stitch_tokens(text: str, count: int, from_end: bool = False) -> List[Tuple[str, int]]:
+    """The first (or last) count words of text, normalized, with the offset where each ends"""
+    if from_end:
+        # Only tokenize a tail of the text; its first, possibly cut, word is dropped
+        tail_start = max(0, len(text) - count * 50)
+        tokens = get_stitch_tokens(text[tail_start:], len(text))[1 if tail_start else 0 :]
+        if len(tokens) < count and tail_start:
+            tokens = get_stitch_tokens(text, len(text))
+        return [(token, tail_start + end) for token, end in tokens[-count:]]
+    tokens = []
+    for m in re.finditer(r"\S+", text):
+        token = normalize_stitch_token(m.group(0))
+        # Tokens that are pure markup ("#", "-", "**") carry no evidence either way
+        if token:
+            tokens.append((token, m.end()))
+            if len(tokens) == count:
+                break
+    return tokens
+
+
+def find_stitch_point(
+    previous: str, current: str, overlap_words: int
+) -> Optional[Tuple[int, int]]:
+    """
+    Where to join two processed chunks whose texts overlap at the seam.
+
+    Each chunk starts with the last overlap_words words of the one before, so
+    the overlap must sit at the very end of previous and the very start of
+    current. Only the last and first overlap_words + slack words are aligned,
+    the matched words must start near the start of current and end near the
+    end of previous, and together cover about half the overlap or more.
+    Returns (end of previous to keep, start of current to keep), or None if
+    no such overlap is found, e.g. because the model rewrote or dropped it.
+    """
+    slack = max(STITCH_MIN_MATCH_WORDS, overlap_words // 2)
+    window_words = overlap_words + slack
+    previous_tokens = get_stitch_tokens(previous, window_words, from_end=True)
+    current_tokens = get_stitch_tokens(current, window_words)
+    blocks = [
+        block
+        for block in difflib.SequenceMatcher(
+            None,
+            [token for token, _ in previous_tokens],
+            [token for token, _ in current_tokens],
+            autojunk=False,
+        ).get_matching_blocks()
+        if block.size
+    ]
+    if not blocks:
+        return None
+    first, last = blocks[0], blocks[-1]
+    matched_words = sum(block.size for block in blocks)
+    if (
+        matched_words < max(STITCH_MIN_MATCH_WORDS, overlap_words // 2)
+        or first.b > slack
+        or len(previous_tokens) - (last.a + last.size) > slack
+    ):
+        return None
+    previous_end = previous_tokens[last.a + last.size - 1][1]
+    current_start = current_tokens[last.b + last.size - 1][1]
+    return previous_end, current_start
+
+
+def stitch_chunks(processed_chunks: List[str], overlap_words: int) -> str:
+    """
+    Merge processed chunks in order, removing the duplicated overlap at every seam.
+
+    Seams where no anchored overlap is found are joined with a blank line and
+    both sides kept unchanged. Each seam only looks at the two chunks next to
+    it, so the cost is linear in the document length.
+    """
+    if not processed_chunks:
+        return ""
+    parts = [processed_chunks[0]]
+    for chunk in processed_chunks[1:]:
+        stitch_point = find_stitch_point(parts[-1], chunk, overlap_words)
+        if stitch_point is None:
+            parts[-1] = parts[-1].rstrip() + "\n\n"
+            parts.append(chunk.lstrip())
+        else:
+            previous_end, current_start = stitch_point
+            parts[-1] = parts[-1][:previous_end]
+            parts.append(chunk[current_start:])
+    return "".join(parts)
+
+
 async def process_chunks(
     chunks: List[str],
     reformat_as_markdown: bool,
     suppress_headers_and_page_numbers: bool,
+    correction_mode: str = CORRECTION_MODE,
+    skip_llm_correction_indices: Optional[set] = None,
+    retried_chunks: Optional[List[Dict]] = None,
+    model_cascade: Optional[List[Tuple[str, Optional[str]]]] = None,
+    vocabulary: Optional[Dict[str, int]] = None,
+    tier_counts: Optional[Dict[str, int]] = None,
 ) -> List[str]:
     total_chunks = len(chunks)
+    skip_llm_correction_indices = skip_llm_correction_indices or set()
+    retried_chunks = retried_chunks if retried_chunks is not None else []
+    tier_counts = tier_counts if tier_counts is not None else {}
 
     async def process_chunk_with_context(
         chunk: str, prev_context: str, index: int
     ) -> Tuple[int, str, str]:
-        processed_chunk, new_context = await process_chunk(
+        processed_chunk, new_context = await process_chunk_with_retries(
             chunk,
             prev_context,
             index,
             total_chunks,
             reformat_as_markdown,
             suppress_headers_and_page_numbers,
+            correction_mode,
+            index in skip_llm_correction_indices,
+            retried_chunks,
+            model_cascade,
+            vocabulary,
+            tier_counts,
         )
         return index, processed_chunk, new_context
 
-    if USE_LOCAL_LLM:
+    if USE_LOCAL_LLM and LOCAL_LLM_REPLICAS <= 1:
         logging.info("Using local LLM. Processing chunks sequentially...")
         context = ""
         processed_chunks = []
         for i, chunk in enumerate(chunks):
-            processed_chunk, context = await process_chunk(
+            processed_chunk, context = await process_chunk_with_retries(
                 chunk,
                 context,
                 i,
                 total_chunks,
                 reformat_as_markdown,
                 suppress_headers_and_page_numbers,
+                correction_mode,
+                i in skip_llm_correction_indices,
+                retried_chunks,
+                model_cascade,
+                vocabulary,
+                tier_counts,
             )
             processed_chunks.append(processed_chunk)
     else:
         logging.info(
-            "Using API-based LLM. Processing chunks concurrently while maintaining order..."
+            "Processing chunks concurrently, longest first, while maintaining order..."
         )
-        tasks = [
-            process_chunk_with_context(chunk, "", i) for i, chunk in enumerate(chunks)
+        costs = [
+            estimate_chunk_cost(
+                tokens,
+                correction_mode,
+                reformat_as_markdown,
+                i in skip_llm_correction_indices,
+            )
+            for i, tokens in enumerate(get_token_estimator().estimate(chunks))
         ]
-        results = await asyncio.gather(*tasks)
-        # Sort results by index to maintain order
-        sorted_results = sorted(results, key=lambda x: x[0])
-        processed_chunks = [chunk for _, chunk, _ in sorted_results]
+        results = await run_longest_first(
+            costs,
+            lambda i: process_chunk_with_context(chunks[i], "", i),
+            MAX_CONCURRENT_CHUNKS,
+        )
+        processed_chunks = [chunk for _, chunk, _ in results]
+    if retried_chunks:
+        recovered = sum(r["recovered"] for r in retried_chunks)
+        logging.warning(
+            f"{len(retried_chunks)} chunks needed retries ({recovered} recovered): "
+            f"{sorted(r['chunk_index'] + 1 for r in retried_chunks)}"
+        )
+    for name, level in get_concurrency_levels().items():
+        logging.info(
+            f"Concurrency {name}: limit {level['limit']}/{level['max_limit']} "
+            f"({level['increases']} increases, {level['decreases']} decreases)"
+        )
+    if model_cascade:
+        logging.info(
+            "Chunks per model tier: "
+            + ", ".join(f"{tier}: {count}" for tier, count in tier_counts.items())
+        )
     logging.info(f"All {total_chunks} chunks processed successfully")
     return processed_chunks
 
@@ -770,13 +4369,31 @@ async def process_document(
     list_of_extracted_text_strings: List[str],
     reformat_as_markdown: bool = True,
     suppress_headers_and_page_numbers: bool = True,
+    correction_mode: str = CORRECTION_MODE,
+    ocr_languages: Optional[List[str]] = None,
+    processing_report: Optional[Dict] = None,
+    model_cascade: Optional[str] = None,
 ) -> str:
     logging.info(
         f"Starting document processing. Total pages: {len(list_of_extracted_text_strings):,}"
     )
     full_text = "\n\n".join(list_of_extracted_text_strings)
     logging.info(f"Size of full text before processing: {len(full_text):,} characters")
-    chunk_size, overlap = 8000, 10
+    cascade_tiers = parse_model_cascade(
+        MODEL_CASCADE if model_cascade is None else model_cascade
+    )
+    # Every tier a chunk may be sent to has to fit it
+    tiers = {
+        (provider or get_default_provider(), model)
+        for provider, model in get_attempt_plan(cascade_tiers)
+    }
+    if any(provider == "LM_STUDIO" for provider, _ in tiers):
+        await refresh_lm_studio_capabilities()
+    await run_blocking(prepare_token_counting, tiers)
+    chunk_size = min(
+        [await run_blocking(get_chunk_size_in_characters, *tier) for tier in tiers]
+    )
+    overlap = 10
     # Improved chunking logic
     paragraphs = re.split(r"\n\s*\n", full_text)
     chunks = []
@@ -817,17 +4434,237 @@ async def process_document(
     logging.info(
         f"Document split into {len(chunks):,} chunks. Chunk size: {chunk_size:,}, Overlap: {overlap:,}"
     )
+    skip_llm_correction_indices = set()
+    if LOCAL_SPELL_CORRECTION:
+        spell_corrector = await run_blocking(
+            get_spell_corrector, ocr_languages or DEFAULT_OCR_LANGUAGES.split("+")
+        )
+        if spell_corrector:
+            document_vocabulary = await run_blocking(
+                get_document_vocabulary, full_text, LOCAL_SPELL_DOCUMENT_MIN_COUNT
+            )
+            for i, chunk in enumerate(chunks):
+                chunks[i], spell_stats = await run_blocking(
+                    spell_corrector.correct_text, chunk, document_vocabulary
+                )
+                if (
+                    spell_stats["residual_error_rate"] <= LOCAL_SPELL_SKIP_LLM_ERROR_RATE
+                    and not spell_stats["uncertain_corrections"]
+                ):
+                    skip_llm_correction_indices.add(i)
+                logging.info(
+                    f"Chunk {i + 1}: {spell_stats['corrected']:,} words corrected locally, "
+                    f"residual unknown-word rate {spell_stats['residual_error_rate']:.2%}"
+                )
+            logging.info(
+                f"Local spell correction: LLM correction skipped for {len(skip_llm_correction_indices)}/{len(chunks)} chunks"
+            )
+    logging.info(f"Correction mode: {correction_mode}")
+    vocabulary = None
+    if cascade_tiers:
+        logging.info(
+            f"Model cascade: {' -> '.join(format_tier(p, m) for p, m in cascade_tiers)}"
+        )
+        vocabulary = await run_blocking(
+            load_wordlist, ocr_languages or DEFAULT_OCR_LANGUAGES.split("+")
+        )
+    retried_chunks, tier_counts = [], {}
     processed_chunks = await process_chunks(
-        chunks, reformat_as_markdown, suppress_headers_and_page_numbers
+        chunks,
+        reformat_as_markdown,
+        suppress_headers_and_page_numbers,
+        correction_mode,
+        skip_llm_correction_indices,
+        retried_chunks,
+        cascade_tiers,
+        vocabulary,
+        tier_counts,
     )
-    final_text = "".join(processed_chunks)
+    if processing_report is not None:
+        processing_report["chunks"] = chunks
+        processing_report["processed_chunks"] = processed_chunks
+        processing_report["retried_chunks"] = retried_chunks
+        processing_report["tiers"] = tier_counts
+    final_text = await run_blocking(stitch_chunks, processed_chunks, overlap)
     logging.info(f"Size of text after combining chunks: {len(final_text):,} characters")
     logging.info(
         f"Document processing complete. Final text length: {len(final_text):,} characters"
     )
+    if HEDGE_REQUESTS:
+        stats = get_hedge_stats()
+        logging.info(
+            f"Hedged {stats['hedged']}/{stats['requests']} requests; the hedge won {stats['hedge_wins']} times "
+            f"({stats['budget_exhausted']} hedges skipped by the budget)"
+        )
+    for provider, stats in get_prompt_cache_stats().items():
+        logging.info(
+            f"{provider} prompt cache: {stats['cached_input_tokens']:,}/{stats['input_tokens']:,} input tokens cached "
+            f"({stats['cache_hit_ratio']:.1%}), mean latency {stats['mean_latency']:.2f}s"
+        )
     return final_text
 
 
+# Local Quality Assessment
+MARKDOWN_MARKUP_PATTERN = re.compile(r"[#*_>`|]+")
+QUALITY_WORD_PATTERN = re.compile(r"[^\W\d_]{2,}", flags=re.UNICODE)
+
+
+def levenshtein_distance(a: str, b: str) -> int:
+    """
+    Character-level edit distance using Myers/Hyyrö bit-parallel computation.
+
+    The DP column for the shorter string is held as bit vectors in Python ints,
+    so each character of the longer string costs a handful of wide bitwise
+    operations instead of a row of the O(n*m) table.
+    """
+    if len(a) > len(b):
+        a, b = b, a
+    if not a:
+        return len(b)
+    m = len(a)
+    full = (1 << m) - 1
+    high_bit = 1 << (m - 1)
+    peq: Dict[str, int] = {}
+    for i, c in enumerate(a):
+        peq[c] = peq.get(c, 0) | (1 << i)
+    pv, mv, score = full, 0, m
+    for c in b:
+        eq = peq.get(c, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | (~(xh | pv) & full)
+        mh = pv & xh
+        if ph & high_bit:
+            score += 1
+        elif mh & high_bit:
+            score -= 1
+        ph = ((ph << 1) | 1) & full
+        mh = (mh << 1) & full
+        pv = mh | (~(xv | ph) & full)
+        mv = ph & xv
+    return score
+
+
+def strip_markup_for_comparison(text: str) -> str:
+    return re.sub(r"\s+", " ", MARKDOWN_MARKUP_PATTERN.sub("", text)).strip()
+
+
+def compute_chunk_quality(
+    raw_chunk: str, processed_chunk: str, vocabulary: Dict[str, int]
+) -> Dict[str, object]:
+    raw_text = strip_markup_for_comparison(raw_chunk)
+    processed_text = strip_markup_for_comparison(processed_chunk or "")
+    raw_words = [w.lower() for w in QUALITY_WORD_PATTERN.findall(raw_text)]
+    processed_words = [w.lower() for w in QUALITY_WORD_PATTERN.findall(processed_text)]
+    raw_vocabulary = set(raw_words)
+    added_words = [w for w in processed_words if w not in raw_vocabulary]
+    distance = levenshtein_distance(raw_text, processed_text)
+    return {
+        "raw_characters": len(raw_text),
+        "processed_characters": len(processed_text),
+        "length_ratio": len(processed_text) / len(raw_text) if raw_text else 0.0,
+        "edit_distance": distance,
+        "normalized_edit_distance": distance / max(len(raw_text), len(processed_text), 1),
+        "dictionary_rate_before": sum(w in vocabulary for w in raw_words) / len(raw_words)
+        if vocabulary and raw_words
+        else None,
+        "dictionary_rate_after": sum(w in vocabulary for w in processed_words)
+        / len(processed_words)
+        if vocabulary and processed_words
+        else None,
+        "added_word_ratio": len(added_words) / len(processed_words)
+        if processed_words
+        else 0.0,
+    }
+
+
+def flag_chunk_quality(chunk_report: Dict[str, object]) -> Dict[str, object]:
+    before = chunk_report["dictionary_rate_before"]
+    after = chunk_report["dictionary_rate_after"]
+    chunk_report["hallucination_flag"] = (
+        chunk_report["added_word_ratio"] > QUALITY_HALLUCINATION_THRESHOLD
+    )
+    chunk_report["suspicious"] = bool(
+        chunk_report["hallucination_flag"]
+        or not 0.5 <= chunk_report["length_ratio"] <= 1.5
+        or (before is not None and after is not None and after < before)
+    )
+    return chunk_report
+
+
+def compute_quality_report(
+    raw_chunks: List[str], processed_chunks: List[str], languages: List[str]
+) -> Dict[str, object]:
+    """
+    Local quality report over the whole document, one entry per chunk.
+
+    A chunk is flagged as a possible hallucination when the share of its output
+    words that never occur in its input exceeds QUALITY_HALLUCINATION_THRESHOLD,
+    and as suspicious when it is flagged, shrank or grew by more than half, or
+    its dictionary-word rate went down.
+    """
+    vocabulary = load_wordlist(languages)
+    chunk_reports = [
+        compute_chunk_quality(raw, processed, vocabulary)
+        for raw, processed in zip(raw_chunks, processed_chunks)
+    ]
+    for index, chunk_report in enumerate(chunk_reports):
+        chunk_report["chunk_index"] = index
+        flag_chunk_quality(chunk_report)
+
+    weights = np.array([r["raw_characters"] for r in chunk_reports], dtype=float)
+    weights = weights if weights.sum() else np.ones_like(weights)
+
+    def weighted_mean(key: str) -> Optional[float]:
+        values = np.array(
+            [np.nan if r[key] is None else r[key] for r in chunk_reports], dtype=float
+        )
+        valid = ~np.isnan(values)
+        if not valid.any():
+            return None
+        return float(np.average(values[valid], weights=weights[valid]))
+
+    return {
+        "chunks": chunk_reports,
+        "summary": {
+            "total_chunks": len(chunk_reports),
+            "suspicious_chunks": [r["chunk_index"] for r in chunk_reports if r["suspicious"]],
+            "hallucination_flags": sum(r["hallucination_flag"] for r in chunk_reports),
+            "length_ratio": weighted_mean("length_ratio"),
+            "normalized_edit_distance": weighted_mean("normalized_edit_distance"),
+            "dictionary_rate_before": weighted_mean("dictionary_rate_before"),
+            "dictionary_rate_after": weighted_mean("dictionary_rate_after"),
+            "added_word_ratio": weighted_mean("added_word_ratio"),
+        },
+    }
+
+
+async def assess_document_quality(
+    raw_chunks: List[str],
+    processed_chunks: List[str],
+    languages: List[str],
+    use_llm_judge: bool = USE_LLM_QUALITY_JUDGE,
+) -> Dict[str, object]:
+    """Local quality report, with the LLM judge consulted only for suspicious chunks"""
+    report = await run_blocking(
+        compute_quality_report, raw_chunks, processed_chunks, languages
+    )
+    summary = report["summary"]
+    logging.info(
+        f"Quality report: {len(summary['suspicious_chunks'])}/{summary['total_chunks']} chunks suspicious, "
+        f"{summary['hallucination_flags']} hallucination flags, "
+        f"normalized edit distance {summary['normalized_edit_distance'] or 0:.3f}"
+    )
+    if use_llm_judge:
+        for index in summary["suspicious_chunks"]:
+            score, explanation = await assess_output_quality(
+                raw_chunks[index], processed_chunks[index]
+            )
+            report["chunks"][index]["llm_score"] = score
+            report["chunks"][index]["llm_explanation"] = explanation
+    return report
+
+
 def remove_corrected_text_header(text):
     return (
         text.replace("# Corrected text\n", "")
@@ -865,29 +4702,20 @@ Processed text sample:
 
 Provide a quality score between 0 and 100, where 100 is perfect processing. Also provide a brief explanation of your assessment.
 
-Your response should be in the following format:
-SCORE: [Your score]
-EXPLANATION: [Your explanation]
+Respond with a JSON object of the form {{"score": <integer>, "explanation": "<text>"}}.
 """
 
-    response = await generate_completion(prompt, max_tokens=1000)
-
-    try:
-        lines = response.strip().split("\n")
-        score_line = next(line for line in lines if line.startswith("SCORE:"))
-        score = int(score_line.split(":")[1].strip())
-        explanation = (
-            "\n".join(line for line in lines if line.startswith("EXPLANATION:"))
-            .replace("EXPLANATION:", "")
-            .strip()
-        )
-        logging.info(f"Quality assessment: Score {score}/100")
-        logging.info(f"Explanation: {explanation}")
-        return score, explanation
-    except Exception as e:
-        logging.error(f"Error parsing quality assessment response: {e}")
-        logging.error(f"Raw response: {response}")
+    response = await generate_structured_completion(
+        prompt, QUALITY_ASSESSMENT_SCHEMA, max_tokens=1000
+    )
+    if response is None or not isinstance(response.get("score"), (int, float)):
+        logging.error(f"Invalid quality assessment response: {response}")
         return None, None
+    score = max(0, min(100, int(response["score"])))
+    explanation = str(response.get("explanation", "")).strip()
+    logging.info(f"Quality assessment: Score {score}/100")
+    logging.info(f"Explanation: {explanation}")
+    return score, explanation
 
 
 async def process_document_pipeline(
@@ -898,6 +4726,9 @@ async def process_document_pipeline(
     reformat_as_markdown: bool = True,
     suppress_headers_and_page_numbers: bool = True,
     ocr_languages: Optional[str] = None,
+    correction_mode: Optional[str] = None,
+    model_cascade: Optional[str] = None,
+    job_id: Optional[str] = None,
 ) -> Dict[str, str]:
     """
     Complete document processing pipeline for API usage
@@ -910,11 +4741,18 @@ async def process_document_pipeline(
         reformat_as_markdown: Whether to format as markdown
         suppress_headers_and_page_numbers: Whether to suppress headers and page numbers
         ocr_languages: OCR languages to use (e.g., "eng+rus+deu")
+        correction_mode: "TWO_PASS", "SINGLE_PASS" or "EDIT_LIST" (defaults to CORRECTION_MODE)
+        model_cascade: Comma-separated "PROVIDER:model" tiers, cheapest first (defaults to MODEL_CASCADE)
+        job_id: Identifies the job for fair sharing of the local model (defaults to pdf_path)
 
     Returns:
         Dictionary with paths to output files
     """
     logging.info(f"Starting document processing pipeline for: {pdf_path}")
+    # Lets the local inference worker interleave this job's requests with other jobs',
+    # and keys the job's usage ledger (callers discard it with discard_usage_ledger)
+    job_id = job_id or pdf_path
+    current_job_id.set(job_id)
 
     # Set output directory
     if output_dir:
@@ -922,6 +4760,7 @@ async def process_document_pipeline(
         original_cwd = os.getcwd()
         os.chdir(output_dir)
 
+    documents_in_progress.inc()
     try:
         # Download model if using local LLM
         if USE_LOCAL_LLM:
@@ -947,12 +4786,16 @@ async def process_document_pipeline(
 
         raw_ocr_output_file_path = f"{base_name}__raw_ocr_output.txt"
         llm_corrected_output_file_path = base_name + "_llm_corrected" + output_extension
+        quality_report_file_path = f"{base_name}__quality_report.json"
+        usage_report_file_path = f"{base_name}__usage.json"
 
-        # Convert PDF to images
-        list_of_scanned_images = convert_pdf_to_images(
-            pdf_path, max_test_pages, skip_first_n_pages
-        )
-        logging.info(f"Tesseract version: {pytesseract.get_tesseract_version()}")
+        # Convert PDF to images; rasterization and OCR run off the event loop
+        with pipeline_stage_seconds.time(("rasterize",)):
+            list_of_scanned_images = await run_blocking(
+                convert_pdf_to_images, pdf_path, max_test_pages, skip_first_n_pages
+            )
+        tesseract_version = await run_blocking(pytesseract.get_tesseract_version)
+        logging.info(f"Tesseract version: {tesseract_version}")
         logging.info("Extracting text from converted pages...")
 
         # Extract text using OCR
@@ -962,11 +4805,9 @@ async def process_document_pipeline(
             else DEFAULT_OCR_LANGUAGES.split("+")
         )
         logging.info(f"Using OCR languages: {'+'.join(languages)}")
-        with ThreadPoolExecutor() as executor:
-            list_of_extracted_text_strings = list(
-                executor.map(
-                    lambda img: ocr_image(img, languages), list_of_scanned_images
-                )
+        with pipeline_stage_seconds.time(("ocr",)):
+            list_of_extracted_text_strings = await asyncio.gather(
+                *[run_blocking(ocr_image, img, languages) for img in list_of_scanned_images]
             )
         logging.info("Done extracting text from converted pages.")
         raw_ocr_output = "\n".join(list_of_extracted_text_strings)
@@ -974,13 +4815,31 @@ async def process_document_pipeline(
             f.write(raw_ocr_output)
         logging.info(f"Raw OCR output written to: {raw_ocr_output_file_path}")
 
+        with pipeline_stage_seconds.time(("text_cleanup",)):
+            if STRIP_HEADERS_AND_FOOTERS:
+                list_of_extracted_text_strings, _ = await run_blocking(
+                    strip_headers_and_footers,
+                    list_of_extracted_text_strings,
+                    suppress_headers_and_page_numbers,
+                )
+            if NORMALIZE_OCR_TEXT:
+                list_of_extracted_text_strings, _ = await run_blocking(
+                    normalize_extracted_pages, list_of_extracted_text_strings, languages
+                )
+
         # Process document with LLM
         logging.info("Processing document...")
-        final_text = await process_document(
-            list_of_extracted_text_strings,
-            reformat_as_markdown,
-            suppress_headers_and_page_numbers,
-        )
+        processing_report = {}
+        with pipeline_stage_seconds.time(("llm_correction",)):
+            final_text = await process_document(
+                list_of_extracted_text_strings,
+                reformat_as_markdown,
+                suppress_headers_and_page_numbers,
+                (correction_mode or CORRECTION_MODE).upper(),
+                languages,
+                processing_report,
+                model_cascade,
+            )
         cleaned_text = remove_corrected_text_header(final_text)
 
         # Save the LLM corrected output
@@ -988,16 +4847,38 @@ async def process_document_pipeline(
             f.write(cleaned_text)
         logging.info(f"LLM Corrected text written to: {llm_corrected_output_file_path}")
 
+        # Local quality report over every chunk
+        with pipeline_stage_seconds.time(("quality_report",)):
+            quality_report = await assess_document_quality(
+                processing_report["chunks"],
+                processing_report["processed_chunks"],
+                languages,
+            )
+        quality_report["summary"]["chunks_per_tier"] = processing_report["tiers"]
+        quality_report["retried_chunks"] = processing_report["retried_chunks"]
+        with open(quality_report_file_path, "w") as f:
+            json.dump(quality_report, f, indent=2)
+        logging.info(f"Quality report written to: {quality_report_file_path}")
+        write_usage_report(job_id, usage_report_file_path)
+        logging.info(f"Usage report written to: {usage_report_file_path}")
+
         # Return output file paths
         output_files = {
             "raw_ocr": os.path.abspath(raw_ocr_output_file_path),
             "corrected": os.path.abspath(llm_corrected_output_file_path),
+            "quality_report": os.path.abspath(quality_report_file_path),
+            "usage": os.path.abspath(usage_report_file_path),
         }
 
         logging.info(f"Document processing completed. Output files: {output_files}")
+        documents_total.inc(labels=("completed",))
         return output_files
 
+    except Exception:
+        documents_total.inc(labels=("failed",))
+        raise
     finally:
+        documents_in_progress.dec()
         # Restore original working directory if we changed it
         if output_dir:
             os.chdir(original_cwd)
@@ -1082,34 +4963,50 @@ async def main():
                     f"Using OpenAI model for embeddings: {OPENAI_EMBEDDING_MODEL}"
                 )
 
+        current_job_id.set(input_pdf_file_path)
         base_name = os.path.splitext(input_pdf_file_path)[0]
         output_extension = ".md" if reformat_as_markdown else ".txt"
 
         raw_ocr_output_file_path = f"{base_name}__raw_ocr_output.txt"
         llm_corrected_output_file_path = base_name + "_llm_corrected" + output_extension
 
-        list_of_scanned_images = convert_pdf_to_images(
-            input_pdf_file_path, max_test_pages, skip_first_n_pages
+        list_of_scanned_images = await run_blocking(
+            convert_pdf_to_images, input_pdf_file_path, max_test_pages, skip_first_n_pages
         )
-        logging.info(f"Tesseract version: {pytesseract.get_tesseract_version()}")
+        tesseract_version = await run_blocking(pytesseract.get_tesseract_version)
+        logging.info(f"Tesseract version: {tesseract_version}")
         logging.info("Extracting text from converted pages...")
-        with ThreadPoolExecutor() as executor:
-            list_of_extracted_text_strings = list(
-                executor.map(
-                    lambda img: ocr_image(img, ["eng", "rus"]), list_of_scanned_images
-                )
-            )
+        list_of_extracted_text_strings = await asyncio.gather(
+            *[
+                run_blocking(ocr_image, img, ["eng", "rus"])
+                for img in list_of_scanned_images
+            ]
+        )
         logging.info("Done extracting text from converted pages.")
         raw_ocr_output = "\n".join(list_of_extracted_text_strings)
         with open(raw_ocr_output_file_path, "w") as f:
             f.write(raw_ocr_output)
         logging.info(f"Raw OCR output written to: {raw_ocr_output_file_path}")
 
+        if STRIP_HEADERS_AND_FOOTERS:
+            list_of_extracted_text_strings, _ = await run_blocking(
+                strip_headers_and_footers,
+                list_of_extracted_text_strings,
+                suppress_headers_and_page_numbers,
+            )
+        if NORMALIZE_OCR_TEXT:
+            list_of_extracted_text_strings, _ = await run_blocking(
+                normalize_extracted_pages, list_of_extracted_text_strings, ["eng", "rus"]
+            )
+
         logging.info("Processing document...")
+        processing_report = {}
         final_text = await process_document(
             list_of_extracted_text_strings,
             reformat_as_markdown,
             suppress_headers_and_page_numbers,
+            ocr_languages=["eng", "rus"],
+            processing_report=processing_report,
         )
         cleaned_text = remove_corrected_text_header(final_text)
 
@@ -1131,14 +5028,20 @@ async def main():
         logging.info(f" LLM Corrected: {llm_corrected_output_file_path}")
 
         # Perform a final quality check
-        quality_score, explanation = await assess_output_quality(
-            raw_ocr_output, final_text
+        quality_report = await assess_document_quality(
+            processing_report["chunks"],
+            processing_report["processed_chunks"],
+            ["eng", "rus"],
         )
-        if quality_score is not None:
-            logging.info(f"Final quality score: {quality_score}/100")
-            logging.info(f"Explanation: {explanation}")
-        else:
-            logging.warning("Unable to determine final quality score.")
+        quality_report["summary"]["chunks_per_tier"] = processing_report["tiers"]
+        quality_report["retried_chunks"] = processing_report["retried_chunks"]
+        quality_report_file_path = f"{base_name}__quality_report.json"
+        with open(quality_report_file_path, "w") as f:
+            json.dump(quality_report, f, indent=2)
+        logging.info(f" Quality report: {quality_report_file_path}")
+        usage_report_file_path = f"{base_name}__usage.json"
+        write_usage_report(input_pdf_file_path, usage_report_file_path)
+        logging.info(f" Usage report: {usage_report_file_path}")
     except Exception as e:
         logging.error(f"An error occurred in the main function: {e}")
         logging.error(traceback.format_exc())
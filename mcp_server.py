@@ -32,7 +32,12 @@ from mcp.types import (
 # Add current directory to path for imports
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
-from llm_aided_ocr import process_document_pipeline
+from llm_aided_ocr import (
+    process_document_pipeline,
+    event_loop_lag_monitor,
+    get_usage_summary,
+    discard_usage_ledger,
+)
 
 # Setup logging
 logging.basicConfig(
@@ -70,6 +75,7 @@ class JobStatus:
         self.message = message
         self.output_files = output_files
         self.error = error
+        self.usage = None  # tokens, cost and latency per provider/model, set when the job ends
         self.created_at = datetime.now()
         self.updated_at = datetime.now()
 
@@ -81,6 +87,11 @@ class JobStatus:
             "message": self.message,
             "output_files": self.output_files,
             "error": self.error,
+            "usage": (
+                get_usage_summary(self.job_id)
+                if self.status == "processing"
+                else self.usage
+            ),
             "created_at": self.created_at.isoformat(),
             "updated_at": self.updated_at.isoformat(),
         }
@@ -118,6 +129,7 @@ async def process_pdf_job(
     provider: Optional[str] = None,
     model: Optional[str] = None,
     ocr_languages: Optional[str] = None,
+    model_cascade: Optional[str] = None,
 ):
     """Background task to process PDF"""
     try:
@@ -169,6 +181,8 @@ async def process_pdf_job(
                 skip_first_n_pages=0,
                 reformat_as_markdown=True,
                 ocr_languages=ocr_languages,
+                model_cascade=model_cascade,
+                job_id=job_id,
             )
 
             # Update job status to completed
@@ -190,6 +204,10 @@ async def process_pdf_job(
         active_jobs[job_id].error = str(e)
         active_jobs[job_id].message = f"Processing failed: {str(e)}"
         active_jobs[job_id].updated_at = datetime.now()
+    finally:
+        # Keep the job's usage summary and drop its per-completion ledger
+        active_jobs[job_id].usage = get_usage_summary(job_id)
+        discard_usage_ledger(job_id)
 
 
 @server.list_resources()
@@ -209,6 +227,8 @@ async def handle_list_resources() -> ListResourcesResult:
                             description=f"OCR output file: {file_type}",
                             mimeType="text/plain"
                             if file_path.endswith(".txt")
+                            else "application/json"
+                            if file_path.endswith(".json")
                             else "text/markdown",
                         )
                     )
@@ -279,6 +299,10 @@ async def handle_list_tools() -> ListToolsResult:
                         "type": "string",
                         "description": "OCR languages to use (e.g., 'eng+rus+deu')",
                     },
+                    "model_cascade": {
+                        "type": "string",
+                        "description": "Model tiers, cheapest first; only failing chunks are escalated (e.g., 'lm-studio:qwen2.5-7b-instruct,openai:gpt-4o')",
+                    },
                 },
                 "required": ["pdf_path"],
             },
@@ -347,6 +371,7 @@ async def handle_process_pdf(arguments: Dict[str, Any]) -> CallToolResult:
     provider = arguments.get("provider")
     model = arguments.get("model")
     ocr_languages = arguments.get("ocr_languages")
+    model_cascade = arguments.get("model_cascade")
 
     # Validate PDF file
     if not pdf_path or not validate_pdf_file(pdf_path):
@@ -385,7 +410,9 @@ async def handle_process_pdf(arguments: Dict[str, Any]) -> CallToolResult:
 
     # Start background processing
     asyncio.create_task(
-        process_pdf_job(job_id, pdf_path, output_path, provider, model, ocr_languages)
+        process_pdf_job(
+            job_id, pdf_path, output_path, provider, model, ocr_languages, model_cascade
+        )
     )
 
     return CallToolResult(
@@ -442,6 +469,7 @@ async def handle_list_jobs(arguments: Dict[str, Any]) -> CallToolResult:
                     {
                         "jobs": jobs_list,
                         "total": len(jobs_list),
+                        "event_loop_lag": event_loop_lag_monitor.get_stats(),
                     },
                     indent=2,
                 ),
@@ -490,6 +518,8 @@ async def main():
     # Log configuration
     logger.info("🚀 Starting LLM-Aided OCR MCP Server")
     logger.info(f"📁 Results directory: {RESULTS_DIR_PATH.absolute()}")
+    # Logs a warning whenever something blocks the loop and stalls tool calls
+    event_loop_lag_monitor.start()
 
     # Run the server
     async with stdio_server() as (read_stream, write_stream):
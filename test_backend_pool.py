@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""
+Test script for the OpenAI-compatible backend pool, using local stub servers
+"""
+
+import asyncio
+import json
+import os
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import llm_aided_ocr as ocr
+
+STUB_LATENCY_SECONDS = 0.2
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Minimal /v1/chat/completions endpoint with a fixed or per-token latency"""
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        with self.server.lock:
+            self.server.request_count += 1
+            self.server.in_flight += 1
+            overload = max(1.0, self.server.in_flight / self.server.capacity)
+        if self.server.latency_per_token:
+            # Latency grows with the request's size and is noisy, but not with load
+            time.sleep(
+                self.server.latency_per_token
+                * request["max_tokens"]
+                * random.lognormvariate(0, 0.3)
+            )
+        else:
+            # Past its capacity the stub slows down faster than it gains parallelism
+            time.sleep(STUB_LATENCY_SECONDS * overload**2)
+        with self.server.lock:
+            self.server.in_flight -= 1
+        if self.server.failing:
+            self.send_response(500)
+            self.end_headers()
+            return
+        body = json.dumps(
+            {
+                "id": "stub",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": "stub-model",
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {
+                            "role": "assistant",
+                            "content": f"Hello from {self.server.server_port}",
+                        },
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15},
+            }
+        ).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_stub_server(failing=False, capacity=1000, latency_per_token=None):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.request_count = 0
+    server.in_flight = 0
+    server.capacity = capacity
+    server.latency_per_token = latency_per_token
+    server.lock = threading.Lock()
+    server.failing = failing
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def make_pool(servers, max_concurrency=2, weights=None, adaptive=False):
+    weights = weights or [1.0] * len(servers)
+    return ocr.OpenAICompatibleBackendPool(
+        [
+            ocr.OpenAICompatibleBackend(
+                f"http://127.0.0.1:{server.server_port}",
+                weight=weight,
+                max_concurrency=max_concurrency,
+                adaptive=adaptive,
+            )
+            for server, weight in zip(servers, weights)
+        ],
+        max_failures=2,
+        cooldown_seconds=60,
+    )
+
+
+async def run_requests(pool, count, sizes=(20,)):
+    ocr.lm_studio_pool = pool
+    start = time.perf_counter()
+    results = await asyncio.gather(
+        *[
+            ocr.generate_completion_from_lm_studio(f"Request {i}", sizes[i % len(sizes)])
+            for i in range(count)
+        ]
+    )
+    return results, time.perf_counter() - start
+
+
+async def test_throughput_scales_with_backends():
+    """Twice the backends should take about half the time"""
+    print("1. Testing throughput with one vs. two backends...")
+    servers = [start_stub_server(), start_stub_server()]
+    _, one_backend = await run_requests(make_pool(servers[:1]), 8)
+    results, two_backends = await run_requests(make_pool(servers), 8)
+    speedup = one_backend / two_backends
+    print(f"   1 backend: {one_backend:.2f}s, 2 backends: {two_backends:.2f}s ({speedup:.2f}x)")
+    print(f"   Requests per server: {[s.request_count for s in servers]}")
+    ok = all(results) and speedup > 1.6
+    print("✅ Throughput scales with backends" if ok else "❌ Throughput did not scale")
+    return ok
+
+
+async def test_weighted_routing():
+    """A backend with twice the weight should get about twice the requests"""
+    print("\n2. Testing weighted least-outstanding routing...")
+    servers = [start_stub_server(), start_stub_server()]
+    pool = make_pool(servers, max_concurrency=8, weights=[2.0, 1.0])
+    results, _ = await run_requests(pool, 12)
+    counts = [s.request_count for s in servers]
+    print(f"   Requests per server (weights 2:1): {counts}")
+    ok = all(results) and counts[0] > counts[1]
+    print("✅ Heavier backend received more requests" if ok else "❌ Weights ignored")
+    return ok
+
+
+async def test_failing_backend_is_ejected():
+    """A failing backend is ejected and later requests go to the healthy one"""
+    print("\n3. Testing passive health checks and ejection...")
+    healthy, failing = start_stub_server(), start_stub_server(failing=True)
+    pool = make_pool([healthy, failing], max_concurrency=1)
+    await run_requests(pool, 6)
+    failing_requests = failing.request_count
+    results, _ = await run_requests(pool, 6)
+    stats = pool.get_stats()
+    print(f"   Backend health: {[(s['base_url'], s['healthy']) for s in stats]}")
+    ok = (
+        not stats[1]["healthy"]
+        and failing.request_count == failing_requests
+        and all(results)
+    )
+    print("✅ Failing backend ejected" if ok else "❌ Failing backend still in rotation")
+    return ok
+
+
+async def test_adaptive_concurrency():
+    """AIMD should settle near a backend's capacity instead of its configured maximum"""
+    print("\n4. Testing adaptive (AIMD) concurrency...")
+    server = start_stub_server(capacity=3)
+    pool = make_pool([server], max_concurrency=16, adaptive=True)
+    results, elapsed = await run_requests(pool, 60)
+    stats = pool.backends[0].limiter.get_stats()
+    print(
+        f"   60 requests in {elapsed:.2f}s, limit {stats['limit']}/{stats['max_limit']} "
+        f"({stats['increases']} increases, {stats['decreases']} decreases)"
+    )
+    ok = all(results) and stats["decreases"] > 0 and stats["limit"] < stats["max_limit"]
+    print("✅ Concurrency adapted to capacity" if ok else "❌ Concurrency did not adapt")
+    return ok
+
+
+async def test_adaptive_concurrency_ignores_request_size():
+    """Mixed request sizes and noisy latency that doesn't depend on load must not shrink the limit"""
+    print("\n5. Testing AIMD with mixed request sizes and load-independent latency...")
+    server = start_stub_server(latency_per_token=0.005)
+    pool = make_pool([server], max_concurrency=16, adaptive=True)
+    results, elapsed = await run_requests(pool, 200, sizes=(10, 20, 40, 160))
+    stats = pool.backends[0].limiter.get_stats()
+    print(
+        f"   200 requests in {elapsed:.2f}s, limit {stats['limit']}/{stats['max_limit']} "
+        f"({stats['increases']} increases, {stats['decreases']} decreases)"
+    )
+    ok = all(results) and stats["decreases"] == 0 and stats["limit"] >= 12
+    print("✅ Concurrency stayed near the maximum" if ok else "❌ Concurrency backed off without overload")
+    return ok
+
+
+async def main():
+    print("🔧 Backend Pool Tests")
+    results = [
+        await test_throughput_scales_with_backends(),
+        await test_weighted_routing(),
+        await test_failing_backend_is_ejected(),
+        await test_adaptive_concurrency(),
+        await test_adaptive_concurrency_ignores_request_size(),
+    ]
+    print(f"\n{'✅' if all(results) else '❌'} {sum(results)}/{len(results)} tests passed")
+    return all(results)
+
+
+if __name__ == "__main__":
+    success = asyncio.run(main())
+    sys.exit(0 if success else 1)
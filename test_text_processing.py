@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+Test script for the text processing and quality assessment steps, with stubbed completions
+"""
+
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import llm_aided_ocr as ocr
+
+
+async def test_assess_output_quality():
+    """The LLM judge builds its prompt, sends the schema and clamps the score"""
+    print("\n1. Testing LLM quality assessment...")
+    calls = []
+
+    async def stub_structured_completion(prompt, json_schema, max_tokens=1000, **kwargs):
+        calls.append((prompt, json_schema))
+        return {"score": 120, "explanation": " Reads well. "}
+
+    original = ocr.generate_structured_completion
+    ocr.generate_structured_completion = stub_structured_completion
+    try:
+        score, explanation = await ocr.assess_output_quality(
+            "Tbe quick brown fox", "The quick brown fox"
+        )
+    finally:
+        ocr.generate_structured_completion = original
+    prompt, json_schema = calls[0]
+    ok = (
+        score == 100
+        and explanation == "Reads well."
+        and json_schema is ocr.QUALITY_ASSESSMENT_SCHEMA
+        and '{"score": <integer>, "explanation": "<text>"}' in prompt
+        and "Tbe quick brown fox" in prompt
+    )
+    print(f"   Score {score}, explanation {explanation!r}")
+    print("✅ Quality assessment parsed" if ok else "❌ Quality assessment failed")
+    return ok
+
+
+def test_unwrap_keeps_tables_and_headings():
+    """Hard-wrapped prose is joined; table rows and headings keep their own lines"""
+    print("\n2. Testing paragraph unwrapping around tables and headings...")
+    text = (
+        "QUARTERLY RESULTS\n"
+        "Revenue grew in every region and the\n"
+        "margin improved on lower costs.\n"
+        "\n"
+        "## Regional breakdown\n"
+        "Region Q1 Q2\n"
+        "North 1,200 1,350\n"
+        "South 980 1,010\n"
+        "\n"
+        "| Item | Cost |\n"
+        "| Paper | 12.50 |"
+    )
+    expected = (
+        "QUARTERLY RESULTS\n"
+        "Revenue grew in every region and the margin improved on lower costs.\n"
+        "\n"
+        "## Regional breakdown\n"
+        "Region Q1 Q2\n"
+        "North 1,200 1,350\n"
+        "South 980 1,010\n"
+        "\n"
+        "| Item | Cost |\n"
+        "| Paper | 12.50 |"
+    )
+    result = ocr.unwrap_paragraph_lines(text)
+    ok = result == expected
+    if not ok:
+        print(f"   Got:\n{result}")
+    print("✅ Tables and headings kept" if ok else "❌ Tables or headings were joined")
+    return ok
+
+
+def test_dehyphenate_sample():
+    """Words split at line breaks in the sample letter are rejoined without a wordlist"""
+    print("\n3. Testing de-hyphenation of the sample OCR output...")
+    sample_path = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "160301289-Warren-Buffett-Katharine-Graham-Letter__raw_ocr_output.txt",
+    )
+    with open(sample_path, encoding="utf-8") as f:
+        text = f.read()
+    splits = ocr.HYPHENATED_LINE_BREAK_PATTERN.findall(text)
+    result = ocr.dehyphenate(text, ocr.count_document_words(text))
+    kept = sorted({f"{first}-{second}" for first, second in splits if f"{first}-{second}" in result})
+    ok = (
+        all(word in result for word in ["historical", "capital", "majority"])
+        and kept == ["above-average", "double-digit", "long-term", "of-living"]
+    )
+    print(f"   {len(splits)} line-break splits, hyphen kept for {kept}")
+    print("✅ Sample de-hyphenated" if ok else "❌ Sample de-hyphenation failed")
+    return ok
+
+
+def test_spell_correction_digit_confusions():
+    """Digits misread for letters are fixed; numbers and alphanumeric terms are kept"""
+    print("\n4. Testing local spell correction of digit confusions...")
+    words = {word: 10 for word in "i would like to have more time for the book in room".split()}
+    corrector = ocr.SymSpellCorrector(words)
+    text = "I would 1ike to have more t1me for the b00k in room 12b on the 10th of 1999."
+    corrected, stats = corrector.correct_text(text)
+    expected = "I would like to have more time for the book in room 12b on the 10th of 1999."
+    ok = corrected == expected and stats["uncertain_corrections"] == 0
+    print(f"   {corrected!r}")
+    print("✅ Digit confusions corrected" if ok else "❌ Digit confusion correction failed")
+    return ok
+
+
+def test_two_page_heading_is_kept():
+    """A heading repeated on both pages of a 2-page document is not a running header"""
+    print("\n5. Testing header/footer detection on a 2-page document...")
+    pages = [
+        "Quarterly Investment Review\nThe fund returned four percent this quarter.\nCosts fell again.",
+        "Quarterly Investment Review\nBond holdings were reduced in March.\nCash rose slightly.",
+    ]
+    cleaned_pages, stats = ocr.strip_headers_and_footers(pages)
+    ok = cleaned_pages == pages and stats["running_lines"] == 0
+    print(f"   {stats}")
+    print("✅ Heading kept on both pages" if ok else "❌ Heading was stripped as a running header")
+    return ok
+
+
+async def main():
+    print("🔧 Text Processing Tests")
+    results = [
+        await test_assess_output_quality(),
+        test_unwrap_keeps_tables_and_headings(),
+        test_dehyphenate_sample(),
+        test_spell_correction_digit_confusions(),
+        test_two_page_heading_is_kept(),
+    ]
+    print(f"\n{'✅' if all(results) else '❌'} {sum(results)}/{len(results)} tests passed")
+    return all(results)
+
+
+if __name__ == "__main__":
+    success = asyncio.run(main())
+    sys.exit(0 if success else 1)